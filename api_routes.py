@@ -10,6 +10,9 @@ from models import (
 from datetime import datetime, timezone, timedelta
 from sqlalchemy import func
 
+from attendance_counters import low_attendance_count
+from live_sessions import live_session_registry
+
 api_bp = Blueprint('api', __name__, url_prefix='/api')
 
 def now_utc_naive():
@@ -24,28 +27,18 @@ def student_active_sessions():
     
     now = now_utc_naive()
     
-    # Get enrolled course IDs
-    course_ids = [
-        row[0] for row in db.session.query(Enrollment.course_id)
-        .filter(Enrollment.student_id == current_user.id, Enrollment.is_active == True)
-        .all()
-    ]
-    
-    if not course_ids:
-        return jsonify({'success': True, 'sessions': []})
-    
-    # Get active sessions
-    sessions = ClassSession.query.filter(
-        ClassSession.course_id.in_(course_ids),
-        ClassSession.is_active == True,
-        ClassSession.starts_at <= now,
-        ClassSession.ends_at >= now
-    ).order_by(ClassSession.ends_at.asc()).all()
+    # Live sessions of the student's active enrollments, from the in-memory registry
+    sessions = live_session_registry.sessions_for_student(current_user.id, now, active_enrollments_only=True)
+    if not sessions:
+        return jsonify({'success': True, 'sessions': [], 'count': 0})
     
     # Check which sessions student has already marked
     marked_session_ids = {
         row[0] for row in db.session.query(SessionAttendance.session_id)
-        .filter(SessionAttendance.student_id == current_user.id)
+        .filter(
+            SessionAttendance.student_id == current_user.id,
+            SessionAttendance.session_id.in_([session.id for session in sessions]),
+        )
         .all()
     }
     
@@ -101,19 +94,9 @@ def student_attendance_stats():
     for enrollment in enrollments:
         course = enrollment.course
         
-        # Get total sessions for this course
-        total_sessions = ClassSession.query.filter_by(
-            course_id=course.id
-        ).filter(
-            ClassSession.starts_at <= now_utc_naive()
-        ).count()
-        
-        # Get attended sessions
-        attended_sessions = SessionAttendance.query.filter_by(
-            student_id=current_user.id
-        ).join(ClassSession).filter(
-            ClassSession.course_id == course.id
-        ).count()
+        # Maintained per-enrollment counters (see attendance_counters)
+        total_sessions = enrollment.sessions_eligible
+        attended_sessions = min(enrollment.sessions_attended, total_sessions)
         
         percentage = (attended_sessions / total_sessions * 100) if total_sessions > 0 else 0
         
@@ -168,20 +151,11 @@ def student_attendance_alert():
     for enrollment in enrollments:
         course = enrollment.course
         
-        total_sessions = ClassSession.query.filter_by(
-            course_id=course.id
-        ).filter(
-            ClassSession.starts_at <= now_utc_naive()
-        ).count()
-        
+        total_sessions = enrollment.sessions_eligible
         if total_sessions == 0:
             continue
         
-        attended_sessions = SessionAttendance.query.filter_by(
-            student_id=current_user.id
-        ).join(ClassSession).filter(
-            ClassSession.course_id == course.id
-        ).count()
+        attended_sessions = min(enrollment.sessions_attended, total_sessions)
         
         percentage = (attended_sessions / total_sessions * 100)
         
@@ -362,35 +336,6 @@ def admin_dashboard_stats():
     from models import Attendance
     today_attendance = Attendance.query.filter_by(date=today_date).count()
     
-    # Students with low attendance (< 75%)
-    low_attendance_students = []
-    students = User.query.filter_by(role='student', is_active=True).limit(100).all()
-    
-    for student in students:
-        enrollments = Enrollment.query.filter_by(student_id=student.id, is_active=True).all()
-        
-        if not enrollments:
-            continue
-        
-        total_sessions = 0
-        attended_sessions = 0
-        
-        for enrollment in enrollments:
-            course_sessions = ClassSession.query.filter_by(course_id=enrollment.course_id).count()
-            course_attended = SessionAttendance.query.filter_by(
-                student_id=student.id
-            ).join(ClassSession).filter(
-                ClassSession.course_id == enrollment.course_id
-            ).count()
-            
-            total_sessions += course_sessions
-            attended_sessions += course_attended
-        
-        if total_sessions > 0:
-            percentage = (attended_sessions / total_sessions * 100)
-            if percentage < 75:
-                low_attendance_students.append(student.id)
-    
     return jsonify({
         'success': True,
         'total_students': total_students,
@@ -400,5 +345,5 @@ def admin_dashboard_stats():
         'total_courses': total_courses,
         'active_sessions': active_sessions,
         'today_attendance': today_attendance,
-        'low_attendance_count': len(low_attendance_students)
+        'low_attendance_count': low_attendance_count()
     })
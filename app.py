@@ -1,11 +1,10 @@
 import csv
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 import hashlib
 import io
-import json
+import os
 import secrets
 import threading
-from math import isfinite
 from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
 
@@ -17,7 +16,7 @@ from flask_limiter.util import get_remote_address
 from flask_wtf.csrf import CSRFError, CSRFProtect, generate_csrf
 from geopy.distance import geodesic
 from itsdangerous import BadSignature, SignatureExpired, URLSafeTimedSerializer
-from sqlalchemy import func, inspect, text
+from sqlalchemy import and_, case, func, inspect, text
 from sqlalchemy.exc import IntegrityError
 from werkzeug.security import check_password_hash, generate_password_hash
 
@@ -35,13 +34,46 @@ from firebase_service import (
     verify_firebase_user,
     create_custom_token,
     update_session_status,
+    sync_user_last_login,
+    send_multi_path_update,
     delete_firebase_user,
     update_firebase_user,
     get_user_from_firebase,
     sync_firebase_to_sqlite,
-    sync_reference_data_to_sqlite,
+    hydration_ready,
+    run_reference_hydration,
+    start_reference_hydration,
 )
+from firebase_outbox import outbox_flusher
 from email_service import send_attendance_email, send_password_reset_email
+from attendance_backfill import start_backfill_thread
+from bulk_upsert import insert_missing
+from attendance_counters import (
+    attendance_percentage,
+    count_started_sessions,
+    ensure_session_counted,
+    low_attendance_cache,
+    low_attendance_count,
+    rebuild_attendance_counters,
+    record_session_marks,
+    seed_enrollment,
+)
+from face_calibration import load_calibration_report
+from face_index import IVFIndex
+from face_matching import (
+    FACE_TEMPLATE_VERSION,
+    MAX_FACE_TEMPLATES,
+    distances_to,
+    encode_template,
+    face_gallery,
+    min_distance,
+    parse_descriptor,
+    to_face_vector,
+)
+from face_store import SharedFaceStore
+from live_sessions import build_session_context, live_session_registry, session_contexts, session_expiry
+from session_events import session_counters, stage_attempt
+from worker_sync import GenerationFile, file_lock
 from models import (
     Attendance,
     AttendanceAttempt,
@@ -66,6 +98,22 @@ csrf = CSRFProtect(app)
 db.init_app(app)
 limiter = Limiter(key_func=get_remote_address, app=app, default_limits=["500 per day", "150 per hour"])
 init_firebase(app)
+session_contexts.ttl_seconds = app.config.get("SESSION_CONTEXT_TTL_SECONDS", 60)
+session_contexts.attach(os.path.join(app.instance_path, "session_contexts.generation"))
+live_session_registry.ttl_seconds = app.config.get("LIVE_SESSION_REGISTRY_TTL_SECONDS", 60)
+live_session_registry.enrollment_ttl_seconds = app.config.get("STUDENT_ENROLLMENT_CACHE_SECONDS", 300)
+live_session_registry.attach(os.path.join(app.instance_path, "live_sessions.generation"))
+session_counters.attach(os.path.join(app.instance_path, "session_counters.generation"))
+low_attendance_cache.ttl_seconds = app.config.get("LOW_ATTENDANCE_CACHE_SECONDS", 30)
+if app.config.get("FACE_GALLERY_FLOAT16"):
+    face_gallery.set_storage_dtype(np.float16)
+if app.config.get("FACE_SHARED_STORE_ENABLED"):
+    face_gallery.attach_store(
+        SharedFaceStore(app.config["FACE_SHARED_STORE_DIR"], app.config["FACE_SHARED_STORE_COMPACT_EVERY"])
+    )
+else:
+    # Each worker keeps a private gallery; the generation file tells it when another worker wrote.
+    face_gallery.attach_generations(GenerationFile(os.path.join(app.instance_path, "face_gallery.generation")))
 
 login_manager = LoginManager()
 login_manager.login_view = "login"
@@ -308,6 +356,7 @@ def record_attempt(session_id, student_id, success, reason, lat=None, lng=None,
         user_agent=user_agent,
     )
     db.session.add(attempt)
+    stage_attempt(db.session, session_id)
     sync_attendance_attempt(
         app,
         {
@@ -326,24 +375,111 @@ def record_attempt(session_id, student_id, success, reason, lat=None, lng=None,
     )
 
 
+MarkState = namedtuple("MarkState", "session enrolled")
+
+
+def load_mark_state(session_id, student_id):
+    """
+    The session a self-service mark targets and whether the student is enrolled in its
+    course, in one joined query; ``None`` if the session does not exist.
+    """
+    row = (
+        db.session.query(ClassSession, Enrollment.id)
+        .outerjoin(
+            Enrollment,
+            and_(Enrollment.course_id == ClassSession.course_id, Enrollment.student_id == student_id),
+        )
+        .filter(ClassSession.id == session_id)
+        .first()
+    )
+    if row is None:
+        return None
+    session, enrollment_id = row
+    return MarkState(session, enrollment_id is not None)
+
+
+def insert_session_marks(marks, local_now):
+    """
+    Inserts ``SessionAttendance`` rows (dicts with the same keys) with ``ON CONFLICT DO
+    NOTHING``, plus the daily record of every newly marked student, and returns the new
+    marks as transient entries. Students already marked are left out, so a retried or
+    concurrent mark is a no-op rather than a unique-constraint error.
+    """
+    inserted = insert_missing(db.session, SessionAttendance, marks, ("session_id", "student_id"))
+    entries = [SessionAttendance(**mark) for mark in marks if (mark["session_id"], mark["student_id"]) in inserted]
+    if entries:
+        # So "My Daily Attendance Records" on the student dashboard reflects the mark.
+        insert_missing(
+            db.session,
+            Attendance,
+            [
+                {
+                    "user_id": entry.student_id,
+                    "date": local_now.date(),
+                    "time": local_now.time().replace(microsecond=0),
+                    "status": "present",
+                    "latitude": entry.latitude,
+                    "longitude": entry.longitude,
+                }
+                for entry in entries
+            ],
+            ("user_id", "date"),
+        )
+    return entries
+
+
 def student_active_sessions(student_id):
-    now = now_utc_naive()
-    course_ids = [
-        row[0]
-        for row in db.session.query(Enrollment.course_id).filter(Enrollment.student_id == student_id).all()
-    ]
-    if not course_ids:
-        return []
+    """The student's live sessions from the in-memory registry, soonest ending first."""
+    return live_session_registry.sessions_for_student(student_id, now_utc_naive())
+
+
+def registered_face_rows():
+    """Yield (user_id, face_template) for registered faces without loading full User rows."""
     return (
-        ClassSession.query.filter(
-            ClassSession.course_id.in_(course_ids),
-            ClassSession.is_active.is_(True),
-            ClassSession.starts_at <= now,
-            ClassSession.ends_at >= now,
-        )
-        .order_by(ClassSession.ends_at.asc())
-        .all()
+        db.session.query(User.id, User.face_template)
+        .filter(User.face_registered.is_(True), User.face_template.isnot(None))
+        .yield_per(1000)
+    )
+
+
+def ensure_face_gallery():
+    # Returns at once unless the gallery is unloaded or another worker changed face data.
+    face_gallery.ensure_loaded(registered_face_rows)
+    if app.config.get("FACE_ANN_ENABLED") and face_gallery.index is None:
+        index = IVFIndex.load(app.config["FACE_ANN_INDEX_PATH"])
+        if index is not None:
+            face_gallery.attach_index(
+                index,
+                nprobe=app.config["FACE_ANN_NPROBE"],
+                min_size=app.config["FACE_ANN_MIN_GALLERY"],
+            )
+    return face_gallery
+
+
+def recent_attendance_matrix(user_ids, recent_dates, user_filter=None):
+    """
+    Build ``{user_id: {iso_date: "hh:mm AM" | None}}`` for ``recent_dates`` plus today's count.
+
+    One range query over Attendance (optionally narrowed by ``user_filter``) pivoted in
+    memory, instead of one lookup per user per day.
+    """
+    today = today_local_date()
+    date_keys = [date.isoformat() for date in recent_dates]
+    attendance_map = {user_id: dict.fromkeys(date_keys) for user_id in user_ids}
+    query = db.session.query(Attendance.user_id, Attendance.date, Attendance.time).filter(
+        Attendance.date >= recent_dates[0], Attendance.date <= recent_dates[-1]
     )
+    if user_filter is not None:
+        query = query.filter(user_filter)
+    today_count = 0
+    for user_id, date, marked_at in query:
+        row = attendance_map.get(user_id)
+        if row is None:
+            continue
+        row[date.isoformat()] = marked_at.strftime("%I:%M %p")
+        if date == today:
+            today_count += 1
+    return attendance_map, today_count
 
 
 def teacher_students_query(teacher_id):
@@ -469,6 +605,80 @@ def build_session_roster(session):
     }
 
 
+def session_roster_counts(session_ids):
+    """
+    Return ``{session_id: {"enrolled", "marked", "failed", "pending"}}`` for many sessions.
+
+    Same numbers as ``build_session_roster(...)["counts"]`` from four grouped queries,
+    without loading any rows; the full roster is only built for the detail page.
+    """
+    session_ids = list(session_ids)
+    counts = {
+        session_id: {"enrolled": 0, "marked": 0, "failed": 0, "pending": 0}
+        for session_id in session_ids
+    }
+    if not session_ids:
+        return counts
+
+    enrolled_students = (
+        db.session.query(ClassSession.id, User.id)
+        .join(Enrollment, Enrollment.course_id == ClassSession.course_id)
+        .join(User, User.id == Enrollment.student_id)
+        .filter(ClassSession.id.in_(session_ids), User.role == "student")
+    )
+    marked = db.session.query(SessionAttendance.id).filter(
+        SessionAttendance.session_id == ClassSession.id,
+        SessionAttendance.student_id == User.id,
+    )
+    failed = db.session.query(AttendanceAttempt.id).filter(
+        AttendanceAttempt.session_id == ClassSession.id,
+        AttendanceAttempt.student_id == User.id,
+        AttendanceAttempt.success.is_(False),
+    )
+
+    for session_id, total in (
+        enrolled_students.with_entities(ClassSession.id, func.count(User.id)).group_by(ClassSession.id)
+    ):
+        counts[session_id]["enrolled"] = total
+
+    for session_id, total in (
+        enrolled_students.with_entities(ClassSession.id, func.count(User.id))
+        .filter(~marked.exists(), ~failed.exists())
+        .group_by(ClassSession.id)
+    ):
+        counts[session_id]["pending"] = total
+
+    for session_id, total in (
+        db.session.query(SessionAttendance.session_id, func.count(SessionAttendance.id))
+        .join(User, User.id == SessionAttendance.student_id)
+        .filter(SessionAttendance.session_id.in_(session_ids))
+        .group_by(SessionAttendance.session_id)
+    ):
+        counts[session_id]["marked"] = total
+
+    # Failed students who were never marked, plus each attempt with no student attached.
+    already_marked = db.session.query(SessionAttendance.id).filter(
+        SessionAttendance.session_id == AttendanceAttempt.session_id,
+        SessionAttendance.student_id == AttendanceAttempt.student_id,
+    )
+    for session_id, students, anonymous in (
+        db.session.query(
+            AttendanceAttempt.session_id,
+            func.count(AttendanceAttempt.student_id.distinct()),
+            func.sum(case((AttendanceAttempt.student_id.is_(None), 1), else_=0)),
+        )
+        .filter(
+            AttendanceAttempt.session_id.in_(session_ids),
+            AttendanceAttempt.success.is_(False),
+            ~already_marked.exists(),
+        )
+        .group_by(AttendanceAttempt.session_id)
+    ):
+        counts[session_id]["failed"] = students + (anonymous or 0)
+
+    return counts
+
+
 def ensure_schema_compatibility():
     try:
         db.create_all()
@@ -519,6 +729,10 @@ def ensure_schema_compatibility():
             conn.execute(text("ALTER TABLE users ADD COLUMN is_active BOOLEAN DEFAULT 1"))
         if "last_login" not in users_columns:
             conn.execute(text("ALTER TABLE users ADD COLUMN last_login DATETIME"))
+        if "face_template" not in users_columns:
+            conn.execute(text("ALTER TABLE users ADD COLUMN face_template BLOB"))
+        if "face_template_version" not in users_columns:
+            conn.execute(text("ALTER TABLE users ADD COLUMN face_template_version SMALLINT"))
 
         # Attendance table updates
         attendance_columns = _columns(conn, "attendance")
@@ -536,6 +750,61 @@ def ensure_schema_compatibility():
         enrollment_columns = _columns(conn, "enrollments")
         if "is_active" not in enrollment_columns:
             conn.execute(text("ALTER TABLE enrollments ADD COLUMN is_active BOOLEAN DEFAULT 1"))
+        counters_missing = "sessions_attended" not in enrollment_columns
+        if counters_missing:
+            conn.execute(text("ALTER TABLE enrollments ADD COLUMN sessions_attended INTEGER NOT NULL DEFAULT 0"))
+            conn.execute(text("ALTER TABLE enrollments ADD COLUMN sessions_eligible INTEGER NOT NULL DEFAULT 0"))
+        if "is_counted" not in class_session_columns:
+            conn.execute(text("ALTER TABLE class_sessions ADD COLUMN is_counted BOOLEAN NOT NULL DEFAULT 0"))
+            counters_missing = True
+
+    if counters_missing:
+        rebuilt = rebuild_attendance_counters()
+        db.session.commit()
+        app.logger.info("Attendance counters built for %d enrollments", rebuilt)
+
+    migrate_legacy_face_encodings()
+
+
+def migrate_legacy_face_encodings(batch_size=500):
+    """Convert JSON face encodings into binary float32 templates, one short transaction per batch."""
+    converted = 0
+    last_id = 0
+    while True:
+        with db.engine.begin() as conn:
+            rows = conn.execute(
+                text(
+                    "SELECT id, face_encoding FROM users "
+                    "WHERE face_encoding IS NOT NULL AND face_template IS NULL AND id > :last_id "
+                    "ORDER BY id LIMIT :limit"
+                ),
+                {"last_id": last_id, "limit": batch_size},
+            ).all()
+            if not rows:
+                break
+            updates = []
+            for user_id, encoding in rows:
+                last_id = user_id
+                vector = to_face_vector(encoding)
+                if vector is None:
+                    app.logger.warning("Skipping unreadable legacy face encoding for user_id=%s", user_id)
+                    continue
+                updates.append(
+                    {"id": user_id, "template": encode_template(vector), "version": FACE_TEMPLATE_VERSION}
+                )
+            if updates:
+                conn.execute(
+                    text(
+                        "UPDATE users SET face_template = :template, face_template_version = :version, "
+                        "face_encoding = NULL WHERE id = :id"
+                    ),
+                    updates,
+                )
+                converted += len(updates)
+    if converted:
+        app.logger.info("Converted %d legacy face encodings to binary templates.", converted)
+
+
 @app.after_request
 def add_header(response):
     """Add security headers and cache control to all responses."""
@@ -558,23 +827,60 @@ def add_header(response):
     return response
 
 
-@app.before_request
-def auto_close_expired_sessions():
-    """Silently close any ClassSession whose ends_at has passed but is still marked active."""
-    try:
-        now = now_utc_naive()
-        expired = ClassSession.query.filter(
-            ClassSession.is_active.is_(True),
-            ClassSession.ends_at < now,
-        ).all()
+def expire_due_sessions(now=None):
+    """
+    Close sessions whose ends_at has passed and count sessions that have started.
+
+    Live sessions that have just started also get their matching context built, so
+    the first marks find it cached. Runs on the session expiry thread at each
+    deadline, never inside a request.
+    """
+    with app.app_context():
+        now = now or now_utc_naive()
+        try:
+            # Every worker runs this sweep at the same deadlines; the lock lets one close
+            # each session, and the others then find nothing left to close or count.
+            with file_lock(os.path.join(app.instance_path, "session_expiry.lock")):
+                expired = ClassSession.query.filter(
+                    ClassSession.is_active.is_(True),
+                    ClassSession.ends_at <= now,
+                ).all()
+                # Not yet counted means the start deadline is being handled right now.
+                started = ClassSession.query.filter(
+                    ClassSession.is_active.is_(True),
+                    ClassSession.is_counted.is_(False),
+                    ClassSession.starts_at <= now,
+                    ClassSession.ends_at > now,
+                ).all()
+                for s in expired:
+                    s.is_active = False
+                    update_session_status(app, s.id, False)
+                counted = count_started_sessions(now)
+                if expired or counted:
+                    db.session.commit()
+        except Exception:
+            db.session.rollback()
+            app.logger.exception("Expired session sweep failed")
+            return
+        for s in expired:
+            session_contexts.evict(s.id)
+        for s in started:
+            session_contexts.warm(s, app.config["SESSION_LOCATION_RADIUS_METERS"])
         if expired:
-            for s in expired:
-                s.is_active = False
-                # Sync each session status to Firebase
-                update_session_status(app, s.id, False)
-            db.session.commit()
-    except Exception:
-        db.session.rollback()
+            live_session_registry.remove(s.id for s in expired)
+            session_counters.changed()
+            app.logger.info("Auto-closed %d expired sessions", len(expired))
+
+
+def schedule_pending_session_deadlines():
+    """Queue the deadlines of every session still to start counting or to close."""
+    pending = ClassSession.query.filter(
+        (ClassSession.is_active.is_(True)) | (ClassSession.is_counted.is_(False))
+    ).all()
+    for pending_session in pending:
+        session_expiry.schedule_session(pending_session)
+    return len(pending)
+
 
 @app.context_processor
 def inject_geo_vars():
@@ -603,8 +909,83 @@ def about():
     return render_template("about_us.html")
 
 
+@app.route("/api/health")
+@limiter.exempt
+def api_health():
+    """Readiness probe: 503 until the background Firebase hydration has finished."""
+    ready = hydration_ready(app)
+    return jsonify({
+        "success": ready,
+        "message": "ready" if ready else "Hydrating reference data from Firebase",
+        "firebase_enabled": app.extensions.get("firebase_enabled", False),
+    }), (200 if ready else 503)
+
+
 # ── Live Classroom Kiosk Mode ─────────────────────────────────────────────────
 
+KIOSK_USER_AGENT = "Kiosk-AssistedVerify/2.0"
+
+
+def live_session_context(session):
+    """Returns the cached matching/validation context of a live session, building it if needed."""
+    return session_contexts.get(
+        session.id,
+        lambda: build_session_context(session, app.config["SESSION_LOCATION_RADIUS_METERS"]),
+    )
+
+
+def record_kiosk_attendance(session, student, face_distance, note):
+    """Adds the session and daily attendance rows for a kiosk scan and commits them; ``None`` if already marked."""
+    entries = record_kiosk_attendance_batch(session, [(student, face_distance)], note)
+    return entries[0] if entries else None
+
+
+def record_kiosk_attendance_batch(session, matches, note):
+    """
+    Adds attendance rows and their Firebase outbox writes for several ``(student, face_distance)``
+    kiosk matches in one transaction. Students marked meanwhile are skipped; returns the new entries.
+    """
+    ip_address = (request.headers.get("X-Forwarded-For", request.remote_addr) or "").split(",")[0].strip()[:64]
+    marked_at = now_utc_naive()
+    students = {student.id: student for student, _ in matches}
+    entries = insert_session_marks(
+        [
+            {
+                "session_id": session.id,
+                "student_id": student.id,
+                "marked_at": marked_at,
+                "latitude": session.location_lat,
+                "longitude": session.location_lng,
+                "face_distance": face_distance,
+                "device_hash": None,
+                "ip_address": ip_address,
+                "user_agent": KIOSK_USER_AGENT,
+            }
+            for student, face_distance in matches
+        ],
+        now_local(),
+    )
+    for entry in entries:
+        record_attempt(
+            session.id, entry.student_id, True, note,
+            session.location_lat, session.location_lng, entry.face_distance,
+            None, ip_address, KIOSK_USER_AGENT
+        )
+        sync_session_attendance(app, entry, session, students[entry.student_id])
+    record_session_marks(session, [entry.student_id for entry in entries])
+    db.session.commit()
+    return entries
+
+
+def notify_kiosk_attendance(session, student):
+    """Non-blocking email notification for a kiosk mark."""
+    threading.Thread(
+        target=send_attendance_email,
+        args=(app, student.name, student.email, session.course_code, session.title, datetime.now(timezone.utc)),
+        daemon=True,
+    ).start()
+
+
 @app.route("/kiosk/<int:session_id>")
 @login_required
 def kiosk(session_id):
@@ -625,8 +1006,10 @@ def kiosk_data(session_id):
 
     session = ClassSession.query.filter_by(id=session_id, teacher_id=current_user.id).first_or_404()
 
+    # Only a has-template flag is selected; the deferred templates themselves stay in the database.
     enrolled_students = (
-        User.query.join(Enrollment, Enrollment.student_id == User.id)
+        db.session.query(User, User.face_template.isnot(None))
+        .join(Enrollment, Enrollment.student_id == User.id)
         .filter(
             Enrollment.course_id == session.course_id,
             User.role == "student",
@@ -641,13 +1024,13 @@ def kiosk_data(session_id):
     }
 
     students_data = []
-    for student in enrolled_students:
+    for student, has_template in enrolled_students:
         students_data.append({
             "id": student.id,
             "name": student.name,
             "college_id": student.college_id or "",
             "already_marked": student.id in marked_ids,
-            "face_ready": bool(student.face_registered and student.face_encoding),
+            "face_ready": bool(student.face_registered and has_template),
         })
 
     now = now_utc_naive()
@@ -694,88 +1077,159 @@ def kiosk_mark():
     if not student:
         return jsonify({"success": False, "message": "Student not found."}), 404
 
-    enrollment = Enrollment.query.filter_by(course_id=session.course_id, student_id=student.id).first()
-    if not enrollment:
+    context = live_session_context(session)
+    if not context.is_enrolled(student.id):
         return jsonify({"success": False, "message": "Student is not enrolled for this course."}), 403
 
-    if not student.face_registered or not student.face_encoding:
-        return jsonify({"success": False, "message": "Student has not completed face registration."}), 400
-
     # Prevent duplicate marking
-    already_marked = SessionAttendance.query.filter_by(session_id=session_id, student_id=student_id).first()
-    if already_marked:
+    if context.is_marked(student.id):
         return jsonify({"success": False, "already_marked": True, "message": f"{student.name} already marked."})
 
-    if not isinstance(descriptor, list) or len(descriptor) != 128:
+    known_templates = context.templates_for(student.id) if student.face_registered else None
+    if known_templates is None:
+        # Registered after the context was built (or not at all); read the templates directly.
+        if not student.face_registered or not student.face_template:
+            return jsonify({"success": False, "message": "Student has not completed face registration."}), 400
+        known_templates = student.get_face_templates()
+        if known_templates is None:
+            app.logger.error("Corrupt kiosk face template for student_id=%s", student.id)
+            return jsonify({"success": False, "message": "Stored face data is unavailable for this student."}), 500
+
+    normalized_descriptor = parse_descriptor(descriptor)
+    if normalized_descriptor is None:
         return jsonify({"success": False, "message": "A valid face scan is required."}), 400
 
-    try:
-        normalized_descriptor = [float(v) for v in descriptor]
-    except (TypeError, ValueError):
-        return jsonify({"success": False, "message": "Face scan contained invalid values."}), 400
-
-    if any(not isfinite(v) for v in normalized_descriptor):
-        return jsonify({"success": False, "message": "Face scan contained invalid values."}), 400
-
-    try:
-        known_encoding = np.array(json.loads(student.face_encoding), dtype=float)
-    except Exception:
-        app.logger.exception("Corrupt kiosk face encoding for student_id=%s", student.id)
-        return jsonify({"success": False, "message": "Stored face data is unavailable for this student."}), 500
-
-    unknown_encoding = np.array(normalized_descriptor, dtype=float)
-    face_distance = float(np.linalg.norm(known_encoding - unknown_encoding))
+    # Cached rows carry precomputed norms; fall back for faces registered after the build.
+    face_distance = context.distance_to(student.id, normalized_descriptor) if student.face_registered else None
+    if face_distance is None:
+        face_distance = min_distance(known_templates, normalized_descriptor)
     
     FACE_THRESHOLD = app.config.get('FACE_RECOGNITION_THRESHOLD', 0.45)
     
     if face_distance >= FACE_THRESHOLD:
         return jsonify({"success": False, "message": "Face verification failed for the selected student."}), 400
 
-    ip_address = (request.headers.get("X-Forwarded-For", request.remote_addr) or "").split(",")[0].strip()[:64]
+    entry = record_kiosk_attendance(session, student, face_distance, "Kiosk assisted verification")
+    context.add_marked([student.id])
+    if entry is None:
+        return jsonify({"success": False, "already_marked": True, "message": f"{student.name} already marked."})
+    notify_kiosk_attendance(session, student)
 
-    entry = SessionAttendance(
-        session_id=session.id,
-        student_id=student_id,
-        latitude=session.location_lat,
-        longitude=session.location_lng,
-        face_distance=face_distance,
-        ip_address=ip_address,
-        user_agent="Kiosk-AssistedVerify/2.0",
-    )
-    db.session.add(entry)
-
-    # Also update the daily attendance record
-    local_now = now_local()
-    today_date = local_now.date()
-    daily_exists = Attendance.query.filter_by(user_id=student_id, date=today_date).first()
-    if not daily_exists:
-        daily_entry = Attendance(
-            user_id=student_id,
-            date=today_date,
-            time=local_now.time().replace(microsecond=0),
-            latitude=session.location_lat,
-            longitude=session.location_lng,
-        )
-        db.session.add(daily_entry)
+    return jsonify({"success": True, "message": f"✅ {student.name} marked present!", "student_name": student.name})
 
-    record_attempt(
-        session.id, student_id, True, "Kiosk assisted verification",
-        session.location_lat, session.location_lng, face_distance,
-        None, ip_address, "Kiosk-AssistedVerify/2.0"
-    )
-    db.session.commit()
-    
-    # Sync to Firebase
-    sync_session_attendance(app, entry, session, student)
 
-    # Non-blocking email notification
-    threading.Thread(
-        target=send_attendance_email,
-        args=(app, student.name, student.email, session.course_code, session.title, datetime.now(timezone.utc)),
-        daemon=True,
-    ).start()
+@app.route("/api/kiosk_mark_batch", methods=["POST"])
+@login_required
+@limiter.limit("300 per minute")
+def kiosk_mark_batch():
+    """Identifies every face in a kiosk frame (or short burst) and marks the matches in one transaction."""
+    if current_user.role not in ("teacher", "admin"):
+        return jsonify({"success": False, "message": "Unauthorized"}), 403
 
-    return jsonify({"success": True, "message": f"✅ {student.name} marked present!", "student_name": student.name})
+    data = request.json or {}
+    session_id = data.get("session_id")
+    descriptors = data.get("descriptors")
+    if not session_id:
+        return jsonify({"success": False, "message": "Missing session ID."}), 400
+    if not isinstance(descriptors, list) or not descriptors:
+        return jsonify({"success": False, "message": "At least one face scan is required."}), 400
+    max_faces = app.config.get("KIOSK_BATCH_MAX_FACES", 16)
+    if len(descriptors) > max_faces:
+        return jsonify({"success": False, "message": f"At most {max_faces} faces can be marked at once."}), 400
+
+    session = ClassSession.query.filter_by(id=session_id, teacher_id=current_user.id).first()
+    if not session:
+        return jsonify({"success": False, "message": "Session not found."}), 404
+
+    now = now_utc_naive()
+    if not (session.is_active and session.starts_at <= now <= session.ends_at):
+        return jsonify({"success": False, "message": "Session is no longer active."}), 400
+
+    results = [None] * len(descriptors)
+    positions = []
+    vectors = []
+    for position, descriptor in enumerate(descriptors):
+        vector = parse_descriptor(descriptor)
+        if vector is None:
+            results[position] = {"index": position, "success": False, "matched": False, "message": "Invalid face scan."}
+            continue
+        positions.append(position)
+        vectors.append(vector)
+
+    matched = {}  # position -> (student_id, face_distance)
+    if vectors:
+        context = live_session_context(session)
+        student_ids, distances = context.nearest_many(np.stack(vectors))
+        FACE_THRESHOLD = app.config.get('FACE_RECOGNITION_THRESHOLD', 0.45)
+        for position, student_id, face_distance in zip(positions, student_ids.tolist(), distances.tolist()):
+            if student_id < 0 or face_distance >= FACE_THRESHOLD:
+                results[position] = {
+                    "index": position,
+                    "success": False,
+                    "matched": False,
+                    "message": "Face not recognised for this class.",
+                }
+            else:
+                matched[position] = (student_id, face_distance)
+
+    students = {}
+    already_marked = set()
+    if matched:
+        matched_ids = {student_id for student_id, _ in matched.values()}
+        students = {student.id: student for student in User.query.filter(User.id.in_(matched_ids)).all()}
+        already_marked = {student_id for student_id in matched_ids if context.is_marked(student_id)}
+
+    # A student seen in several faces of a burst is marked once, with their closest scan.
+    best_scan = {}
+    for position, (student_id, face_distance) in matched.items():
+        if student_id in students and student_id not in already_marked:
+            if student_id not in best_scan or face_distance < best_scan[student_id]:
+                best_scan[student_id] = face_distance
+
+    entries = []
+    if best_scan:
+        entries = record_kiosk_attendance_batch(
+            session,
+            [(students[student_id], face_distance) for student_id, face_distance in best_scan.items()],
+            "Kiosk batch identification",
+        )
+        context.add_marked(best_scan)
+    newly_marked = {entry.student_id for entry in entries}
+
+    for position, (student_id, face_distance) in matched.items():
+        student = students.get(student_id)
+        if student is None:
+            results[position] = {
+                "index": position,
+                "success": False,
+                "matched": False,
+                "message": "Face not recognised for this class.",
+            }
+        elif student_id in newly_marked:
+            results[position] = {
+                "index": position,
+                "success": True,
+                "matched": True,
+                "student_id": student.id,
+                "student_name": student.name,
+                "face_distance": round(face_distance, 4),
+                "message": f"✅ {student.name} marked present!",
+            }
+        else:
+            results[position] = {
+                "index": position,
+                "success": False,
+                "matched": True,
+                "already_marked": True,
+                "student_id": student.id,
+                "student_name": student.name,
+                "message": f"{student.name} already marked.",
+            }
+
+    for entry in entries:
+        notify_kiosk_attendance(session, students[entry.student_id])
+
+    return jsonify({"success": True, "marked": len(entries), "results": results})
 
 # ─────────────────────────────────────────────────────────────────────────────
 
@@ -866,6 +1320,8 @@ def register():
                 password_hash=generate_password_hash(password, method="scrypt"),
             )
             db.session.add(new_user)
+            # Sync user data to Firebase Realtime Database (sent after the commit)
+            sync_user_registration(app, new_user)
             db.session.commit()
             
             # Create Firebase Authentication user
@@ -875,9 +1331,6 @@ def register():
             else:
                 app.logger.warning(f"Firebase Auth user creation failed: {email}")
             
-            # Sync user data to Firebase Realtime Database
-            sync_user_registration(app, new_user)
-            
             app.logger.info("New user registered: email=%s, role=%s", email, role)
         except Exception as e:
             db.session.rollback()
@@ -895,10 +1348,13 @@ def register():
 @app.route("/register_face")
 @login_required
 def register_face():
-    if current_user.face_registered:
+    append_mode = request.args.get("mode") == "add"
+    if current_user.face_registered and not append_mode:
         flash("Face registration is already complete.", "info")
         return redirect(url_for("dashboard"))
-    return render_template("register_face.html")
+    if append_mode and not current_user.face_registered:
+        return redirect(url_for("register_face"))
+    return render_template("register_face.html", append_mode=append_mode)
 
 
 @app.route("/save_face", methods=["POST"])
@@ -906,12 +1362,13 @@ def register_face():
 @limiter.limit("100 per hour")
 def save_face():
     """
-    Save a user's facial encoding (128-dimensional vector).
+    Save a user's face templates (one or more 128-dimensional vectors).
     
     This function:
-    1. Validates the face descriptor format and values
-    2. Checks for duplicate faces across all users (prevents multi-account abuse)
-    3. Stores the face encoding in the database
+    1. Validates the face descriptors' format and values
+    2. Checks the samples belong to one person (and, with ``mode="append"``, to this user)
+    3. Checks for duplicate faces across all users (prevents multi-account abuse)
+    4. Stores the templates in the database, replacing or extending the existing ones
     
     Returns:
         - 200 with success if face saved
@@ -919,87 +1376,92 @@ def save_face():
         - 409 if duplicate face detected
         - 500 if database save fails
     """
-    # This function saves user's face encoding after registration
-    # Face data is stored as a 128-dimension vector
+    # This function saves user's face templates after registration
+    # Each template is a 128-dimension vector; a burst may hold up to MAX_FACE_TEMPLATES
     # It also checks for duplicate faces across ALL users (any role)
     data = request.json or {}
-    descriptor = data.get("descriptor")
+    descriptors = data.get("descriptors")
+    if descriptors is None and data.get("descriptor"):
+        descriptors = [data.get("descriptor")]
+    append = data.get("mode") == "append"
 
-    if not descriptor:
+    if not descriptors:
         return jsonify({"success": False, "message": "No face data received"})
-    if not isinstance(descriptor, list):
+    if not isinstance(descriptors, list):
         return jsonify({"success": False, "message": "Invalid face data format."}), 400
-    if len(descriptor) != 128:
-        return jsonify({"success": False, "message": "Invalid face data size. Please scan again."}), 400
+    if len(descriptors) > MAX_FACE_TEMPLATES:
+        return jsonify({
+            "success": False,
+            "message": f"At most {MAX_FACE_TEMPLATES} face samples can be saved at once.",
+        }), 400
+    vectors = [parse_descriptor(d) for d in descriptors]
+    if any(vector is None for vector in vectors):
+        return jsonify({"success": False, "message": "Invalid face data. Please scan again."}), 400
+    new_templates = np.stack(vectors)
 
-    try:
-        normalized_descriptor = [float(v) for v in descriptor]
-    except (TypeError, ValueError):
-        return jsonify({"success": False, "message": "Face data contains invalid values."}), 400
+    FACE_DUPLICATE_THRESHOLD = app.config.get('FACE_DUPLICATE_THRESHOLD', 0.50)
 
-    if any(not isfinite(v) for v in normalized_descriptor):
-        return jsonify({"success": False, "message": "Face data contains invalid values."}), 400
+    # Every sample of one burst must be the same person.
+    if float(distances_to(new_templates, new_templates[0]).max()) >= FACE_DUPLICATE_THRESHOLD:
+        return jsonify({
+            "success": False,
+            "message": "Face samples did not match each other. Keep only your face in view and scan again.",
+        }), 400
 
-    # ── Duplicate face check across ALL existing users (vectorized) ──────────────
-    # Batch-compare new face against all registered faces using numpy,
-    # preventing one person creating multiple accounts (student/teacher).
-    new_vec = np.array(normalized_descriptor)
-    FACE_DUPLICATE_THRESHOLD = app.config.get('FACE_DUPLICATE_THRESHOLD', 0.50)
-    existing_users = User.query.filter(
-        User.face_registered.is_(True),
-        User.face_encoding.isnot(None),
-        User.id != current_user.id,
-    ).all()
+    # Re-enrollment may only add samples of the face already registered to this account.
+    if append:
+        existing = current_user.get_face_templates() if current_user.face_registered else None
+        if existing is None:
+            return jsonify({"success": False, "message": "Register your face before adding more samples."}), 400
+        best = min(min_distance(existing, template) for template in new_templates)
+        if best >= FACE_DUPLICATE_THRESHOLD:
+            app.logger.warning(
+                "Rejected face re-enrollment: user_id=%s (distance=%.4f)", current_user.id, best,
+            )
+            return jsonify({"success": False, "message": "This face does not match your registered face."}), 400
 
-    if existing_users:
-        try:
-            all_encodings = []
-            valid_users = []
-            for u in existing_users:
-                try:
-                    enc = json.loads(u.face_encoding)
-                    if isinstance(enc, list) and len(enc) == 128:
-                        all_encodings.append(enc)
-                        valid_users.append(u)
-                except Exception:
-                    continue  # skip corrupted encodings
-
-            if all_encodings:
-                enc_matrix = np.array(all_encodings)           # shape (N, 128)
-                distances = np.linalg.norm(enc_matrix - new_vec, axis=1)  # shape (N,)
-                min_idx = int(np.argmin(distances))
-                if distances[min_idx] < FACE_DUPLICATE_THRESHOLD:
-                    match_user = valid_users[min_idx]
-                    app.logger.warning(
-                        "Duplicate face attempt: user_id=%s vs existing user_id=%s (distance=%.4f)",
-                        current_user.id, match_user.id, distances[min_idx],
-                    )
-                    role_label = match_user.role.capitalize()
-                    return jsonify({
-                        "success": False,
-                        "message": (
-                            f"⚠ This face is already registered to another {role_label} account. "
-                            "Each person can only have one account across all roles."
-                        ),
-                    }), 409
-        except Exception:
-            app.logger.exception("Face duplicate vectorized check failed for user_id=%s", current_user.id)
+    # ── Duplicate face check across ALL existing users (vectorized) ──────────────
+    # Compare every new template against the in-memory gallery of registered faces in one
+    # vectorized pass each, preventing one person creating multiple accounts (student/teacher).
+    try:
+        gallery = ensure_face_gallery()
+        for template in new_templates:
+            match_id, match_distance = gallery.nearest(template, exclude_id=current_user.id)
+            if match_id is not None and match_distance < FACE_DUPLICATE_THRESHOLD:
+                match_user = db.session.get(User, match_id)
+                app.logger.warning(
+                    "Duplicate face attempt: user_id=%s vs existing user_id=%s (distance=%.4f)",
+                    current_user.id, match_id, match_distance,
+                )
+                role_label = match_user.role.capitalize() if match_user else "User"
+                return jsonify({
+                    "success": False,
+                    "message": (
+                        f"⚠ This face is already registered to another {role_label} account. "
+                        "Each person can only have one account across all roles."
+                    ),
+                }), 409
+    except Exception:
+        app.logger.exception("Face duplicate vectorized check failed for user_id=%s", current_user.id)
     # ──────────────────────────────────────────────────────────────────────────────
 
     try:
-        current_user.face_encoding = json.dumps(normalized_descriptor)
+        if append:
+            current_user.add_face_templates(new_templates)
+        else:
+            current_user.set_face_templates(new_templates)
         current_user.face_registered = True
-        db.session.commit()
-        
-        # Sync to Firebase
         sync_user_registration(app, current_user)
+        db.session.commit()
+        face_gallery.upsert(current_user.id, current_user.face_template)
+        session_contexts.evict_student(current_user.id)
         
     except Exception:
         db.session.rollback()
         app.logger.exception("Failed saving face descriptor for user_id=%s", current_user.id)
         return jsonify({"success": False, "message": "Unable to save face data right now. Please try again."}), 500
 
-    return jsonify({"success": True})
+    return jsonify({"success": True, "templates": current_user.get_face_templates().shape[0]})
 
 
 @app.route("/mark_attendance", methods=["GET", "POST"])
@@ -1043,10 +1505,11 @@ def mark_attendance():
 
         if not descriptor:
             return jsonify({"success": False, "message": "No face detected!"}), 400
+        descriptor = parse_descriptor(descriptor)
+        if descriptor is None:
+            return jsonify({"success": False, "message": "A valid face scan is required."}), 400
 
-        known_encoding = np.array(json.loads(current_user.face_encoding))
-        unknown_encoding = np.array(descriptor)
-        distance = float(np.linalg.norm(known_encoding - unknown_encoding))
+        distance = min_distance(current_user.get_face_templates(), descriptor)
 
         FACE_THRESHOLD = app.config.get('FACE_RECOGNITION_THRESHOLD', 0.45)
         
@@ -1097,10 +1560,8 @@ def create_course():
 
     course = Course(code=code, title=title, section=section, teacher_id=current_user.id)
     db.session.add(course)
-    db.session.commit()
-    
-    # Sync to Firebase
     sync_course_creation(app, course)
+    db.session.commit()
     
     flash("Course created successfully.", "success")
     return redirect(url_for("dashboard"))
@@ -1127,11 +1588,13 @@ def enroll_student(course_id):
         return redirect(url_for("dashboard"))
 
     enrollment = Enrollment(course_id=course.id, student_id=student.id)
+    seed_enrollment(enrollment)
     db.session.add(enrollment)
-    db.session.commit()
-    
-    # Sync to Firebase
     sync_enrollment(app, enrollment)
+    db.session.commit()
+    live_session_registry.invalidate()
+    session_contexts.evict_course(course.id)
+    session_counters.changed()
     
     flash("Student enrolled successfully.", "success")
     return redirect(url_for("dashboard"))
@@ -1207,10 +1670,14 @@ def create_session():
         location_radius_meters=app.config["SESSION_LOCATION_RADIUS_METERS"],
     )
     db.session.add(new_session)
-    db.session.commit()
-    
-    # Sync to Firebase
+    db.session.flush()
+    ensure_session_counted(new_session)
     sync_session_creation(app, new_session)
+    db.session.commit()
+    session_expiry.schedule_session(new_session)
+    session_contexts.warm(new_session, app.config["SESSION_LOCATION_RADIUS_METERS"])
+    live_session_registry.add(new_session)
+    session_counters.changed()
     
     flash(
         f"Class session created. Students must be within {app.config['SESSION_LOCATION_RADIUS_METERS']} meters of the classroom to mark attendance.",
@@ -1229,10 +1696,12 @@ def close_session(session_id):
     session = ClassSession.query.filter_by(id=session_id, teacher_id=current_user.id).first_or_404()
     session.is_active = False
     session.ends_at = now_utc_naive()
-    db.session.commit()
-    
-    # Sync session status to Firebase
     update_session_status(app, session_id, False)
+    db.session.commit()
+    session_expiry.cancel(session_id)
+    session_contexts.evict(session_id)
+    live_session_registry.remove([session_id])
+    session_counters.changed()
     
     flash("Class session closed.", "info")
     return redirect(url_for("dashboard"))
@@ -1309,80 +1778,73 @@ def mark_session_attendance():
     if current_user.role != "student":
         return jsonify({"success": False, "message": "Only students can use session attendance."}), 403
 
-    if not current_user.face_registered or not current_user.face_encoding:
+    if not current_user.face_registered:
         return jsonify({"success": False, "message": "Face registration is required before marking attendance."}), 400
 
     data = request.json or {}
     session_id = data.get("session_id")
-    descriptor = data.get("descriptor")
     lat = data.get("lat")
     lng = data.get("lng")
     device_hash, ip_address, user_agent = get_request_meta(data)
 
-    if not session_id:
-        record_attempt(None, current_user.id, False, "Missing session id", lat, lng, None, device_hash, ip_address, user_agent)
+    def reject(attempt_session_id, reason, message, status=400, distance=None):
+        # Failed marks write only their attempt row, in one transaction.
+        record_attempt(attempt_session_id, current_user.id, False, reason, lat, lng, distance, device_hash, ip_address, user_agent)
         db.session.commit()
-        return jsonify({"success": False, "message": "Session is required."}), 400
+        return jsonify({"success": False, "message": message}), status
 
+    if not session_id:
+        return reject(None, "Missing session id", "Session is required.")
     try:
         session_id = int(session_id)
-    except ValueError:
-        record_attempt(None, current_user.id, False, "Invalid session id", lat, lng, None, device_hash, ip_address, user_agent)
-        db.session.commit()
-        return jsonify({"success": False, "message": "Session id is invalid."}), 400
+    except (TypeError, ValueError):
+        return reject(None, "Invalid session id", "Session id is invalid.")
 
-    session = ClassSession.query.filter_by(id=session_id).first()
-    if not session:
-        record_attempt(session_id, current_user.id, False, "Session not found", lat, lng, None, device_hash, ip_address, user_agent)
-        db.session.commit()
-        return jsonify({"success": False, "message": "Session not found."}), 400
+    # ── Read: one joined query for the session and the enrollment ───────────
+    state = load_mark_state(session_id, current_user.id)
+    if state is None:
+        return reject(session_id, "Session not found", "Session not found.")
+    session = state.session
 
-    enrolled = Enrollment.query.filter_by(course_id=session.course_id, student_id=current_user.id).first()
-    if not enrolled:
-        record_attempt(session.id, current_user.id, False, "Student not enrolled", lat, lng, None, device_hash, ip_address, user_agent)
-        db.session.commit()
-        return jsonify({"success": False, "message": "You are not enrolled for this course."}), 403
+    # ── Validate in memory ──────────────────────────────────────────────────
+    if not state.enrolled:
+        return reject(session.id, "Student not enrolled", "You are not enrolled for this course.", 403)
 
     now = now_utc_naive()
     if not (session.is_active and session.starts_at <= now <= session.ends_at):
-        record_attempt(session.id, current_user.id, False, "Session inactive", lat, lng, None, device_hash, ip_address, user_agent)
-        db.session.commit()
-        return jsonify({"success": False, "message": "This session is not active now."}), 400
+        return reject(session.id, "Session inactive", "This session is not active now.")
 
-    classroom_status = classroom_geofence_status(session, lat, lng)
+    context = live_session_context(session)
+    classroom_status = classroom_geofence_status(context, lat, lng)
     if not classroom_status["ok"]:
         failure_reason = {
             "missing_location": "Student location unavailable",
             "session_location_missing": "Teacher classroom location missing",
             "outside_classroom_radius": "Outside classroom radius",
         }.get(classroom_status["reason"], "Classroom location check failed")
-        record_attempt(session.id, current_user.id, False, failure_reason, lat, lng, None, device_hash, ip_address, user_agent)
-        db.session.commit()
         if classroom_status["reason"] == "session_location_missing":
-            return jsonify({
-                "success": False,
-                "message": "Teacher classroom location is missing for this session. Ask your teacher to restart the live class from the classroom.",
-            }), 400
-        return jsonify({
-            "success": False,
-            "message": classroom_status["message"] or "Go to the classroom to mark attendance.",
-        }), 400
+            message = "Teacher classroom location is missing for this session. Ask your teacher to restart the live class from the classroom."
+        else:
+            message = classroom_status["message"] or "Go to the classroom to mark attendance."
+        return reject(session.id, failure_reason, message)
 
-    already_marked = SessionAttendance.query.filter_by(session_id=session.id, student_id=current_user.id).first()
-    if already_marked:
-        record_attempt(session.id, current_user.id, False, "Duplicate mark", lat, lng, already_marked.face_distance, device_hash, ip_address, user_agent)
-        db.session.commit()
-        return jsonify({"success": False, "message": "Attendance already marked for this class session."}), 400
+    if context.is_marked(current_user.id):
+        return reject(session.id, "Duplicate mark", "Attendance already marked for this class session.")
 
+    descriptor = data.get("descriptor")
     if not descriptor:
-        record_attempt(session.id, current_user.id, False, "No face descriptor", lat, lng, None, device_hash, ip_address, user_agent)
-        db.session.commit()
-        return jsonify({"success": False, "message": "No face detected!"}), 400
-
-
-    known_encoding = np.array(json.loads(current_user.face_encoding))
-    unknown_encoding = np.array(descriptor)
-    distance = float(np.linalg.norm(known_encoding - unknown_encoding))
+        return reject(session.id, "No face descriptor", "No face detected!")
+    descriptor = parse_descriptor(descriptor)
+    if descriptor is None:
+        return reject(session.id, "Invalid face descriptor", "A valid face scan is required.")
+
+    distance = context.distance_to(current_user.id, descriptor)
+    if distance is None:
+        # Registered after the session context was built.
+        known_templates = current_user.get_face_templates()
+        if known_templates is None:
+            return jsonify({"success": False, "message": "Face registration is required before marking attendance."}), 400
+        distance = min_distance(known_templates, descriptor)
 
     FACE_THRESHOLD = app.config.get('FACE_RECOGNITION_THRESHOLD', 0.45)
     SPOOFING_THRESHOLD = app.config.get('FACE_SPOOFING_THRESHOLD', 0.80)
@@ -1393,117 +1855,68 @@ def mark_session_attendance():
             "🚨 Possible spoofing attempt detected: user_id=%s, session_id=%s, distance=%.4f",
             current_user.id, session.id, distance
         )
-        record_attempt(
-            session.id,
-            current_user.id,
-            False,
-            "Possible spoofing attempt (photo attack)",
-            lat,
-            lng,
-            distance,
-            device_hash,
-            ip_address,
-            user_agent
+        return reject(
+            session.id, "Possible spoofing attempt (photo attack)",
+            "⚠ Spoofing attempt detected! Please use live camera.", distance=distance,
         )
-        db.session.commit()
-        return jsonify({
-            "success": False,
-            "message": "⚠ Spoofing attempt detected! Please use live camera."
-        }), 400
 
     # UNKNOWN PERSON ALERT - Face doesn't match registered face
     if distance >= FACE_THRESHOLD:
-        record_attempt(
-            session.id,
-            current_user.id,
-            False,
-            "Face verification failed - unknown person",
-            lat,
-            lng,
-            distance,
-            device_hash,
-            ip_address,
-            user_agent
-        )
-
-        db.session.commit()
-
         app.logger.warning(
             "⚠ Face verification failed: user_id=%s, session_id=%s, distance=%.4f (threshold=%.2f)",
             current_user.id, session.id, distance, FACE_THRESHOLD
         )
+        return reject(
+            session.id, "Face verification failed - unknown person",
+            f"⚠ Face verification failed! Your face doesn't match the registered face. (Distance: {distance:.2f})",
+            distance=distance,
+        )
 
-        return jsonify({
-            "success": False,
-            "message": f"⚠ Face verification failed! Your face doesn't match the registered face. (Distance: {distance:.2f})"
-        }), 400
-
-
-    # FACE VERIFIED → MARK ATTENDANCE
+    # ── Write: mark, daily record, attempt, counters and outbox in one transaction ──
     app.logger.info(
         "✅ Face verified successfully: user_id=%s, session_id=%s, distance=%.4f",
         current_user.id, session.id, distance
     )
-    entry = SessionAttendance(
-        session_id=session.id,
-        student_id=current_user.id,
-        latitude=lat,
-        longitude=lng,
-        face_distance=distance,
-        device_hash=device_hash,
-        ip_address=ip_address,
-        user_agent=user_agent,
+    # The insert, not a pre-check, decides duplicates: a concurrent retry inserts nothing.
+    entries = insert_session_marks(
+        [{
+            "session_id": session.id,
+            "student_id": current_user.id,
+            "marked_at": now,
+            "latitude": lat,
+            "longitude": lng,
+            "face_distance": distance,
+            "device_hash": device_hash,
+            "ip_address": ip_address,
+            "user_agent": user_agent,
+        }],
+        now_local(),
     )
-
-    db.session.add(entry)
-
-    # ── Also update the Daily Attendance record ───────────────────────────
-    # So "My Daily Attendance Records" on the student dashboard reflects this session.
-    local_now = now_local()
-    today_date = local_now.date()
-    daily_exists = Attendance.query.filter_by(
-        user_id=current_user.id,
-        date=today_date,
-    ).first()
-    if not daily_exists:
-        daily_entry = Attendance(
-            user_id=current_user.id,
-            date=today_date,
-            time=local_now.time().replace(microsecond=0),
-            latitude=lat,
-            longitude=lng,
+    if not entries:
+        context.add_marked([current_user.id])
+        return reject(
+            session.id, "Duplicate mark", "Attendance already marked for this class session.", distance=distance,
         )
-        db.session.add(daily_entry)
-    # ─────────────────────────────────────────────────────────────────────
-
-    record_attempt(
-        session.id,
-        current_user.id,
-        True,
-        "Attendance marked",
-        lat,
-        lng,
-        distance,
-        device_hash,
-        ip_address,
-        user_agent
-    )
-
+    record_attempt(session.id, current_user.id, True, "Attendance marked", lat, lng, distance, device_hash, ip_address, user_agent)
+    record_session_marks(session, [current_user.id])
+    sync_session_attendance(app, entries[0], session, current_user)
+    # Read before the commit expires them, so the response needs no reload queries.
+    student_id, student_name, student_email = current_user.id, current_user.name, current_user.email
+    course_code, course_title = session.course_code, session.title
     db.session.commit()
-
-    sync_session_attendance(app, entry, session, current_user)
+    context.add_marked([student_id])
 
     # ── Email Notification (background thread – non-blocking) ──────────────────
     threading.Thread(
         target=send_attendance_email,
-        args=(app, current_user.name, current_user.email, session.course_code, session.title, datetime.now(timezone.utc)),
+        args=(app, student_name, student_email, course_code, course_title, datetime.now(timezone.utc)),
         daemon=True,
     ).start()
     # ────────────────────────────────────────────────────────────────────────────
 
     return jsonify({
         "success": True,
-        "message": f"Attendance marked for {session.course_code} ({session.title})."
+        "message": f"Attendance marked for {course_code} ({course_title})."
     })
 
 
@@ -1516,11 +1929,11 @@ def reset_face():
         flash("Unauthorised.", "danger")
         return redirect(url_for("dashboard"))
     current_user.face_registered = False
-    current_user.face_encoding = None
-    db.session.commit()
-    
-    # Sync to Firebase
+    current_user.set_face_templates(None)
     sync_user_registration(app, current_user)
+    db.session.commit()
+    face_gallery.remove(current_user.id)
+    session_contexts.evict_student(current_user.id)
     
     flash("Face data cleared. Please re-register your face.", "info")
     return redirect(url_for("register_face"))
@@ -1610,32 +2023,29 @@ def course_attendance_report(course_id):
         flash("Course not found for this teacher.", "warning")
         return redirect(url_for("dashboard"))
 
-    # All sessions ever held for this course
-    all_sessions = ClassSession.query.filter_by(course_id=course.id).all()
-    total_sessions = len(all_sessions)
-    session_ids = [s.id for s in all_sessions]
+    # Sessions held so far for this course
+    total_sessions = ClassSession.query.filter(
+        ClassSession.course_id == course.id,
+        ClassSession.is_counted.is_(True),
+    ).count()
 
-    # All enrolled students
+    # All enrolled students with their maintained attendance counters
     enrollments = (
-        User.query.join(Enrollment, Enrollment.student_id == User.id)
+        db.session.query(User, Enrollment.sessions_attended, Enrollment.sessions_eligible)
+        .join(Enrollment, Enrollment.student_id == User.id)
         .filter(Enrollment.course_id == course.id)
         .order_by(User.name.asc())
         .all()
     )
 
-    # Per-student attendance count
     report = []
     WARNING_THRESHOLD = 75.0
-    for student in enrollments:
-        attended = SessionAttendance.query.filter(
-            SessionAttendance.student_id == student.id,
-            SessionAttendance.session_id.in_(session_ids),
-        ).count() if session_ids else 0
-        pct = round((attended / total_sessions) * 100, 1) if total_sessions > 0 else 0.0
+    for student, attended, eligible in enrollments:
+        pct = attendance_percentage(attended, eligible, digits=1)
         report.append({
             "student": student,
             "attended": attended,
-            "total": total_sessions,
+            "total": eligible,
             "percentage": pct,
             "low": pct < WARNING_THRESHOLD,
         })
@@ -1666,6 +2076,9 @@ def unenroll_student(course_id, student_id):
     if enrollment:
         db.session.delete(enrollment)
         db.session.commit()
+        live_session_registry.invalidate()
+        session_contexts.evict_course(course.id)
+        session_counters.changed()
         flash("Student unenrolled successfully.", "info")
     else:
         flash("Enrollment not found.", "warning")
@@ -1684,6 +2097,9 @@ def delete_course(course_id):
     # Cascade deletes enrollments (defined in model), sessions cascade their attendance
     db.session.delete(course)
     db.session.commit()
+    live_session_registry.invalidate()
+    session_contexts.evict_course(course_id)
+    session_counters.changed()
     flash(f"Course '{course.code} – {course.title}' deleted.", "info")
     return redirect(url_for("dashboard"))
 # ──────────────────────────────────────────────────────────────────────────────
@@ -1735,9 +2151,8 @@ def admin_create_course():
         is_active=True,
     )
     db.session.add(course)
-    db.session.commit()
-
     sync_course_creation(app, course)
+    db.session.commit()
 
     flash(f"Course '{course.code} - {course.title}' created successfully.", "success")
     return redirect(url_for("dashboard"))
@@ -1782,8 +2197,8 @@ def admin_assign_teacher():
         is_active=True,
     )
     db.session.add(assignment)
-    db.session.commit()
     sync_teacher_assignment(app, assignment)
+    db.session.commit()
 
     flash(
         f"Assigned {teacher.name} to {course.code} - {course.title} (Section {section}).",
@@ -1831,10 +2246,13 @@ def admin_enroll_student():
         return redirect(url_for("dashboard"))
 
     enrollment = Enrollment(course_id=course.id, student_id=student.id, is_active=True)
+    seed_enrollment(enrollment)
     db.session.add(enrollment)
-    db.session.commit()
-
     sync_enrollment(app, enrollment)
+    db.session.commit()
+    live_session_registry.invalidate()
+    session_contexts.evict_course(course.id)
+    session_counters.changed()
 
     flash(f"Enrolled {student.name} in {course.code} Section {section}.", "success")
     return redirect(url_for("dashboard"))
@@ -1866,9 +2284,8 @@ def admin_change_student_section(student_id):
     if semester:
         student.semester = semester
     student.assignment_status = "assigned" if student.section and student.year and student.semester else "pending"
-    db.session.commit()
-
     sync_user_registration(app, student)
+    db.session.commit()
 
     flash(f"Updated section details for {student.name}.", "success")
     return redirect(url_for("dashboard"))
@@ -1953,11 +2370,6 @@ def api_admin_dashboard_stats():
     pending_assignments = User.query.filter_by(role="student", assignment_status="pending").count()
     today_attendance = Attendance.query.filter_by(date=today_local_date()).count()
 
-    low_attendance_count = 0
-    for student in User.query.filter_by(role="student").all():
-        if student.get_attendance_percentage() < 75:
-            low_attendance_count += 1
-
     return jsonify(
         {
             "success": True,
@@ -1967,9 +2379,33 @@ def api_admin_dashboard_stats():
             "active_sessions": active_sessions,
             "pending_assignments": pending_assignments,
             "today_attendance": today_attendance,
-            "low_attendance_count": low_attendance_count,
+            "low_attendance_count": low_attendance_count(),
         }
     )
+
+
+def current_face_thresholds():
+    return {
+        "FACE_RECOGNITION_THRESHOLD": app.config.get("FACE_RECOGNITION_THRESHOLD", 0.45),
+        "FACE_DUPLICATE_THRESHOLD": app.config.get("FACE_DUPLICATE_THRESHOLD", 0.50),
+        "FACE_SPOOFING_THRESHOLD": app.config.get("FACE_SPOOFING_THRESHOLD", 0.80),
+    }
+
+
+@app.route("/api/admin/face_calibration")
+@login_required
+def api_admin_face_calibration():
+    """The last FAR/FRR curves and recommended face thresholds saved by the calibration command."""
+    if current_user.role != "admin":
+        return jsonify({"success": False, "message": "Admins only."}), 403
+
+    report = load_calibration_report(app.config["FACE_CALIBRATION_REPORT_PATH"])
+    if report is None:
+        return jsonify({
+            "success": False,
+            "message": "No calibration report yet. Run: flask --app manage calibrate-face-thresholds",
+        }), 404
+    return jsonify({"success": True, **report})
 # ──────────────────────────────────────────────────────────────────────────────
 
 
@@ -2019,11 +2455,8 @@ def admin_edit_user(user_id):
             user.semester = semester
 
         try:
-            db.session.commit()
-            
-            # Sync to Firebase
             sync_user_registration(app, user)
-            
+            db.session.commit()
         except IntegrityError:
             db.session.rollback()
             flash("Unable to update user due to a data conflict.", "danger")
@@ -2085,11 +2518,8 @@ def admin_change_user_role(user_id):
             user.semester = None
 
         try:
-            db.session.commit()
-            
-            # Sync to Firebase
             sync_user_registration(app, user)
-            
+            db.session.commit()
         except IntegrityError:
             db.session.rollback()
             flash("Role change failed due to data conflict.", "danger")
@@ -2122,6 +2552,8 @@ def admin_delete_user(user_id):
     db.session.delete(user)
     try:
         db.session.commit()
+        face_gallery.remove(user_id)
+        session_contexts.evict_student(user_id)
         
         # Delete from Firebase Authentication
         delete_firebase_user(app, user_id)
@@ -2147,11 +2579,11 @@ def admin_clear_face(user_id):
         flash("User not found.", "warning")
         return redirect(url_for("dashboard"))
     user.face_registered = False
-    user.face_encoding = None
-    db.session.commit()
-    
-    # Sync to Firebase
+    user.set_face_templates(None)
     sync_user_registration(app, user)
+    db.session.commit()
+    face_gallery.remove(user.id)
+    session_contexts.evict_student(user.id)
     
     flash(f"Face data cleared for '{user.name}'.", "info")
     return redirect(url_for("dashboard"))
@@ -2213,13 +2645,54 @@ def api_teacher_session_stats(session_id):
     if not session:
         return jsonify({"success": False, "message": "Session not found."}), 404
 
-    roster = build_session_roster(session)
+    counts = session_roster_counts([session.id])[session.id]
+    return jsonify(
+        {
+            "success": True,
+            "marked": counts["marked"],
+            "failed": counts["failed"],
+            "pending": counts["pending"],
+        }
+    )
+
+
+@app.route("/api/teacher/live_counts")
+@login_required
+@limiter.exempt
+def api_teacher_live_counts():
+    """
+    Marked/failed/pending counts of the teacher's live sessions for dashboard polling.
+
+    Clients pass the ``generation`` of their last answer as ``since``; while no worker
+    has committed a mark, session start/close or enrollment change, the answer is
+    ``changed: false`` from one file read, without a database query.
+    """
+    if current_user.role != "teacher":
+        return jsonify({"success": False, "message": "Teachers only."}), 403
+
+    # Read before querying: a change committed meanwhile shows up on the next poll.
+    generation = session_counters.current()
+    if request.args.get("since", type=int) == generation:
+        return jsonify({"success": True, "generation": generation, "changed": False})
+
+    session_ids = [
+        session_id
+        for (session_id,) in db.session.query(ClassSession.id).filter(
+            ClassSession.teacher_id == current_user.id,
+            ClassSession.is_active.is_(True),
+            ClassSession.ends_at >= now_utc_naive(),
+        )
+    ]
+    counts = session_roster_counts(session_ids)
     return jsonify(
         {
             "success": True,
-            "marked": roster["counts"].get("marked", 0),
-            "failed": roster["counts"].get("failed", 0),
-            "pending": roster["counts"].get("pending", 0),
+            "generation": generation,
+            "changed": True,
+            "sessions": {
+                str(session_id): {name: counts[session_id][name] for name in ("marked", "failed", "pending")}
+                for session_id in session_ids
+            },
         }
     )
 
@@ -2232,22 +2705,14 @@ def api_my_course_attendance():
     if current_user.role != "student":
         return jsonify([]), 403
     enrolled_courses = (
-        Course.query.join(Enrollment, Enrollment.course_id == Course.id)
+        db.session.query(Course, Enrollment.sessions_attended, Enrollment.sessions_eligible)
+        .join(Enrollment, Enrollment.course_id == Course.id)
         .filter(Enrollment.student_id == current_user.id)
         .all()
     )
     result = []
-    for course in enrolled_courses:
-        session_ids = [s.id for s in ClassSession.query.filter_by(course_id=course.id).all()]
-        total = len(session_ids)
-        attended = (
-            SessionAttendance.query.filter(
-                SessionAttendance.student_id == current_user.id,
-                SessionAttendance.session_id.in_(session_ids),
-            ).count()
-            if session_ids else 0
-        )
-        pct = round((attended / total) * 100, 1) if total > 0 else 0.0
+    for course, attended, total in enrolled_courses:
+        pct = attendance_percentage(attended, total, digits=1)
         result.append({
             "course_code": course.code,
             "course_title": course.title,
@@ -2416,17 +2881,9 @@ def login():
                 
                 # Update last login timestamp
                 user.last_login = now_utc_naive()
+                sync_user_last_login(app, user)
                 db.session.commit()
                 
-                # Sync last login to Firebase
-                try:
-                    from firebase_service import db as firebase_db
-                    if firebase_db:
-                        ref = firebase_db.reference(f"users/{user.id}/last_login")
-                        ref.set(user.last_login.isoformat())
-                except Exception:
-                    pass
-                
                 app.logger.info(f"✅ Login successful (Firebase): {email}")
                 flash("Login successful!", "success")
                 return redirect(url_for("dashboard"))
@@ -2438,10 +2895,8 @@ def login():
             
             # Update last login timestamp
             user.last_login = now_utc_naive()
-            db.session.commit()
-            
-            # Sync to Firebase
             sync_user_registration(app, user)
+            db.session.commit()
             
             app.logger.info(f"✅ Login successful (SQLite fallback): {email}")
             flash("Login successful!", "success")
@@ -2475,19 +2930,9 @@ def dashboard():
         assigned_students = sum(1 for student in students if student.assignment_status == "assigned")
         dept_stats = {}
 
-        user_attendance_map = {}
-        today_count = 0
-
-        for user in users:
-            user_attendance_map[user.id] = {}
-            for date in recent_dates:
-                att = Attendance.query.filter_by(user_id=user.id, date=date).first()
-                if att:
-                    user_attendance_map[user.id][date.isoformat()] = att.time.strftime("%I:%M %p")
-                    if date == today:
-                        today_count += 1
-                else:
-                    user_attendance_map[user.id][date.isoformat()] = None
+        user_attendance_map, today_count = recent_attendance_matrix(
+            [user.id for user in users], recent_dates
+        )
 
         for student in students:
             department = student.department or "Unknown"
@@ -2521,20 +2966,13 @@ def dashboard():
         recent_dates.reverse()
         teacher_course_ids = teacher_accessible_course_ids(current_user.id)
 
-        students = teacher_students_query(current_user.id).order_by(User.name.asc()).all()
-        student_attendance_map = {}
-        student_today_count = 0
-
-        for student in students:
-            student_attendance_map[student.id] = {}
-            for date in recent_dates:
-                att = Attendance.query.filter_by(user_id=student.id, date=date).first()
-                if att:
-                    student_attendance_map[student.id][date.isoformat()] = att.time.strftime("%I:%M %p")
-                    if date == today:
-                        student_today_count += 1
-                else:
-                    student_attendance_map[student.id][date.isoformat()] = None
+        students_query = teacher_students_query(current_user.id)
+        students = students_query.order_by(User.name.asc()).all()
+        student_attendance_map, student_today_count = recent_attendance_matrix(
+            [student.id for student in students],
+            recent_dates,
+            user_filter=Attendance.user_id.in_(students_query.with_entities(User.id)),
+        )
 
         now = now_utc_naive()
         teacher_courses = (
@@ -2569,9 +3007,9 @@ def dashboard():
             .group_by(SessionAttendance.session_id)
             .all()
         )
-        session_roster_count_map = {}
-        for teacher_session in teacher_sessions:
-            session_roster_count_map[teacher_session.id] = build_session_roster(teacher_session)["counts"]
+        session_roster_count_map = session_roster_counts(
+            [teacher_session.id for teacher_session in teacher_sessions]
+        )
 
         my_attendance = Attendance.query.filter_by(user_id=current_user.id).order_by(Attendance.date.desc()).all()
         return render_template(
@@ -2588,6 +3026,7 @@ def dashboard():
             active_session_count=active_session_count,
             session_attendance_count_map=session_attendance_count_map,
             session_roster_count_map=session_roster_count_map,
+            live_counts_poll_seconds=app.config.get("TEACHER_LIVE_COUNTS_POLL_SECONDS", 5),
             now=now,
         )
 
@@ -2596,18 +3035,15 @@ def dashboard():
 
     present_days = len(my_attendance)
 
-    # Total class sessions the student was eligible to attend
-    enrolled_course_ids = [e.course_id for e in Enrollment.query.filter_by(student_id=current_user.id).all()]
-    total_sessions_held = 0
-    if enrolled_course_ids:
-        # Count all sessions that have already started
-        total_sessions_held = ClassSession.query.filter(
-            ClassSession.course_id.in_(enrolled_course_ids),
-            ClassSession.starts_at <= now_utc_naive()
-        ).count()
-
-    # Use session attendance for percentage (more accurate than daily record)
-    sessions_attended = SessionAttendance.query.filter_by(student_id=current_user.id).count()
+    # Sessions held and attended across the student's courses, from the enrollment counters
+    sessions_attended, total_sessions_held = (
+        db.session.query(
+            func.coalesce(func.sum(Enrollment.sessions_attended), 0),
+            func.coalesce(func.sum(Enrollment.sessions_eligible), 0),
+        )
+        .filter(Enrollment.student_id == current_user.id)
+        .one()
+    )
 
     attendance_percentage = 0
     if total_sessions_held > 0:
@@ -2643,41 +3079,34 @@ def dashboard():
     )
 with app.app_context():
     ensure_schema_compatibility()
-    sync_reference_data_to_sqlite(app, db.session, User, Course, TeacherAssignment, Enrollment, ClassSession)
-
-    # ── Backfill daily Attendance from existing SessionAttendance records ──
-    # Fixes missing daily records for sessions marked before this logic was added.
-    try:
-        all_session_att = SessionAttendance.query.all()
-        backfill_count = 0
-        for sa in all_session_att:
-            sess = db.session.get(ClassSession, sa.session_id)
-            if not sess:
-                continue
-            from zoneinfo import ZoneInfo as _ZI
-            local_marked = sa.marked_at
-            if local_marked.tzinfo is None:
-                local_marked = local_marked.replace(tzinfo=timezone.utc)
-            local_marked = local_marked.astimezone(_ZI(app.config["APP_TIMEZONE"]))
-            record_date = local_marked.date()
-            exists = Attendance.query.filter_by(user_id=sa.student_id, date=record_date).first()
-            if not exists:
-                daily = Attendance(
-                    user_id=sa.student_id,
-                    date=record_date,
-                    time=local_marked.time().replace(microsecond=0),
-                    latitude=sa.latitude,
-                    longitude=sa.longitude,
-                )
-                db.session.add(daily)
-                backfill_count += 1
-        if backfill_count:
-            db.session.commit()
-            app.logger.info("Backfilled %d daily attendance records from session attendance.", backfill_count)
-    except Exception:
-        db.session.rollback()
-        app.logger.exception("Backfill of daily attendance records failed (non-critical).")
-    # ─────────────────────────────────────────────────────────────────────
+    hydration_models = (User, Course, TeacherAssignment, Enrollment, ClassSession)
+    if app.config.get("FIREBASE_HYDRATION_BACKGROUND", True):
+        # Sessions hydrated after the expiry timer bootstrapped still need their deadlines.
+        start_reference_hydration(app, db.session, *hydration_models, on_complete=schedule_pending_session_deadlines)
+    else:
+        run_reference_hydration(app, db.session, *hydration_models)
+    if app.extensions.get("firebase_enabled"):
+        outbox_flusher.poll_seconds = app.config["FIREBASE_OUTBOX_POLL_SECONDS"]
+        outbox_flusher.start(
+            app,
+            send_multi_path_update,
+            batch_size=app.config["FIREBASE_OUTBOX_BATCH_SIZE"],
+            max_attempts=app.config["FIREBASE_OUTBOX_MAX_ATTEMPTS"],
+            backoff_seconds=app.config["FIREBASE_OUTBOX_BACKOFF_SECONDS"],
+            backoff_max_seconds=app.config["FIREBASE_OUTBOX_BACKOFF_MAX_SECONDS"],
+        )
+    if app.config.get("SESSION_EXPIRY_ENABLED", True):
+        session_expiry.on_due = expire_due_sessions
+        session_expiry.fallback_seconds = app.config.get("SESSION_EXPIRY_FALLBACK_SECONDS", 300)
+        schedule_pending_session_deadlines()
+        session_expiry.start()
+
+
+# Marks recorded before daily records were written alongside them get their daily rows
+# from an incremental backfill; see attendance_backfill and `flask --app manage
+# backfill-daily-attendance`.
+if app.config.get("DAILY_ATTENDANCE_BACKFILL_ON_STARTUP", True):
+    start_backfill_thread(app)
 
 
 if __name__ == "__main__":
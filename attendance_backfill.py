@@ -0,0 +1,175 @@
+"""
+Incremental backfill of daily ``Attendance`` rows from ``SessionAttendance`` marks.
+
+Each run copies the first mark per student and local day into ``attendance`` with one
+``INSERT … SELECT … WHERE NOT EXISTS`` and records the highest processed mark id in
+``SyncState``, so later runs only read marks added since. The local day is computed in
+SQL with a fixed UTC offset per stretch of constant offset, which keeps DST-observing
+``APP_TIMEZONE`` values correct without loading rows into Python. SQLite and PostgreSQL
+are supported; other backends are refused before anything is read.
+"""
+import threading
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+from sqlalchemy import Date, Time, and_, cast, func, insert, literal, select
+
+from models import Attendance, ClassSession, SessionAttendance, SyncState, db
+from worker_sync import file_lock
+
+BACKFILL_STATE_KEY = "daily_attendance_backfill.last_session_attendance_id"
+
+# Probe step when searching for UTC offset changes; zones change offset at most a few
+# times a year, and bisection narrows each change down to the minute.
+_OFFSET_PROBE_STEP = timedelta(days=1)
+
+
+def _utc_offset_minutes(tz, moment):
+    return int(moment.replace(tzinfo=timezone.utc).astimezone(tz).utcoffset().total_seconds() // 60)
+
+
+def utc_offset_segments(start, end, tz):
+    """
+    Split the naive-UTC range ``[start, end]`` into ``(lower, upper, offset_minutes)``
+    stretches where ``tz`` keeps one UTC offset; ``upper`` is exclusive.
+    """
+    cursor = start.replace(second=0, microsecond=0)
+    stop = end.replace(second=0, microsecond=0) + timedelta(minutes=1)
+    offset = _utc_offset_minutes(tz, cursor)
+    probe = cursor
+    while probe < stop:
+        following = min(probe + _OFFSET_PROBE_STEP, stop)
+        if _utc_offset_minutes(tz, following) == offset:
+            probe = following
+            continue
+        low, high = probe, following
+        while high - low > timedelta(minutes=1):
+            middle = low + timedelta(minutes=(high - low) // timedelta(minutes=1) // 2)
+            if _utc_offset_minutes(tz, middle) == offset:
+                low = middle
+            else:
+                high = middle
+        yield cursor, high, offset
+        cursor, probe, offset = high, high, _utc_offset_minutes(tz, high)
+    yield cursor, stop, offset
+
+
+def _local_date_and_time(marked_at, offset_minutes, dialect_name):
+    """SQL expressions for the local date and time of ``marked_at`` at a fixed UTC offset."""
+    if dialect_name == "sqlite":
+        shift = f"{offset_minutes:+d} minutes"
+        return (
+            func.strftime("%Y-%m-%d", marked_at, shift),
+            func.strftime("%H:%M:%S.000000", marked_at, shift),
+        )
+    if dialect_name == "postgresql":
+        shifted = marked_at + timedelta(minutes=offset_minutes)
+        return cast(shifted, Date), cast(shifted, Time)
+    raise NotImplementedError(f"Daily attendance backfill is not supported for the {dialect_name!r} dialect")
+
+
+def _backfill_segment(lower, upper, offset_minutes, after_id, through_id, created_at):
+    local_date, local_time = _local_date_and_time(
+        SessionAttendance.marked_at, offset_minutes, db.session.get_bind().dialect.name
+    )
+    ranked = (
+        select(
+            SessionAttendance.student_id,
+            local_date.label("local_date"),
+            local_time.label("local_time"),
+            SessionAttendance.latitude,
+            SessionAttendance.longitude,
+            func.row_number()
+            .over(
+                partition_by=(SessionAttendance.student_id, local_date),
+                order_by=(SessionAttendance.marked_at, SessionAttendance.id),
+            )
+            .label("rank"),
+        )
+        .join(ClassSession, ClassSession.id == SessionAttendance.session_id)
+        .where(
+            SessionAttendance.id > after_id,
+            SessionAttendance.id <= through_id,
+            SessionAttendance.marked_at >= lower,
+            SessionAttendance.marked_at < upper,
+        )
+        .subquery()
+    )
+    already_recorded = (
+        select(Attendance.id)
+        .where(and_(Attendance.user_id == ranked.c.student_id, Attendance.date == ranked.c.local_date))
+        .exists()
+    )
+    rows = select(
+        ranked.c.student_id,
+        ranked.c.local_date,
+        ranked.c.local_time,
+        literal("present"),
+        ranked.c.latitude,
+        ranked.c.longitude,
+        literal(created_at),
+    ).where(ranked.c.rank == 1, ~already_recorded)
+    return db.session.execute(
+        insert(Attendance).from_select(
+            ["user_id", "date", "time", "status", "latitude", "longitude", "created_at"],
+            rows,
+        )
+    ).rowcount
+
+
+def backfill_daily_attendance(timezone_name):
+    """
+    Create missing daily records for marks newer than the stored high-water mark.
+
+    Returns the number of daily rows inserted. Runs in the caller's session and
+    commits, so the inserts and the new high-water mark land together. Raises
+    ``NotImplementedError`` on backends other than SQLite and PostgreSQL.
+    """
+    dialect_name = db.session.get_bind().dialect.name
+    if dialect_name not in ("sqlite", "postgresql"):
+        raise NotImplementedError(f"Daily attendance backfill is not supported for the {dialect_name!r} dialect")
+    after_id = int(SyncState.get_value(BACKFILL_STATE_KEY, 0))
+    through_id, first_marked, last_marked = db.session.execute(
+        select(
+            func.max(SessionAttendance.id),
+            func.min(SessionAttendance.marked_at),
+            func.max(SessionAttendance.marked_at),
+        ).where(SessionAttendance.id > after_id, SessionAttendance.marked_at.is_not(None))
+    ).one()
+    if through_id is None:
+        return 0
+
+    tz = ZoneInfo(timezone_name)
+    created_at = datetime.now(timezone.utc)
+    inserted = 0
+    # Segments run in time order within one transaction, so NOT EXISTS also sees days
+    # filled by an earlier segment (e.g. the repeated hour when clocks fall back).
+    for lower, upper, offset in utc_offset_segments(first_marked, last_marked, tz):
+        inserted += _backfill_segment(lower, upper, offset, after_id, through_id, created_at)
+    SyncState.set_value(BACKFILL_STATE_KEY, through_id)
+    db.session.commit()
+    return inserted
+
+
+def start_backfill_thread(app):
+    """Run ``backfill_daily_attendance`` once off the import path, one worker at a time."""
+
+    def run():
+        lock_path = f"{app.instance_path}/daily_attendance_backfill.lock"
+        with app.app_context():
+            try:
+                with file_lock(lock_path):
+                    inserted = backfill_daily_attendance(app.config["APP_TIMEZONE"])
+                if inserted:
+                    app.logger.info("Backfilled %d daily attendance records from session attendance.", inserted)
+            except NotImplementedError as exc:
+                app.logger.warning("Skipping daily attendance backfill: %s", exc)
+            except Exception:
+                db.session.rollback()
+                app.logger.exception("Backfill of daily attendance records failed (non-critical).")
+            finally:
+                db.session.remove()
+
+    thread = threading.Thread(target=run, name="daily-attendance-backfill", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,192 @@
+"""
+Materialized per-enrollment attendance counters.
+
+Every ``Enrollment`` row carries ``sessions_attended`` and ``sessions_eligible`` so
+attendance percentages are a column read instead of per-course COUNT queries. A session
+becomes eligible once its start time has passed: it is counted exactly once, guarded by
+``ClassSession.is_counted``. Marks increment the attended counter in the same
+transaction that inserts the ``SessionAttendance`` row. ``rebuild_attendance_counters``
+recomputes everything from the source tables.
+"""
+import threading
+import time
+from datetime import datetime, timezone
+
+from sqlalchemy import func, select, update
+
+from models import ClassSession, Enrollment, SessionAttendance, User, db
+
+LOW_ATTENDANCE_THRESHOLD = 75.0
+
+
+def _now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def attendance_percentage(attended, eligible, digits=2):
+    """Percentage of eligible sessions attended, capped at 100; 0.0 when nothing was held yet."""
+    if not eligible:
+        return 0.0
+    return round(min(attended, eligible) / eligible * 100, digits)
+
+
+class CachedValue:
+    """One computed value reused for ``ttl_seconds`` or until ``invalidate()``."""
+
+    def __init__(self, ttl_seconds=30):
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._value = None
+        self._computed_at = None
+
+    def get(self, compute):
+        with self._lock:
+            if self._computed_at is not None and time.monotonic() - self._computed_at < self.ttl_seconds:
+                return self._value
+        value = compute()
+        with self._lock:
+            self._value = value
+            self._computed_at = time.monotonic()
+        return value
+
+    def invalidate(self):
+        with self._lock:
+            self._computed_at = None
+
+
+# Campus-wide low-attendance count polled by the admin dashboard. Marks and newly counted
+# sessions in this worker invalidate it; the TTL bounds staleness from other workers.
+low_attendance_cache = CachedValue()
+
+
+def count_low_attendance_students(threshold=LOW_ATTENDANCE_THRESHOLD):
+    """
+    Number of active students whose overall attendance is below ``threshold`` percent.
+
+    One grouped query over the enrollment counters: attended and eligible sessions are
+    summed per student across their active enrollments. Students with no sessions held
+    yet are not counted.
+    """
+    per_student = (
+        db.session.query(Enrollment.student_id)
+        .join(User, User.id == Enrollment.student_id)
+        .filter(User.role == "student", User.is_active.is_(True), Enrollment.is_active.is_(True))
+        .group_by(Enrollment.student_id)
+        .having(func.sum(Enrollment.sessions_eligible) > 0)
+        .having(func.sum(Enrollment.sessions_attended) * 100 < threshold * func.sum(Enrollment.sessions_eligible))
+        .subquery()
+    )
+    return db.session.query(func.count()).select_from(per_student).scalar()
+
+
+def low_attendance_count():
+    """Cached ``count_low_attendance_students()``."""
+    return low_attendance_cache.get(count_low_attendance_students)
+
+
+def count_session(session_id, course_id):
+    """
+    Add one eligible session to every enrollment of ``course_id``, once per session.
+
+    The conditional update on ``is_counted`` makes concurrent callers safe: only the
+    one that flips the flag increments the counters. Runs in the caller's transaction.
+    """
+    flipped = db.session.execute(
+        update(ClassSession)
+        .where(ClassSession.id == session_id, ClassSession.is_counted.is_(False))
+        .values(is_counted=True)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if flipped and course_id is not None:
+        low_attendance_cache.invalidate()
+        db.session.execute(
+            update(Enrollment)
+            .where(Enrollment.course_id == course_id)
+            .values(sessions_eligible=Enrollment.sessions_eligible + 1)
+            .execution_options(synchronize_session=False)
+        )
+    return bool(flipped)
+
+
+def ensure_session_counted(session, now=None):
+    """Count ``session`` if it has started and was not counted yet."""
+    if session.is_counted or session.starts_at > (now or _now()):
+        return False
+    counted = count_session(session.id, session.course_id)
+    session.is_counted = True
+    return counted
+
+
+def count_started_sessions(now=None):
+    """Count every session whose start time has passed since the last sweep."""
+    pending = db.session.execute(
+        select(ClassSession.id, ClassSession.course_id).where(
+            ClassSession.is_counted.is_(False),
+            ClassSession.starts_at <= (now or _now()),
+        )
+    ).all()
+    return sum(1 for session_id, course_id in pending if count_session(session_id, course_id))
+
+
+def record_session_marks(session, student_ids):
+    """Increment ``sessions_attended`` for newly marked students; call before the mark commits."""
+    student_ids = list(student_ids)
+    if session.course_id is None or not student_ids:
+        return
+    ensure_session_counted(session)
+    low_attendance_cache.invalidate()
+    db.session.execute(
+        update(Enrollment)
+        .where(Enrollment.course_id == session.course_id, Enrollment.student_id.in_(student_ids))
+        .values(sessions_attended=Enrollment.sessions_attended + 1)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def seed_enrollment(enrollment):
+    """Initialise the counters of a new enrollment from the sessions already held."""
+    enrollment.sessions_eligible = (
+        db.session.query(func.count(ClassSession.id))
+        .filter(ClassSession.course_id == enrollment.course_id, ClassSession.is_counted.is_(True))
+        .scalar()
+    )
+    enrollment.sessions_attended = (
+        db.session.query(func.count(SessionAttendance.id))
+        .join(ClassSession, ClassSession.id == SessionAttendance.session_id)
+        .filter(
+            ClassSession.course_id == enrollment.course_id,
+            SessionAttendance.student_id == enrollment.student_id,
+        )
+        .scalar()
+    )
+
+
+def rebuild_attendance_counters(now=None):
+    """Recompute every counter and ``is_counted`` flag from sessions and marks; caller commits."""
+    now = now or _now()
+    db.session.execute(
+        update(ClassSession)
+        .values(is_counted=ClassSession.starts_at <= now)
+        .execution_options(synchronize_session=False)
+    )
+    eligible = (
+        select(func.count(ClassSession.id))
+        .where(ClassSession.course_id == Enrollment.course_id, ClassSession.is_counted.is_(True))
+        .scalar_subquery()
+    )
+    attended = (
+        select(func.count(SessionAttendance.id))
+        .join(ClassSession, ClassSession.id == SessionAttendance.session_id)
+        .where(
+            ClassSession.course_id == Enrollment.course_id,
+            SessionAttendance.student_id == Enrollment.student_id,
+        )
+        .scalar_subquery()
+    )
+    rebuilt = db.session.execute(
+        update(Enrollment)
+        .values(sessions_eligible=eligible, sessions_attended=attended)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    low_attendance_cache.invalidate()
+    return rebuilt
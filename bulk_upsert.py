@@ -0,0 +1,119 @@
+"""
+Chunked ``INSERT … ON CONFLICT`` for SQLite and PostgreSQL.
+
+``upsert_rows`` writes many rows in one statement per chunk instead of a lookup and an
+ORM flush per row. On conflict, every non-key column is updated with
+``COALESCE(excluded.col, col)``: a ``None`` in a row keeps the stored value, matching the
+``payload.get(key, existing)`` merges it replaces. With no columns to update it becomes
+``ON CONFLICT DO NOTHING``; ``insert_missing`` is that statement on its own, for callers
+that need to know which rows were new.
+"""
+from sqlalchemy import func, select, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+
+DEFAULT_CHUNK_SIZE = 500
+
+_DIALECT_INSERTS = {
+    "sqlite": sqlite.insert,
+    "postgresql": postgresql.insert,
+}
+
+
+def dialect_insert(session, table):
+    """The dialect-specific ``insert()`` that supports ``on_conflict_*`` for ``session``'s bind."""
+    name = session.get_bind().dialect.name
+    try:
+        return _DIALECT_INSERTS[name](table)
+    except KeyError:
+        raise NotImplementedError(f"Bulk upsert is not supported for the {name!r} dialect") from None
+
+
+def _existing_rows(session, table, key_columns, keys, value_columns):
+    """``{key: {column: stored value}}`` for the rows of ``keys`` that already exist."""
+    columns = [table.c[name] for name in key_columns]
+    key_match = columns[0].in_([key[0] for key in keys]) if len(columns) == 1 else tuple_(*columns).in_(keys)
+    query = select(*columns, *(table.c[name] for name in value_columns)).where(key_match)
+    width = len(columns)
+    return {tuple(row[:width]): dict(zip(value_columns, row[width:])) for row in session.execute(query)}
+
+
+def upsert_rows(
+    session,
+    model,
+    rows,
+    key_columns=("id",),
+    defaults=None,
+    insert_only_columns=(),
+    chunk_size=DEFAULT_CHUNK_SIZE,
+):
+    """
+    Insert or update ``rows`` (dicts of column values) keyed by ``key_columns``.
+
+    ``insert_only_columns`` are written for new rows and left alone on conflict.
+
+    ``defaults`` fill ``None`` values of rows that do not exist yet, for NOT NULL columns
+    a partial payload may omit; callables are called with the row. ``None`` in a NOT NULL
+    column of an existing row is replaced by the stored value first, because the database
+    rejects the proposed row before resolving the conflict. Runs in the caller's
+    transaction and returns the number of rows written.
+    """
+    table = model.__table__
+    key_columns = tuple(key_columns)
+    rows = list(rows)
+    columns = sorted({name for row in rows for name in row} | set(defaults or ()))
+    required = [
+        name for name in columns
+        if name not in key_columns and not table.c[name].nullable and not table.c[name].primary_key
+    ]
+    written = 0
+    for start in range(0, len(rows), chunk_size):
+        chunk = [{name: row.get(name) for name in columns} for row in rows[start:start + chunk_size]]
+        incomplete = any(row[name] is None for row in chunk for name in required)
+        if defaults or incomplete:
+            keys = [tuple(row[name] for name in key_columns) for row in chunk]
+            existing = _existing_rows(session, table, key_columns, keys, required)
+            for row, key in zip(chunk, keys):
+                stored = existing.get(key)
+                if stored is not None:
+                    for name, value in stored.items():
+                        if row[name] is None:
+                            row[name] = value
+                    continue
+                for name, default in (defaults or {}).items():
+                    if row.get(name) is None:
+                        row[name] = default(row) if callable(default) else default
+        statement = dialect_insert(session, table).values(chunk)
+        update_columns = [name for name in columns if name not in key_columns and name not in insert_only_columns]
+        if update_columns:
+            statement = statement.on_conflict_do_update(
+                index_elements=list(key_columns),
+                set_={name: func.coalesce(statement.excluded[name], table.c[name]) for name in update_columns},
+            )
+        else:
+            statement = statement.on_conflict_do_nothing(index_elements=list(key_columns))
+        session.execute(statement)
+        written += len(chunk)
+    return written
+
+
+def insert_missing(session, model, rows, key_columns):
+    """
+    Insert the ``rows`` whose ``key_columns`` do not exist yet and skip the rest.
+
+    One ``INSERT … ON CONFLICT DO NOTHING RETURNING`` per chunk, so concurrent writers of
+    the same key cannot fail each other. Returns the set of key tuples that were
+    inserted; runs in the caller's transaction.
+    """
+    table = model.__table__
+    key_columns = tuple(key_columns)
+    rows = list(rows)
+    inserted = set()
+    for start in range(0, len(rows), DEFAULT_CHUNK_SIZE):
+        statement = (
+            dialect_insert(session, table)
+            .values(rows[start:start + DEFAULT_CHUNK_SIZE])
+            .on_conflict_do_nothing(index_elements=list(key_columns))
+            .returning(*(table.c[name] for name in key_columns))
+        )
+        inserted.update(tuple(row) for row in session.execute(statement))
+    return inserted
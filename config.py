@@ -93,6 +93,20 @@ class Config:
     FIREBASE_SERVICE_ACCOUNT_JSON = os.environ.get('FIREBASE_SERVICE_ACCOUNT_JSON', '')
     FIREBASE_PRIVATE_KEY = os.environ.get('FIREBASE_PRIVATE_KEY', '')
     FIREBASE_CLIENT_EMAIL = os.environ.get('FIREBASE_CLIENT_EMAIL', '')
+    # Hydrate SQLite from Firebase in a background thread instead of blocking worker
+    # boot; /api/health reports ready once it finishes. Later runs only pull records
+    # whose synced_at is past the stored watermark, in pages of this many records.
+    FIREBASE_HYDRATION_BACKGROUND = _env_bool('FIREBASE_HYDRATION_BACKGROUND', True)
+    FIREBASE_HYDRATION_PAGE_SIZE = _env_int('FIREBASE_HYDRATION_PAGE_SIZE', 1000)
+    # Mirror writes are queued in the firebase_outbox table with the SQLite change and
+    # sent by a background flusher as multi-path updates of up to BATCH_SIZE writes.
+    # Failed writes back off exponentially (capped at BACKOFF_MAX_SECONDS) and are
+    # dead-lettered after MAX_ATTEMPTS; requeue with: flask --app manage requeue-firebase-outbox
+    FIREBASE_OUTBOX_BATCH_SIZE = _env_int('FIREBASE_OUTBOX_BATCH_SIZE', 200)
+    FIREBASE_OUTBOX_MAX_ATTEMPTS = _env_int('FIREBASE_OUTBOX_MAX_ATTEMPTS', 10)
+    FIREBASE_OUTBOX_BACKOFF_SECONDS = _env_float('FIREBASE_OUTBOX_BACKOFF_SECONDS', 2.0)
+    FIREBASE_OUTBOX_BACKOFF_MAX_SECONDS = _env_float('FIREBASE_OUTBOX_BACKOFF_MAX_SECONDS', 300.0)
+    FIREBASE_OUTBOX_POLL_SECONDS = _env_float('FIREBASE_OUTBOX_POLL_SECONDS', 5.0)
 
     # Firebase Web SDK config (frontend)
     FIREBASE_API_KEY = os.environ.get('VITE_FIREBASE_API_KEY', '')
@@ -138,3 +152,56 @@ class Config:
     FACE_RECOGNITION_THRESHOLD = _env_float('FACE_RECOGNITION_THRESHOLD', 0.45)
     FACE_DUPLICATE_THRESHOLD = _env_float('FACE_DUPLICATE_THRESHOLD', 0.50)
     FACE_SPOOFING_THRESHOLD = _env_float('FACE_SPOOFING_THRESHOLD', 0.80)
+    # Where `flask --app manage calibrate-face-thresholds` saves its report for
+    # /api/admin/face_calibration; the calibration itself never runs in a request.
+    FACE_CALIBRATION_REPORT_PATH = os.environ.get(
+        'FACE_CALIBRATION_REPORT_PATH', (_basedir / 'instance' / 'face_calibration.json').as_posix()
+    )
+
+    # ─── Face Gallery ANN Index ─────────────────────────────────────────────────
+    # Approximate search for duplicate-face checks on very large galleries.
+    # Build or rebuild the index offline with: flask --app manage build-face-index
+    # Galleries smaller than FACE_ANN_MIN_GALLERY keep using the exact scan.
+    FACE_ANN_ENABLED = _env_bool('FACE_ANN_ENABLED', False)
+    FACE_ANN_INDEX_PATH = os.environ.get('FACE_ANN_INDEX_PATH', (_basedir / 'instance' / 'face_index.npy').as_posix())
+    FACE_ANN_NPROBE = _env_int('FACE_ANN_NPROBE', 8)
+    FACE_ANN_MIN_GALLERY = _env_int('FACE_ANN_MIN_GALLERY', 20000)
+
+    # ─── Shared Face Gallery ────────────────────────────────────────────────────
+    # Keep one memory-mapped copy of the face gallery per host instead of one per
+    # gunicorn worker. Each registration is logged as a small delta that the other
+    # workers replay; every FACE_SHARED_STORE_COMPACT_EVERY deltas become a new base.
+    FACE_SHARED_STORE_ENABLED = _env_bool('FACE_SHARED_STORE_ENABLED', False)
+    FACE_SHARED_STORE_DIR = os.environ.get('FACE_SHARED_STORE_DIR', (_basedir / 'instance' / 'face_store').as_posix())
+    FACE_SHARED_STORE_COMPACT_EVERY = _env_int('FACE_SHARED_STORE_COMPACT_EVERY', 256)
+    # Store gallery templates as float16: half the memory, ~1e-4 distance error,
+    # but scans widen each chunk to float32 and run slower than plain float32.
+    FACE_GALLERY_FLOAT16 = _env_bool('FACE_GALLERY_FLOAT16', False)
+
+    # ─── Live Sessions & Kiosk ──────────────────────────────────────────────────
+    # Seconds a live session's prepared context (enrollments, face templates,
+    # geofence, marked students) is reused before reloading, so late enrollments
+    # and new face registrations are picked up.
+    SESSION_CONTEXT_TTL_SECONDS = _env_int('SESSION_CONTEXT_TTL_SECONDS', 60)
+    # Upper bound on faces accepted by one /api/kiosk_mark_batch call.
+    KIOSK_BATCH_MAX_FACES = _env_int('KIOSK_BATCH_MAX_FACES', 16)
+    # Close sessions at their deadline from a background timer in each worker.
+    # The fallback wake also picks up sessions created by other processes.
+    SESSION_EXPIRY_ENABLED = _env_bool('SESSION_EXPIRY_ENABLED', True)
+    SESSION_EXPIRY_FALLBACK_SECONDS = _env_int('SESSION_EXPIRY_FALLBACK_SECONDS', 300)
+    # Student polls resolve their live sessions from an in-memory index by course.
+    # Changes made through the app reach every worker at once; these bound how long
+    # changes from elsewhere (CLI, Firebase hydration) can go unseen.
+    LIVE_SESSION_REGISTRY_TTL_SECONDS = _env_int('LIVE_SESSION_REGISTRY_TTL_SECONDS', 60)
+    STUDENT_ENROLLMENT_CACHE_SECONDS = _env_int('STUDENT_ENROLLMENT_CACHE_SECONDS', 300)
+    # Seconds between the teacher dashboard's live counter polls (/api/teacher/live_counts).
+    # Polls answer at once, and without SQL while nothing changed in any worker.
+    TEACHER_LIVE_COUNTS_POLL_SECONDS = _env_int('TEACHER_LIVE_COUNTS_POLL_SECONDS', 5)
+
+    # ─── Attendance Statistics ──────────────────────────────────────────────────
+    # Seconds the campus-wide low-attendance count on the admin dashboard is
+    # reused; marks made in the same worker refresh it immediately.
+    LOW_ATTENDANCE_CACHE_SECONDS = _env_int('LOW_ATTENDANCE_CACHE_SECONDS', 30)
+    # Copy marks newer than the last backfill into daily attendance records from a
+    # background thread at startup (also: flask --app manage backfill-daily-attendance).
+    DAILY_ATTENDANCE_BACKFILL_ON_STARTUP = _env_bool('DAILY_ATTENDANCE_BACKFILL_ON_STARTUP', True)
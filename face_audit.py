@@ -0,0 +1,142 @@
+"""
+Offline all-pairs duplicate-identity audit over the registered face templates.
+
+``save_face`` only compares a face against the gallery at registration time, so accounts
+hydrated from Firebase or registered before that check existed were never compared.
+The audit compares every template with every other one using blocked matrix products:
+memory stays at one ``block_size x block_size`` tile, and progress is checkpointed after
+each row block so an interrupted run resumes where it stopped.
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from face_matching import DESCRIPTOR_SIZE, to_face_matrix
+
+DEFAULT_BLOCK_SIZE = 4096
+# float32 cancellation in ||a||^2 + ||b||^2 - 2ab; candidates are re-checked exactly.
+SQUARED_DISTANCE_SLACK = 1e-3
+
+
+def load_audit_gallery(rows):
+    """Stack ``(user_id, face_template)`` rows into per-template ``(owners, matrix)`` arrays."""
+    owners = []
+    blocks = []
+    for user_id, template in rows:
+        templates = to_face_matrix(template)
+        if templates is None:
+            continue
+        owners.extend([user_id] * templates.shape[0])
+        blocks.append(templates)
+    matrix = np.concatenate(blocks) if blocks else np.empty((0, DESCRIPTOR_SIZE), dtype=np.float32)
+    return np.asarray(owners, dtype=np.int64), np.ascontiguousarray(matrix, dtype=np.float32)
+
+
+def block_count(total, block_size):
+    return (total + block_size - 1) // block_size
+
+
+def iter_duplicate_pairs(owners, matrix, threshold, block_size=DEFAULT_BLOCK_SIZE, start_block=0):
+    """
+    Yield ``(block_index, pairs)`` for each row block from ``start_block`` on.
+
+    ``pairs`` holds ``(user_a, user_b, distance)`` with ``user_a < user_b`` and the
+    smallest distance between any of their templates seen in that block. Templates of
+    the same user are never paired.
+    """
+    total = matrix.shape[0]
+    sq_norms = np.einsum("ij,ij->i", matrix, matrix)
+    limit = threshold * threshold + SQUARED_DISTANCE_SLACK
+
+    for block_index in range(start_block, block_count(total, block_size)):
+        a0 = block_index * block_size
+        a1 = min(a0 + block_size, total)
+        rows = matrix[a0:a1]
+        best = {}
+        # Upper triangle only: row block i is compared with column blocks i..end.
+        for b0 in range(a0, total, block_size):
+            b1 = min(b0 + block_size, total)
+            # In place on the GEMM output, so a tile needs a single block x block buffer.
+            squared = rows @ matrix[b0:b1].T
+            squared *= -2.0
+            squared += sq_norms[a0:a1, None]
+            squared += sq_norms[None, b0:b1]
+            hits = squared < limit
+            if b0 == a0:
+                hits = np.triu(hits, k=1)
+            ii, jj = np.nonzero(hits)
+            if ii.size == 0:
+                continue
+            ii += a0
+            jj += b0
+            keep = owners[ii] != owners[jj]
+            ii, jj = ii[keep], jj[keep]
+            distances = np.linalg.norm(matrix[ii] - matrix[jj], axis=1)
+            keep = distances < threshold
+            for user_a, user_b, distance in zip(
+                owners[ii[keep]].tolist(), owners[jj[keep]].tolist(), distances[keep].tolist()
+            ):
+                key = (user_a, user_b) if user_a < user_b else (user_b, user_a)
+                if distance < best.get(key, np.inf):
+                    best[key] = distance
+        yield block_index, [(user_a, user_b, distance) for (user_a, user_b), distance in best.items()]
+
+
+def merge_pairs(pairs):
+    """Collapse repeated user pairs (one per template pair or block) to their smallest distance."""
+    best = {}
+    for user_a, user_b, distance in pairs:
+        key = (user_a, user_b)
+        if distance < best.get(key, np.inf):
+            best[key] = distance
+    return sorted(((a, b, d) for (a, b), d in best.items()), key=lambda pair: pair[2])
+
+
+def gallery_fingerprint(owners, matrix, threshold, block_size):
+    """
+    Identify an audit run so a checkpoint is only resumed against the same inputs.
+
+    The template bytes are hashed along with the owners, so a face re-registered
+    between runs invalidates the checkpoint instead of mixing old and new results.
+    """
+    digest = hashlib.sha1(np.ascontiguousarray(owners, dtype=np.int64).tobytes())
+    digest.update(np.ascontiguousarray(matrix, dtype=np.float32).tobytes())
+    return f"{digest.hexdigest()}:{len(owners)}:{threshold:.6f}:{block_size}"
+
+
+class AuditCheckpoint:
+    """
+    JSON progress file, rewritten atomically after each row block.
+
+    Besides the next block it records how many bytes of the partial pair file were
+    complete at that point, so a resumed run can cut off a half-written tail.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self, fingerprint):
+        """Return ``(next_block, partial_bytes)`` to resume from, or ``(0, 0)`` without a matching checkpoint."""
+        try:
+            with open(self.path, encoding="utf-8") as handle:
+                state = json.load(handle)
+        except (OSError, ValueError):
+            return 0, 0
+        if state.get("fingerprint") != fingerprint:
+            return 0, 0
+        return int(state.get("next_block", 0)), int(state.get("partial_bytes", 0))
+
+    def save(self, fingerprint, next_block, partial_bytes):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as handle:
+            json.dump(
+                {"fingerprint": fingerprint, "next_block": next_block, "partial_bytes": partial_bytes},
+                handle,
+            )
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
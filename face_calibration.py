@@ -0,0 +1,293 @@
+"""
+Face-distance threshold calibration from recorded attendance history.
+
+Genuine distances come from the database: every ``SessionAttendance.face_distance`` is an
+accepted genuine scan, and a failed face check in a session the same student was later
+marked in is a false reject. Impostor distances are sampled between templates of
+different users in the registered gallery. Both are accumulated into fixed-bin
+histograms, so the rows are streamed once and never held in memory. A run reads the
+whole gallery and history, so it happens offline (``flask --app manage
+calibrate-face-thresholds``) and the admin API serves the last saved report.
+"""
+import json
+import os
+from datetime import datetime, timezone
+
+import numpy as np
+from sqlalchemy import and_, or_
+
+from face_audit import load_audit_gallery
+from models import AttendanceAttempt, ClassSession, SessionAttendance, User, db
+
+BIN_WIDTH = 0.005
+MAX_DISTANCE = 2.0
+STREAM_CHUNK = 5000
+CURVE_STEP = 0.05
+
+# Failed attempts whose face_distance says something about the face check itself.
+FACE_FAILURE_REASONS = ("Face verification failed%", "Possible spoofing%")
+
+
+class DistanceHistogram:
+    """Fixed-width histogram of face distances over [0, MAX_DISTANCE)."""
+
+    def __init__(self):
+        self.counts = np.zeros(int(round(MAX_DISTANCE / BIN_WIDTH)), dtype=np.int64)
+
+    @property
+    def total(self):
+        return int(self.counts.sum())
+
+    def add(self, distances):
+        values = np.asarray(distances, dtype=np.float64)
+        values = values[np.isfinite(values)]
+        bins = np.clip((values / BIN_WIDTH).astype(np.int64), 0, self.counts.size - 1)
+        self.counts += np.bincount(bins, minlength=self.counts.size)
+
+    def fraction_below(self, threshold):
+        """Share of samples with distance < threshold (accepted at that threshold)."""
+        if not self.total:
+            return None
+        return float(self.counts[:_bin_index(threshold)].sum() / self.total)
+
+    def fraction_at_or_above(self, threshold):
+        """Share of samples with distance >= threshold (rejected at that threshold)."""
+        below = self.fraction_below(threshold)
+        return None if below is None else 1.0 - below
+
+    def quantile(self, q):
+        if not self.total:
+            return None
+        cumulative = np.cumsum(self.counts)
+        index = int(np.searchsorted(cumulative, q * self.total))
+        return round((index + 1) * BIN_WIDTH, 4)
+
+
+def _bin_index(threshold):
+    return int(np.clip(round(threshold / BIN_WIDTH), 0, int(round(MAX_DISTANCE / BIN_WIDTH))))
+
+
+def device_type(user_agent):
+    """Coarse device bucket for a recorded user agent."""
+    agent = (user_agent or "").lower()
+    if agent.startswith("kiosk"):
+        return "kiosk"
+    if any(token in agent for token in ("mobile", "android", "iphone", "ipad")):
+        return "mobile"
+    return "desktop" if agent else "unknown"
+
+
+class GroupedHistograms:
+    """One histogram per (dimension, group) pair plus an overall histogram."""
+
+    DIMENSIONS = ("department", "course", "device")
+
+    def __init__(self):
+        self.overall = DistanceHistogram()
+        self.groups = {dimension: {} for dimension in self.DIMENSIONS}
+
+    def add_rows(self, rows):
+        """Add ``(distance, department, course_code, user_agent)`` rows in vectorized chunks."""
+        buffer = []
+        for row in rows:
+            buffer.append(row)
+            if len(buffer) >= STREAM_CHUNK:
+                self._flush(buffer)
+                buffer = []
+        if buffer:
+            self._flush(buffer)
+
+    def _flush(self, rows):
+        distances = np.array([row[0] for row in rows], dtype=np.float64)
+        self.overall.add(distances)
+        keys = {
+            "department": [row[1] or "unknown" for row in rows],
+            "course": [row[2] or "unknown" for row in rows],
+            "device": [device_type(row[3]) for row in rows],
+        }
+        for dimension, labels in keys.items():
+            labels = np.array(labels, dtype=object)
+            for label in set(labels.tolist()):
+                histogram = self.groups[dimension].setdefault(label, DistanceHistogram())
+                histogram.add(distances[labels == label])
+
+
+def sample_impostor_distances(owners, matrix, sample_size=200000, seed=0, chunk=50000):
+    """Distances between random template pairs that belong to different users."""
+    histogram = DistanceHistogram()
+    if len(np.unique(owners)) < 2:
+        return histogram
+    rng = np.random.default_rng(seed)
+    remaining = sample_size
+    while remaining > 0:
+        size = min(chunk, remaining)
+        left = rng.integers(0, matrix.shape[0], size)
+        right = rng.integers(0, matrix.shape[0], size)
+        keep = owners[left] != owners[right]
+        left, right = left[keep], right[keep]
+        histogram.add(np.linalg.norm(matrix[left] - matrix[right], axis=1))
+        remaining -= size
+    return histogram
+
+
+def genuine_accept_rows():
+    """Distances of accepted session marks with their grouping columns."""
+    return (
+        db.session.query(
+            SessionAttendance.face_distance,
+            User.department,
+            ClassSession.course_code,
+            SessionAttendance.user_agent,
+        )
+        .join(User, User.id == SessionAttendance.student_id)
+        .join(ClassSession, ClassSession.id == SessionAttendance.session_id)
+        .filter(SessionAttendance.face_distance.isnot(None))
+        .yield_per(STREAM_CHUNK)
+    )
+
+
+def _face_failures():
+    return (
+        AttendanceAttempt.success.is_(False),
+        AttendanceAttempt.face_distance.isnot(None),
+        or_(*(AttendanceAttempt.reason.like(pattern) for pattern in FACE_FAILURE_REASONS)),
+    )
+
+
+def genuine_reject_rows():
+    """Failed face checks by students who were marked in the same session afterwards."""
+    return (
+        db.session.query(
+            AttendanceAttempt.face_distance,
+            User.department,
+            ClassSession.course_code,
+            AttendanceAttempt.user_agent,
+        )
+        .join(
+            SessionAttendance,
+            and_(
+                SessionAttendance.session_id == AttendanceAttempt.session_id,
+                SessionAttendance.student_id == AttendanceAttempt.student_id,
+            ),
+        )
+        .join(User, User.id == AttendanceAttempt.student_id)
+        .join(ClassSession, ClassSession.id == AttendanceAttempt.session_id)
+        .filter(*_face_failures())
+        .yield_per(STREAM_CHUNK)
+    )
+
+
+def unresolved_failure_count():
+    """Failed face checks never followed by a mark: impostors or students who gave up."""
+    marked = (
+        db.session.query(SessionAttendance.id)
+        .filter(
+            SessionAttendance.session_id == AttendanceAttempt.session_id,
+            SessionAttendance.student_id == AttendanceAttempt.student_id,
+        )
+        .exists()
+    )
+    return db.session.query(AttendanceAttempt.id).filter(*_face_failures(), ~marked).count()
+
+
+def _largest_threshold_within(impostor, far_target):
+    """Largest threshold whose estimated false-accept rate stays within ``far_target``."""
+    if not impostor.total:
+        return None
+    accepted = np.cumsum(impostor.counts) / impostor.total
+    allowed = np.flatnonzero(accepted <= far_target)
+    # Bin i holds distances in [i*w, (i+1)*w): accepting below (i+1)*w admits bins 0..i.
+    return round((int(allowed[-1]) + 1) * BIN_WIDTH, 4) if allowed.size else BIN_WIDTH
+
+
+def build_calibration_report(genuine, impostor, current, unresolved=0, far_target=0.001, duplicate_far_target=0.01):
+    """Estimate FAR/FRR curves and recommend thresholds from genuine and impostor histograms."""
+    recognition = _largest_threshold_within(impostor, far_target)
+    duplicate = _largest_threshold_within(impostor, duplicate_far_target)
+    genuine_tail = genuine.overall.quantile(0.999)
+    spoofing = None
+    if genuine_tail is not None:
+        spoofing = round(max(genuine_tail, recognition or 0.0), 4)
+    recommended = {
+        "FACE_RECOGNITION_THRESHOLD": recognition,
+        "FACE_DUPLICATE_THRESHOLD": duplicate,
+        "FACE_SPOOFING_THRESHOLD": spoofing,
+    }
+
+    def rates(threshold):
+        if threshold is None:
+            return {"far": None, "frr": None}
+        return {
+            "far": impostor.fraction_below(threshold),
+            "frr": genuine.overall.fraction_at_or_above(threshold),
+        }
+
+    curve = [
+        {"threshold": round(threshold, 4), **rates(threshold)}
+        for threshold in np.arange(CURVE_STEP, MAX_DISTANCE / 2 + CURVE_STEP / 2, CURVE_STEP)
+    ]
+
+    current_recognition = current["FACE_RECOGNITION_THRESHOLD"]
+    groups = {
+        dimension: {
+            label: {
+                "samples": histogram.total,
+                "median_distance": histogram.quantile(0.5),
+                "p95_distance": histogram.quantile(0.95),
+                "frr_at_current": histogram.fraction_at_or_above(current_recognition),
+                "frr_at_recommended": (
+                    histogram.fraction_at_or_above(recognition) if recognition is not None else None
+                ),
+            }
+            for label, histogram in sorted(by_label.items())
+        }
+        for dimension, by_label in genuine.groups.items()
+    }
+
+    return {
+        "samples": {
+            "genuine": genuine.overall.total,
+            "impostor": impostor.total,
+            "unresolved_failures": unresolved,
+        },
+        "targets": {"far": far_target, "duplicate_far": duplicate_far_target},
+        "current": {"thresholds": current, **rates(current_recognition)},
+        "recommended": {"thresholds": recommended, **rates(recognition)},
+        "curve": curve,
+        "groups": groups,
+    }
+
+
+def run_face_calibration(face_rows, current, far_target=0.001, duplicate_far_target=0.01, impostor_samples=200000):
+    """Stream attendance history and the registered gallery into a calibration report."""
+    genuine = GroupedHistograms()
+    genuine.add_rows(genuine_accept_rows())
+    genuine.add_rows(genuine_reject_rows())
+    owners, matrix = load_audit_gallery(face_rows)
+    impostor = sample_impostor_distances(owners, matrix, sample_size=impostor_samples)
+    return build_calibration_report(
+        genuine,
+        impostor,
+        current,
+        unresolved=unresolved_failure_count(),
+        far_target=far_target,
+        duplicate_far_target=duplicate_far_target,
+    )
+
+
+def save_calibration_report(report, path):
+    """Write ``report`` atomically with its generation time, for the admin API to serve."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as handle:
+        json.dump({**report, "generated_at": datetime.now(timezone.utc).isoformat()}, handle)
+    os.replace(tmp_path, path)
+
+
+def load_calibration_report(path):
+    """The last saved report, or None if calibration has not been run."""
+    try:
+        with open(path, encoding="utf-8") as handle:
+            return json.load(handle)
+    except (OSError, ValueError):
+        return None
@@ -0,0 +1,106 @@
+"""
+Approximate nearest-neighbour index for face templates (IVF coarse quantization).
+
+The index only decides *which* gallery rows to look at: k-means centroids split the
+gallery into ``nlist`` inverted lists, a query probes its ``nprobe`` closest lists, and
+the gallery re-ranks the candidate rows with exact distances. Thresholds such as
+``FACE_DUPLICATE_THRESHOLD`` therefore keep their meaning; the only approximation is
+that a match living in an unprobed list can be missed.
+"""
+import logging
+import os
+from math import sqrt
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+ASSIGN_CHUNK_ROWS = 8192
+
+
+def default_nlist(count):
+    """Roughly sqrt(N) lists keeps both the probe and the re-rank step small."""
+    return max(1, int(round(sqrt(max(count, 1)))))
+
+
+class IVFIndex:
+    """Inverted-file coarse quantizer over 128-D face descriptors."""
+
+    def __init__(self, centroids):
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self._centroid_sq_norms = np.einsum("ij,ij->i", self.centroids, self.centroids)
+
+    @property
+    def nlist(self):
+        return self.centroids.shape[0]
+
+    @classmethod
+    def train(cls, vectors, nlist=None, iterations=12, sample_per_list=64, seed=0):
+        """Fit centroids with k-means on (a sample of) ``vectors``."""
+        data = np.asarray(vectors, dtype=np.float32)
+        if data.ndim != 2 or data.shape[0] == 0:
+            raise ValueError("Cannot train a face index on an empty gallery.")
+        nlist = min(nlist or default_nlist(data.shape[0]), data.shape[0])
+        rng = np.random.default_rng(seed)
+
+        sample_size = min(data.shape[0], nlist * sample_per_list)
+        if sample_size < data.shape[0]:
+            data = data[rng.choice(data.shape[0], sample_size, replace=False)]
+
+        index = cls(data[rng.choice(data.shape[0], nlist, replace=False)])
+        for _ in range(iterations):
+            assignment = index.assign(data)
+            sums = np.zeros_like(index.centroids)
+            np.add.at(sums, assignment, data)
+            counts = np.bincount(assignment, minlength=nlist)
+            filled = counts > 0
+            centroids = index.centroids.copy()
+            centroids[filled] = sums[filled] / counts[filled, None]
+            index = cls(centroids)
+        return index
+
+    def assign(self, vectors):
+        """Return the closest list id for every row of ``vectors``."""
+        data = np.asarray(vectors, dtype=np.float32)
+        if data.ndim == 1:
+            data = data[None, :]
+        result = np.empty(data.shape[0], dtype=np.int32)
+        for start in range(0, data.shape[0], ASSIGN_CHUNK_ROWS):
+            chunk = data[start:start + ASSIGN_CHUNK_ROWS]
+            # ||x||^2 is constant per row, so argmin(||c||^2 - 2 x.c) picks the nearest centroid.
+            scores = self._centroid_sq_norms - 2.0 * (chunk @ self.centroids.T)
+            result[start:start + chunk.shape[0]] = np.argmin(scores, axis=1)
+        return result
+
+    def probe(self, vector, nprobe):
+        """Return the ids of the ``nprobe`` lists closest to ``vector``."""
+        query = np.asarray(vector, dtype=np.float32).reshape(-1)
+        scores = self._centroid_sq_norms - 2.0 * (self.centroids @ query)
+        nprobe = max(1, min(int(nprobe), self.nlist))
+        if nprobe == self.nlist:
+            return np.arange(self.nlist, dtype=np.int32)
+        return np.argpartition(scores, nprobe - 1)[:nprobe].astype(np.int32)
+
+    def save(self, path):
+        """Persist the centroids atomically so workers never read a half-written file."""
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as handle:
+            np.save(handle, self.centroids)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Load a saved index, or return None when the file is missing or unreadable."""
+        if not path or not os.path.exists(path):
+            return None
+        try:
+            centroids = np.load(path, allow_pickle=False)
+        except (OSError, ValueError):
+            logger.exception("Face index at %s could not be loaded", path)
+            return None
+        if centroids.ndim != 2 or centroids.shape[0] == 0:
+            logger.warning("Ignoring malformed face index at %s", path)
+            return None
+        return cls(centroids)
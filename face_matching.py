@@ -0,0 +1,539 @@
+"""
+Face template storage helpers and the in-memory gallery used for duplicate-face detection.
+"""
+import base64
+import binascii
+import json
+import logging
+import threading
+from contextlib import nullcontext
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DESCRIPTOR_SIZE = 128
+
+# Version 1: K little-endian float32 vectors of DESCRIPTOR_SIZE values (K x 512 bytes).
+# Older single-template rows are simply K = 1.
+FACE_TEMPLATE_VERSION = 1
+TEMPLATE_DTYPE = np.dtype("<f4")
+TEMPLATE_NBYTES = DESCRIPTOR_SIZE * TEMPLATE_DTYPE.itemsize
+MAX_FACE_TEMPLATES = 5
+# float16 gallery blocks are widened to float32 this many rows at a time for the GEMV.
+GEMV_CHUNK_ROWS = 16384
+
+
+def encode_template(vectors):
+    """Serialize one face vector or a (K x 128) block into the binary template on ``User.face_template``."""
+    return np.asarray(vectors, dtype=TEMPLATE_DTYPE).reshape(-1, DESCRIPTOR_SIZE).tobytes()
+
+
+def decode_template(blob, version=FACE_TEMPLATE_VERSION):
+    """Return a read-only (K x 128) float32 view over a stored template (no copy), or None if unusable."""
+    if blob is None or version not in (None, FACE_TEMPLATE_VERSION):
+        return None
+    if not _valid_template_length(len(blob)):
+        return None
+    return np.frombuffer(blob, dtype=TEMPLATE_DTYPE).reshape(-1, DESCRIPTOR_SIZE)
+
+
+def _valid_template_length(nbytes):
+    return 0 < nbytes <= MAX_FACE_TEMPLATES * TEMPLATE_NBYTES and nbytes % TEMPLATE_NBYTES == 0
+
+
+def template_to_base64(blob):
+    """Encode a binary template for JSON transports such as the Firebase mirror."""
+    if blob is None:
+        return None
+    return base64.b64encode(bytes(blob)).decode("ascii")
+
+
+def template_from_base64(value):
+    """Decode a base64 template back into bytes, or None if it is malformed."""
+    if not value:
+        return None
+    try:
+        blob = base64.b64decode(value, validate=True)
+    except (binascii.Error, TypeError, ValueError):
+        return None
+    return blob if _valid_template_length(len(blob)) else None
+
+
+def to_face_matrix(encoding):
+    """
+    Convert stored or submitted face data into a (K x 128) float32 matrix, or None if invalid.
+
+    Accepts a binary template, a JSON string, one 128-value list or a list of them.
+    """
+    if encoding is None:
+        return None
+    try:
+        if isinstance(encoding, (bytes, bytearray, memoryview)):
+            matrix = decode_template(encoding)
+            if matrix is None:
+                return None
+        else:
+            if isinstance(encoding, str):
+                encoding = json.loads(encoding)
+            matrix = np.asarray(encoding, dtype=np.float32)
+            if matrix.ndim == 1:
+                matrix = matrix[None, :]
+    except (TypeError, ValueError):
+        return None
+    if matrix.ndim != 2 or matrix.shape[1] != DESCRIPTOR_SIZE or not 0 < matrix.shape[0] <= MAX_FACE_TEMPLATES:
+        return None
+    if not np.isfinite(matrix).all():
+        return None
+    return matrix
+
+
+def to_face_vector(encoding):
+    """Convert a single stored or submitted encoding into a float32 vector, or None if invalid."""
+    matrix = to_face_matrix(encoding)
+    if matrix is None or matrix.shape[0] != 1:
+        return None
+    return matrix[0]
+
+
+def squared_norms(matrix):
+    """Row-wise ||t||^2 as float32, computed once when templates are stored."""
+    matrix = np.asarray(matrix).reshape(-1, DESCRIPTOR_SIZE)
+    if matrix.dtype != np.float32:
+        matrix = matrix.astype(np.float32)
+    return np.einsum("ij,ij->i", matrix, matrix)
+
+
+def squared_distances(matrix, sq_norms, vector):
+    """
+    ||t - v||^2 for every template row as ||t||^2 + ||v||^2 - 2 t.v.
+
+    The only O(N) work is one matrix-vector product; float16 blocks are widened chunk
+    by chunk so BLAS still does it. Values can dip slightly below zero from rounding.
+    """
+    query = np.asarray(vector, dtype=np.float32)
+    if matrix.dtype == np.float32:
+        products = matrix @ query
+    else:
+        products = np.empty(matrix.shape[0], dtype=np.float32)
+        for start in range(0, matrix.shape[0], GEMV_CHUNK_ROWS):
+            stop = start + GEMV_CHUNK_ROWS
+            products[start:stop] = matrix[start:stop].astype(np.float32) @ query
+    products *= -2.0
+    products += sq_norms
+    products += float(query @ query)
+    return products
+
+
+def exact_distance(template, vector):
+    """Euclidean distance of one template row, free of the cancellation in ``squared_distances``."""
+    delta = np.asarray(template, dtype=np.float32) - np.asarray(vector, dtype=np.float32)
+    return float(np.sqrt(delta @ delta))
+
+
+def distances_to(templates, vector, sq_norms=None):
+    """Euclidean distances from ``vector`` to each of ``templates``."""
+    templates = np.asarray(templates).reshape(-1, DESCRIPTOR_SIZE)
+    if sq_norms is None:
+        sq_norms = squared_norms(templates)
+    return np.sqrt(np.maximum(squared_distances(templates, sq_norms, vector), 0.0))
+
+
+def parse_descriptor(value):
+    """
+    Validate one submitted face descriptor and return it as a float32 vector, or None.
+
+    Accepts a JSON list of 128 numbers or the compact wire format: base64 of 128
+    little-endian float32 values (512 bytes).
+    """
+    if isinstance(value, str):
+        try:
+            raw = base64.b64decode(value, validate=True)
+        except (binascii.Error, ValueError):
+            return None
+        if len(raw) != TEMPLATE_NBYTES:
+            return None
+        vector = np.frombuffer(raw, dtype=TEMPLATE_DTYPE)
+    elif isinstance(value, list) and len(value) == DESCRIPTOR_SIZE:
+        try:
+            vector = np.asarray(value, dtype=np.float32)
+        except (TypeError, ValueError):
+            return None
+        if vector.shape != (DESCRIPTOR_SIZE,):
+            return None
+    else:
+        return None
+    return vector if np.isfinite(vector).all() else None
+
+
+def min_distance(templates, vector, sq_norms=None):
+    """Best-of-K Euclidean distance between a scan and a user's (K x 128) templates."""
+    templates = np.asarray(templates).reshape(-1, DESCRIPTOR_SIZE)
+    if sq_norms is None:
+        sq_norms = squared_norms(templates)
+    best = int(np.argmin(squared_distances(templates, sq_norms, vector)))
+    return exact_distance(templates[best], vector)
+
+
+class FaceGallery:
+    """
+    Process-wide matrix of registered face templates.
+
+    Templates live in one contiguous block (N x 128) with an owner id and a precomputed
+    squared norm per row (a user with K templates owns K rows), so a duplicate check is
+    a single matrix-vector product over memory that is already loaded. The block is
+    float32 by default; ``set_storage_dtype(np.float16)`` halves it for large galleries
+    at the cost of ~1e-4 distance error and slower scans. The gallery is filled once from the database and then kept in
+    sync in place by the routes that register, clear or delete face data.
+
+    An optional ANN index (see ``face_index.IVFIndex``) narrows large galleries down
+    to a few inverted lists before the exact re-rank.
+
+    With a ``face_store.SharedFaceStore`` attached, the block is a read-only memory map
+    of the store's base shared by every worker on the host. A write appends the user's
+    new templates to the store's delta log under the store lock, and other workers
+    replay the deltas they have not seen through the same in-place update, so one
+    registration costs every worker O(K) work rather than a remap of all N rows.
+    Without one, ``attach_generations`` gives each worker its own copy plus a shared
+    ``worker_sync.GenerationFile``: writes bump it, and ``ensure_loaded`` reloads from
+    the database when another worker has written since the last load.
+    """
+
+    def __init__(self, dim=DESCRIPTOR_SIZE, initial_capacity=1024, dtype=np.float32):
+        self._dim = dim
+        self._dtype = np.dtype(dtype)
+        self._lock = threading.RLock()
+        self._matrix = np.empty((initial_capacity, dim), dtype=self._dtype)
+        self._sq_norms = np.empty(initial_capacity, dtype=np.float32)
+        self._ids = np.empty(initial_capacity, dtype=np.int64)
+        self._lists = np.empty(initial_capacity, dtype=np.int32)
+        self._rows_by_id = {}
+        self._size = 0
+        self._loaded = False
+        self._index = None
+        self._nprobe = 1
+        self._min_indexed_size = 0
+        self._store = None
+        self._generation = 0
+        self._generations = None
+        self._seen_generation = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    @property
+    def index(self):
+        return self._index
+
+    def attach_index(self, index, nprobe=8, min_size=0):
+        """
+        Route ``nearest`` through an ANN index once the gallery holds ``min_size`` rows.
+
+        Every row is assigned to its inverted list now; later upserts are assigned
+        incrementally, so the index never has to be rebuilt online.
+        """
+        with self._lock:
+            self._index = index
+            self._nprobe = max(1, int(nprobe))
+            self._min_indexed_size = max(0, int(min_size))
+            if index is not None and self._size:
+                self._lists[:self._size] = index.assign(self._matrix[:self._size])
+
+    @property
+    def storage_dtype(self):
+        return self._dtype
+
+    def set_storage_dtype(self, dtype):
+        """Store templates as float32 or float16; rows already loaded are converted."""
+        dtype = np.dtype(dtype)
+        if dtype not in (np.dtype(np.float32), np.dtype(np.float16)):
+            raise ValueError(f"Unsupported face gallery dtype: {dtype}")
+        with self._lock:
+            if dtype == self._dtype:
+                return
+            self._dtype = dtype
+            self._matrix = self._matrix[:self._size].astype(dtype)
+            self._sq_norms = squared_norms(self._matrix)
+
+    def attach_store(self, store):
+        """Back the gallery by a host-wide shared store instead of a private copy."""
+        with self._lock:
+            self._store = store
+            self._generation = 0
+            self._clear()
+            self._loaded = False
+
+    def attach_generations(self, generations):
+        """Revalidate a private (store-less) gallery against a ``GenerationFile`` shared by all workers."""
+        with self._lock:
+            self._generations = generations
+            self._seen_generation = generations.read()
+
+    def snapshot(self):
+        """Return copies of the (ids, matrix) currently held, e.g. for offline index training."""
+        with self._lock:
+            self._sync()
+            return self._ids[:self._size].copy(), self._matrix[:self._size].copy()
+
+    def ensure_loaded(self, loader):
+        """
+        Fill the gallery from ``loader()`` (an iterable of (user_id, templates)) on first use.
+
+        With a shared store, a generation already published by another worker is mapped
+        instead, so only the first worker on the host reads the database.
+        """
+        if self._loaded and not self._written_elsewhere():
+            return
+        with self._lock, self._store_lock():
+            self._sync()
+            if self._loaded and not self._written_elsewhere():
+                return
+            if self._generations is not None and self._store is None:
+                # Read before loading, so a write that lands during the load triggers another.
+                self._seen_generation = self._generations.read()
+            self._clear()
+            self._make_writable()
+            skipped = 0
+            for user_id, encoding in loader():
+                matrix = to_face_matrix(encoding)
+                if matrix is None:
+                    skipped += 1
+                    continue
+                self._put(int(user_id), matrix)
+            self._loaded = True
+            logger.info(
+                "Face gallery loaded: %d templates for %d users (%d skipped)",
+                self._size, len(self._rows_by_id), skipped,
+            )
+            self._publish()
+
+    def invalidate(self):
+        """Drop all rows; the next ``ensure_loaded`` call reloads (from the shared store if attached)."""
+        with self._lock:
+            self._clear()
+            self._generation = 0
+            self._loaded = False
+
+    def upsert(self, user_id, encoding):
+        """Replace all templates of ``user_id``. No-op until the gallery is loaded."""
+        matrix = to_face_matrix(encoding)
+        with self._lock, self._store_lock():
+            self._sync()
+            if not self._loaded:
+                return
+            self._make_writable()
+            self._remove(int(user_id))
+            if matrix is not None:
+                self._put(int(user_id), matrix)
+            self._append(int(user_id))
+        self._announce()
+
+    def remove(self, user_id):
+        """Remove every template of ``user_id`` if present."""
+        with self._lock, self._store_lock():
+            self._sync()
+            if self._loaded and int(user_id) in self._rows_by_id:
+                self._make_writable()
+                self._remove(int(user_id))
+                self._append(int(user_id))
+        self._announce()
+
+    def nearest(self, vector, exclude_id=None):
+        """Return ``(user_id, distance)`` of the closest template over all users' templates, or ``(None, None)``."""
+        query = np.asarray(vector, dtype=np.float32)
+        with self._lock:
+            self._sync()
+            size = self._size
+            if size == 0:
+                return None, None
+            rows = self._candidate_rows(query)
+            if rows is None:
+                matrix = self._matrix[:size]
+                scores = squared_distances(matrix, self._sq_norms[:size], query)
+                row_ids = self._ids[:size]
+            else:
+                matrix = self._matrix[rows]
+                scores = squared_distances(matrix, self._sq_norms[rows], query)
+                row_ids = self._ids[rows]
+            if exclude_id is not None:
+                scores[row_ids == int(exclude_id)] = np.inf
+            if scores.size == 0:
+                return None, None
+            best = int(np.argmin(scores))
+            if not np.isfinite(scores[best]):
+                return None, None
+            # Exact distance for the winner only, so thresholds see no cancellation error.
+            return int(row_ids[best]), exact_distance(matrix[best], query)
+
+    # ── internal helpers (caller holds the lock) ─────────────────────────────
+
+    def _store_lock(self):
+        return self._store.lock() if self._store is not None else nullcontext()
+
+    def _sync(self):
+        """Catch up with the shared store: replay unseen deltas, remapping its base when one is newer."""
+        if self._store is None:
+            return
+        generation = self._store.current_generation()
+        if generation <= 0 or generation == self._generation:
+            return
+        base = self._store.base_generation()
+        if self._generation < base:
+            # Replay up to the base first when possible: its rows then line up with ours.
+            caught_up = self._generation > 0 and self._replay(base)
+            if not self._map_base(base, reuse_rows=caught_up):
+                return
+        if not self._replay(generation):
+            # A delta was compacted away while reading; the next call starts from the new base.
+            self._generation = 0
+
+    def _map_base(self, base, reuse_rows=False):
+        """
+        Map the store's base. With ``reuse_rows`` the rows held are known to equal the
+        base, so their owner index, norms and inverted lists are kept instead of rebuilt.
+        """
+        mapped = self._store.load(base)
+        if mapped is None:
+            return False
+        self._generation, owners, templates = mapped
+        if templates.dtype != self._dtype:
+            templates = templates.astype(self._dtype)
+        size = int(owners.shape[0])
+        if not (reuse_rows and size == self._size and np.array_equal(owners, self._ids[:size])):
+            self._sq_norms = squared_norms(templates)
+            self._rows_by_id = {}
+            for row, user_id in enumerate(owners.tolist()):
+                self._rows_by_id.setdefault(user_id, []).append(row)
+            if self._index is not None:
+                self._lists = self._index.assign(templates)
+            else:
+                self._lists = np.zeros(size, dtype=np.int32)
+        self._matrix = templates
+        self._ids = owners
+        self._size = size
+        self._loaded = True
+        return True
+
+    def _replay(self, generation):
+        """Apply the store's deltas after the held generation up to ``generation``; False if one is gone."""
+        while self._generation < generation:
+            delta = self._store.read_delta(self._generation + 1)
+            if delta is None:
+                return False
+            user_id, templates = delta
+            self._make_writable()
+            self._remove(user_id)
+            if templates.shape[0]:
+                self._put(user_id, templates.astype(self._dtype))
+            self._generation += 1
+        return True
+
+    def _written_elsewhere(self):
+        """Whether another worker changed face data since this private gallery was loaded."""
+        if self._generations is None or self._store is not None:
+            return False
+        return self._generations.read() != self._seen_generation
+
+    def _announce(self):
+        """Bump the shared generation after a write; keep this copy only if no other write happened since."""
+        if self._generations is None or self._store is not None:
+            return
+        generation = self._generations.bump()
+        with self._lock:
+            if generation == self._seen_generation + 1:
+                self._seen_generation = generation
+            else:
+                self._loaded = False
+
+    def _make_writable(self):
+        """Swap a read-only mapping for a private copy before mutating it."""
+        if self._matrix.flags.writeable:
+            return
+        self._matrix = np.array(self._matrix[:self._size])
+        self._sq_norms = np.array(self._sq_norms[:self._size])
+        self._ids = np.array(self._ids[:self._size])
+        self._lists = np.array(self._lists[:self._size])
+
+    def _publish(self):
+        """Publish the private block as the store's new base and map it back."""
+        if self._store is None:
+            return
+        generation = self._store.publish(self._ids[:self._size], self._matrix[:self._size])
+        self._map_base(generation, reuse_rows=True)
+
+    def _append(self, user_id):
+        """Log ``user_id``'s rows as the store's next delta, folding the log into a base now and then."""
+        if self._store is None:
+            return
+        rows = self._rows_by_id.get(user_id, [])
+        self._generation = self._store.append(user_id, self._matrix[rows])
+        if self._store.needs_compaction(self._generation):
+            self._store.publish(self._ids[:self._size], self._matrix[:self._size], self._generation)
+            self._map_base(self._generation, reuse_rows=True)
+
+    def _candidate_rows(self, query):
+        """Rows in the probed inverted lists, or None to scan the whole gallery exactly."""
+        if self._index is None or self._size < self._min_indexed_size:
+            return None
+        probed = self._index.probe(query, self._nprobe)
+        return np.flatnonzero(np.isin(self._lists[:self._size], probed))
+
+    def _clear(self):
+        self._rows_by_id = {}
+        self._size = 0
+
+    def _put(self, user_id, matrix):
+        """Append ``matrix`` rows for a user that currently has none."""
+        count = matrix.shape[0]
+        while self._size + count > self._matrix.shape[0]:
+            self._grow()
+        start = self._size
+        stop = start + count
+        self._matrix[start:stop] = matrix
+        # Norms of the stored (possibly float16-rounded) rows, so scores stay consistent.
+        self._sq_norms[start:stop] = squared_norms(self._matrix[start:stop])
+        self._ids[start:stop] = user_id
+        if self._index is not None:
+            self._lists[start:stop] = self._index.assign(matrix)
+        self._rows_by_id[user_id] = list(range(start, stop))
+        self._size = stop
+
+    def _remove(self, user_id):
+        rows = self._rows_by_id.pop(user_id, None)
+        if not rows:
+            return
+        # Highest rows first, so the row moved into each hole never belongs to this user.
+        for row in sorted(rows, reverse=True):
+            last = self._size - 1
+            if row != last:
+                # Move the last row into the hole so the block stays contiguous.
+                moved_id = int(self._ids[last])
+                self._matrix[row] = self._matrix[last]
+                self._sq_norms[row] = self._sq_norms[last]
+                self._ids[row] = moved_id
+                self._lists[row] = self._lists[last]
+                moved_rows = self._rows_by_id[moved_id]
+                moved_rows[moved_rows.index(last)] = row
+            self._size = last
+
+    def _grow(self):
+        capacity = max(1, self._matrix.shape[0]) * 2
+        matrix = np.empty((capacity, self._dim), dtype=self._dtype)
+        sq_norms = np.empty(capacity, dtype=np.float32)
+        ids = np.empty(capacity, dtype=np.int64)
+        lists = np.empty(capacity, dtype=np.int32)
+        matrix[:self._size] = self._matrix[:self._size]
+        sq_norms[:self._size] = self._sq_norms[:self._size]
+        ids[:self._size] = self._ids[:self._size]
+        lists[:self._size] = self._lists[:self._size]
+        self._matrix = matrix
+        self._sq_norms = sq_norms
+        self._ids = ids
+        self._lists = lists
+
+
+face_gallery = FaceGallery()
@@ -0,0 +1,129 @@
+"""
+Host-wide face template store shared by all gunicorn workers.
+
+The store is a base snapshot plus a log of per-user deltas. The base is a pair of
+``.npy`` files (owner ids and templates) that every worker memory-maps read-only, so
+the host keeps one copy of the gallery in the page cache however many workers run.
+Each registration or removal appends one small ``delta-<generation>.npz`` holding the
+user's new templates (none for a removal) and bumps the generation counter; readers
+replay the deltas they have not seen instead of remapping the whole gallery. Every
+``compact_every`` deltas the writer folds the log into a new base. Files older than
+the previous base are unlinked, which is safe because existing maps keep their pages
+until they are dropped.
+"""
+import logging
+import os
+import re
+
+import numpy as np
+
+from face_matching import DESCRIPTOR_SIZE
+from worker_sync import GenerationFile
+
+logger = logging.getLogger(__name__)
+
+_GENERATION_FILE = re.compile(r"^(?:owners|templates|delta)-(\d+)\.(?:npy|npz)$")
+
+
+class SharedFaceStore:
+    """Generation-numbered, memory-mapped ``(owners, templates)`` base plus per-user deltas in one directory."""
+
+    def __init__(self, directory, compact_every=256):
+        self.directory = directory
+        self.compact_every = compact_every
+        self.generations = GenerationFile(os.path.join(directory, "generation"))
+        self.bases = GenerationFile(os.path.join(directory, "base"))
+
+    def lock(self):
+        return self.generations.lock()
+
+    def current_generation(self):
+        return self.generations.read()
+
+    def base_generation(self):
+        return self.bases.read()
+
+    def _paths(self, generation):
+        return (
+            os.path.join(self.directory, f"owners-{generation}.npy"),
+            os.path.join(self.directory, f"templates-{generation}.npy"),
+        )
+
+    def _delta_path(self, generation):
+        return os.path.join(self.directory, f"delta-{generation}.npz")
+
+    def load(self, generation=None):
+        """Map a base read-only; returns ``(generation, owners, templates)`` or None."""
+        generation = self.base_generation() if generation is None else generation
+        if generation <= 0:
+            return None
+        owners_path, templates_path = self._paths(generation)
+        try:
+            owners = np.load(owners_path, mmap_mode="r", allow_pickle=False)
+            templates = np.load(templates_path, mmap_mode="r", allow_pickle=False)
+        except (OSError, ValueError):
+            logger.exception("Shared face store base %s could not be mapped", generation)
+            return None
+        if templates.ndim != 2 or templates.shape[1] != DESCRIPTOR_SIZE or owners.shape[0] != templates.shape[0]:
+            logger.warning("Ignoring malformed shared face store base %s", generation)
+            return None
+        return generation, owners, templates
+
+    def read_delta(self, generation):
+        """Return ``(user_id, templates)`` written at ``generation``, or None once compacted away."""
+        try:
+            with np.load(self._delta_path(generation), allow_pickle=False) as delta:
+                return int(delta["user_id"]), delta["templates"].reshape(-1, DESCRIPTOR_SIZE)
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def append(self, user_id, templates):
+        """Log ``user_id``'s new templates (empty for a removal) as the next generation; callers hold ``lock()``."""
+        os.makedirs(self.directory, exist_ok=True)
+        generation = self.current_generation() + 1
+        path = self._delta_path(generation)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as handle:
+            np.savez(handle, user_id=np.int64(user_id), templates=np.asarray(templates))
+        os.replace(tmp_path, path)
+        self.generations.write(generation)
+        return generation
+
+    def needs_compaction(self, generation):
+        return generation - self.base_generation() >= self.compact_every
+
+    def publish(self, owners, templates, generation=None):
+        """
+        Write a base and make it current; callers hold ``lock()``.
+
+        Without ``generation`` the base is a new generation (a full reload); with it,
+        the base folds the deltas up to that already-current generation.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        previous = self.base_generation()
+        if generation is None:
+            generation = self.current_generation() + 1
+        # Templates keep the gallery's storage dtype (float32, or float16 for large galleries).
+        template_dtype = np.float16 if np.asarray(templates).dtype == np.float16 else np.float32
+        for path, array, dtype in zip(self._paths(generation), (owners, templates), (np.int64, template_dtype)):
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "wb") as handle:
+                np.save(handle, np.ascontiguousarray(array, dtype=dtype))
+            os.replace(tmp_path, path)
+        self.bases.write(generation)
+        self.generations.write(max(generation, self.current_generation()))
+        # Keep the previous base and its deltas for readers that are still catching up from it.
+        self._prune(previous)
+        return generation
+
+    def _prune(self, keep_from):
+        for name in os.listdir(self.directory):
+            match = _GENERATION_FILE.match(name)
+            if match is None:
+                continue
+            generation = int(match.group(1))
+            if generation < keep_from or (name.startswith("delta-") and generation <= keep_from):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
@@ -0,0 +1,200 @@
+"""
+Durable outbox for Firebase mirror writes.
+
+``enqueue_firebase_writes`` stages ``{path: value}`` writes as ``FirebaseOutbox`` rows in
+the caller's transaction, so a mirror write exists exactly when the SQLite change it
+describes commits and requests never wait on Firebase. ``OutboxFlusher`` drains the
+table from a daemon thread in id order, one multi-path ``update()`` per batch. After a
+failure the oldest row is retried alone with exponential backoff; a row that keeps
+failing is dead-lettered (``dead_at``) so the rows behind it can proceed.
+"""
+import json
+import logging
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models import FirebaseOutbox, db
+from worker_sync import file_lock
+
+logger = logging.getLogger(__name__)
+
+_PENDING_KEY = "firebase_outbox_pending"
+
+
+def _utc_now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def enqueue_firebase_writes(writes, session=None):
+    """Stage ``{path: value}`` writes in the current transaction; they are sent after it commits."""
+    session = session or db.session
+    for path, value in writes.items():
+        session.add(FirebaseOutbox(path=path.strip("/"), payload=json.dumps(value)))
+    session.info[_PENDING_KEY] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _wake_flusher_after_commit(session):
+    if session.info.pop(_PENDING_KEY, False):
+        outbox_flusher.wake()
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_rolled_back_writes(session):
+    session.info.pop(_PENDING_KEY, None)
+
+
+def _paths_overlap(path, other):
+    """A multi-path update rejects a path together with one of its ancestors."""
+    return path.startswith(other + "/") or other.startswith(path + "/")
+
+
+def pending_batch(limit):
+    """The oldest live rows, cut before the first one that overlaps an earlier path."""
+    batch = []
+    rows = (
+        FirebaseOutbox.query.filter(FirebaseOutbox.dead_at.is_(None))
+        .order_by(FirebaseOutbox.id)
+        .limit(limit)
+        .all()
+    )
+    for row in rows:
+        if any(_paths_overlap(row.path, earlier.path) for earlier in batch):
+            break
+        batch.append(row)
+    return batch
+
+
+def flush_outbox(send, batch_size=200, max_attempts=10, backoff_seconds=2, backoff_max_seconds=300, now=None):
+    """
+    Send one batch through ``send(updates)`` and delete it, or record the failure.
+
+    Returns ``(sent, wake_at)``: the number of rows delivered and when the next batch
+    is due, or ``None`` when the outbox is empty. Rows go out strictly in id order, so
+    a later write to a path never lands before an earlier one.
+    """
+    now = now or _utc_now()
+    batch = pending_batch(batch_size)
+    if not batch:
+        return 0, None
+    head = batch[0]
+    if head.next_attempt_at is not None and head.next_attempt_at > now:
+        return 0, head.next_attempt_at
+    if head.attempts:
+        # Retry the failed head alone so one bad row cannot keep failing a whole batch.
+        batch = [head]
+
+    updates = {row.path: json.loads(row.payload) if row.payload is not None else None for row in batch}
+    try:
+        send(updates)
+    except Exception as exc:
+        head.attempts += 1
+        head.last_error = str(exc)[:1000]
+        if head.attempts >= max_attempts:
+            head.dead_at = now
+            head.next_attempt_at = None
+            logger.error("Firebase outbox row %s (%s) dead-lettered after %d attempts: %s",
+                         head.id, head.path, head.attempts, exc)
+        else:
+            delay = min(backoff_seconds * 2 ** (head.attempts - 1), backoff_max_seconds)
+            head.next_attempt_at = now + timedelta(seconds=delay)
+            logger.warning("Firebase outbox write failed (attempt %d, retry in %ss): %s", head.attempts, delay, exc)
+        db.session.commit()
+        return 0, head.next_attempt_at or now
+
+    FirebaseOutbox.query.filter(FirebaseOutbox.id.in_([row.id for row in batch])).delete(synchronize_session=False)
+    db.session.commit()
+    return len(batch), now
+
+
+def requeue_dead_letters():
+    """Give every dead-lettered row a fresh set of attempts; caller commits."""
+    return FirebaseOutbox.query.filter(FirebaseOutbox.dead_at.isnot(None)).update(
+        {FirebaseOutbox.dead_at: None, FirebaseOutbox.attempts: 0, FirebaseOutbox.next_attempt_at: None},
+        synchronize_session=False,
+    )
+
+
+class OutboxFlusher:
+    """
+    One daemon thread per worker that drains the outbox.
+
+    Commits that staged writes wake it immediately; otherwise it polls every
+    ``poll_seconds`` for rows staged by other processes. A host-wide file lock keeps
+    workers from sending the same rows concurrently.
+    """
+
+    def __init__(self, poll_seconds=5):
+        self.poll_seconds = poll_seconds
+        self.app = None
+        self.send = None
+        self.options = {}
+        self._cond = threading.Condition()
+        self._woken = False
+        self._thread = None
+        self._pid = None
+        self._stopped = False
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def start(self, app, send, **options):
+        """Start draining with ``send(updates)`` once per process; ``options`` go to ``flush_outbox``."""
+        with self._cond:
+            self.app, self.send, self.options = app, send, options
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._stopped = False
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="firebase-outbox", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def wake(self):
+        with self._cond:
+            self._woken = True
+            self._cond.notify()
+
+    def _after_fork(self):
+        self._cond = threading.Condition()
+        was_running = self._thread is not None and not self._stopped
+        self._thread = None
+        if was_running:
+            self.start(self.app, self.send, **self.options)
+
+    def _run(self):
+        timeout = 0.0
+        while True:
+            with self._cond:
+                if not self._woken and timeout > 0:
+                    self._cond.wait(timeout)
+                if self._stopped:
+                    return
+                self._woken = False
+            timeout = self._flush_once()
+
+    def _flush_once(self):
+        """Flush one batch and return how long to sleep before the next."""
+        with self.app.app_context():
+            try:
+                with file_lock(os.path.join(self.app.instance_path, "firebase_outbox.lock")):
+                    sent, wake_at = flush_outbox(self.send, **self.options)
+            except Exception:
+                db.session.rollback()
+                logger.exception("Firebase outbox flush failed")
+                return self.poll_seconds
+            finally:
+                db.session.remove()
+        if sent or wake_at is None:
+            return 0.0 if sent else self.poll_seconds
+        return min(max((wake_at - _utc_now()).total_seconds(), 0.0), self.poll_seconds)
+
+
+outbox_flusher = OutboxFlusher()
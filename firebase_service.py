@@ -1,6 +1,24 @@
 import json
 import logging
-from datetime import datetime, timezone
+import os
+import secrets
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from attendance_counters import rebuild_attendance_counters
+from bulk_upsert import upsert_rows
+from face_matching import (
+    FACE_TEMPLATE_VERSION,
+    encode_template,
+    face_gallery,
+    template_from_base64,
+    template_to_base64,
+    to_face_matrix,
+)
+from firebase_outbox import enqueue_firebase_writes
+from models import SyncState, db as sql_db
+from worker_sync import file_lock
 
 try:
     import firebase_admin
@@ -87,16 +105,25 @@ def get_firebase_status(app):
 
 
 # ═══════════════════════════════════════════════════════════════════════════
-# SYNC FUNCTIONS - Sync SQLite data to Firebase
+# SYNC FUNCTIONS - Queue SQLite changes for the Firebase mirror (see firebase_outbox)
 # ═══════════════════════════════════════════════════════════════════════════
 
+def face_template_from_payload(payload):
+    """Read a binary face template from a Firebase user payload (base64 or legacy JSON list)."""
+    template = template_from_base64(payload.get('face_template'))
+    if template is not None:
+        return template
+    templates = to_face_matrix(payload.get('face_encoding'))
+    return encode_template(templates) if templates is not None else None
+
+
 def sync_user_registration(app, user):
-    """Sync user registration to Firebase"""
+    """Queue the user's Firebase mirror; call before the commit that persists the change."""
     if not firebase_enabled(app):
         return
-    try:
-        ref = db.reference(f"users/{user.id}")
-        ref.set({
+    sql_db.session.flush()
+    enqueue_firebase_writes({
+        f"users/{user.id}": {
             'id': user.id,
             'name': user.name,
             'email': user.email,
@@ -108,23 +135,23 @@ def sync_user_registration(app, user):
             'semester': user.semester or '',
             'college_id': user.college_id or '',
             'face_registered': user.face_registered,
-            'face_encoding': user.face_encoding,  # Store face encoding
+            'face_template': template_to_base64(user.face_template),  # base64 float32 face template
+            'face_template_version': user.face_template_version,
+            'face_encoding': None,  # Drop the legacy JSON encoding from the mirror
             'is_active': user.is_active,
             'registered_at': user.registered_at.isoformat() if user.registered_at else None,
             'synced_at': datetime.now(timezone.utc).isoformat()
-        })
-        logger.info(f"✅ User {user.id} synced to Firebase")
-    except Exception as exc:
-        logger.warning(f"Firebase sync_user_registration failed: {exc}")
+        }
+    })
 
 
 def sync_course_creation(app, course):
-    """Sync course creation to Firebase"""
+    """Queue the course's Firebase mirror; call before the commit that persists it."""
     if not firebase_enabled(app):
         return
-    try:
-        ref = db.reference(f"courses/{course.id}")
-        ref.set({
+    sql_db.session.flush()
+    enqueue_firebase_writes({
+        f"courses/{course.id}": {
             'id': course.id,
             'code': course.code,
             'title': course.title,
@@ -139,19 +166,17 @@ def sync_course_creation(app, course):
             'updated_at': course.updated_at.isoformat() if getattr(course, 'updated_at', None) else None,
             'created_at': course.created_at.isoformat() if course.created_at else None,
             'synced_at': datetime.now(timezone.utc).isoformat()
-        })
-        logger.info(f"✅ Course {course.id} synced to Firebase")
-    except Exception as exc:
-        logger.warning(f"Firebase sync_course_creation failed: {exc}")
+        }
+    })
 
 
 def sync_teacher_assignment(app, assignment):
-    """Sync teacher assignment to Firebase"""
+    """Queue the teacher assignment's Firebase mirror; call before the commit that persists it."""
     if not firebase_enabled(app):
         return
-    try:
-        ref = db.reference(f"teacher_assignments/{assignment.id}")
-        ref.set({
+    sql_db.session.flush()
+    enqueue_firebase_writes({
+        f"teacher_assignments/{assignment.id}": {
             'id': assignment.id,
             'teacher_id': assignment.teacher_id,
             'course_id': assignment.course_id,
@@ -160,19 +185,17 @@ def sync_teacher_assignment(app, assignment):
             'assigned_at': assignment.assigned_at.isoformat() if assignment.assigned_at else None,
             'is_active': assignment.is_active,
             'synced_at': datetime.now(timezone.utc).isoformat()
-        })
-        logger.info(f"✅ Teacher assignment {assignment.id} synced to Firebase")
-    except Exception as exc:
-        logger.warning(f"Firebase sync_teacher_assignment failed: {exc}")
+        }
+    })
 
 
 def sync_session_creation(app, session):
-    """Sync class session creation to Firebase"""
+    """Queue the class session's Firebase mirror; call before the commit that persists it."""
     if not firebase_enabled(app):
         return
-    try:
-        ref = db.reference(f"sessions/{session.id}")
-        ref.set({
+    sql_db.session.flush()
+    enqueue_firebase_writes({
+        f"sessions/{session.id}": {
             'id': session.id,
             'course_id': session.course_id,
             'course_code': session.course_code,
@@ -188,20 +211,18 @@ def sync_session_creation(app, session):
             'location_radius_meters': getattr(session, 'location_radius_meters', None),
             'created_at': session.created_at.isoformat() if session.created_at else None,
             'synced_at': datetime.now(timezone.utc).isoformat()
-        })
-        logger.info(f"✅ Session {session.id} synced to Firebase")
-    except Exception as exc:
-        logger.warning(f"Firebase sync_session_creation failed: {exc}")
+        }
+    })
 
 
 def sync_session_attendance(app, entry, session, student):
-    """Sync attendance marking to Firebase"""
+    """Queue a mark for the student's and the session's attendance lists, in the mark's transaction."""
     if not firebase_enabled(app):
         return
-    try:
-        # Sync to student's attendance record
-        ref = db.reference(f"attendance/students/{student.id}/{session.id}")
-        ref.set({
+    now = datetime.now(timezone.utc).isoformat()
+    marked_at = entry.marked_at.isoformat() if entry.marked_at else now
+    enqueue_firebase_writes({
+        f"attendance/students/{student.id}/{session.id}": {
             'studentId': student.id,
             'studentName': student.name,
             'studentEmail': student.email,
@@ -209,71 +230,73 @@ def sync_session_attendance(app, entry, session, student):
             'courseTitle': session.title,
             'sessionId': session.id,
             'room': session.room or '',
-            'markedAt': entry.marked_at.isoformat() if entry.marked_at else datetime.now(timezone.utc).isoformat(),
+            'markedAt': marked_at,
             'latitude': entry.latitude,
             'longitude': entry.longitude,
             'faceDistance': entry.face_distance,
             'deviceHash': entry.device_hash or '',
-            'synced_at': datetime.now(timezone.utc).isoformat()
-        })
-        
-        # Also sync to session's attendance list
-        session_ref = db.reference(f"attendance/sessions/{session.id}/{student.id}")
-        session_ref.set({
+            'synced_at': now
+        },
+        f"attendance/sessions/{session.id}/{student.id}": {
             'studentId': student.id,
             'studentName': student.name,
-            'markedAt': entry.marked_at.isoformat() if entry.marked_at else datetime.now(timezone.utc).isoformat(),
+            'markedAt': marked_at,
             'faceDistance': entry.face_distance,
-            'synced_at': datetime.now(timezone.utc).isoformat()
-        })
-        
-        logger.info(f"✅ Attendance synced: Student {student.id} → Session {session.id}")
-    except Exception as exc:
-        logger.warning(f"Firebase sync_session_attendance failed: {exc}")
+            'synced_at': now
+        },
+    })
+
+
+def _push_key():
+    """Time-ordered, collision-resistant child key, like the ones ``push()`` generates."""
+    return f"{time.time_ns() // 1_000_000:013d}-{secrets.token_hex(5)}"
 
 
 def sync_attendance_attempt(app, payload):
-    """Sync attendance attempt (success/failure) to Firebase"""
+    """Queue an attendance attempt (success/failure) under the day's attempt log"""
     if not firebase_enabled(app):
         return
-    try:
-        day_key = datetime.now(timezone.utc).strftime('%Y-%m-%d')
-        ref = db.reference(f"attendance_attempts/{day_key}")
-        attempt_ref = ref.push(payload)
-        logger.info(f"✅ Attendance attempt logged to Firebase: {attempt_ref.key}")
-    except Exception as exc:
-        logger.warning(f"Firebase sync_attendance_attempt failed: {exc}")
+    day_key = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+    enqueue_firebase_writes({f"attendance_attempts/{day_key}/{_push_key()}": payload})
 
 
 def sync_enrollment(app, enrollment):
-    """Sync student enrollment to Firebase"""
+    """Queue the enrollment's Firebase mirror; call before the commit that persists it."""
     if not firebase_enabled(app):
         return
-    try:
-        ref = db.reference(f"enrollments/{enrollment.student_id}/{enrollment.course_id}")
-        ref.set({
+    sql_db.session.flush()
+    enqueue_firebase_writes({
+        f"enrollments/{enrollment.student_id}/{enrollment.course_id}": {
             'enrollment_id': enrollment.id,
             'student_id': enrollment.student_id,
             'course_id': enrollment.course_id,
             'is_active': enrollment.is_active,
             'enrolled_at': enrollment.enrolled_at.isoformat() if enrollment.enrolled_at else None,
             'synced_at': datetime.now(timezone.utc).isoformat()
-        })
-        logger.info(f"✅ Enrollment synced: Student {enrollment.student_id} → Course {enrollment.course_id}")
-    except Exception as exc:
-        logger.warning(f"Firebase sync_enrollment failed: {exc}")
+        }
+    })
 
 
 def update_session_status(app, session_id, is_active):
-    """Update session active status in Firebase"""
+    """Queue a session status change; synced_at is bumped so incremental hydration picks it up."""
     if not firebase_enabled(app):
         return
-    try:
-        ref = db.reference(f"sessions/{session_id}/is_active")
-        ref.set(is_active)
-        logger.info(f"✅ Session {session_id} status updated: {is_active}")
-    except Exception as exc:
-        logger.warning(f"Firebase update_session_status failed: {exc}")
+    enqueue_firebase_writes({
+        f"sessions/{session_id}/is_active": is_active,
+        f"sessions/{session_id}/synced_at": datetime.now(timezone.utc).isoformat(),
+    })
+
+
+def sync_user_last_login(app, user):
+    """Queue the user's last login time."""
+    if not firebase_enabled(app) or user.last_login is None:
+        return
+    enqueue_firebase_writes({f"users/{user.id}/last_login": user.last_login.isoformat()})
+
+
+def send_multi_path_update(updates):
+    """Deliver one outbox batch as a single multi-path update from the database root."""
+    db.reference('/').update(updates)
 
 
 def get_live_attendance_count(app, session_id):
@@ -464,6 +487,7 @@ def sync_firebase_to_sqlite(app, user_data, db_session, User):
     """Sync Firebase user data to SQLite (create or update)"""
     try:
         user = User.query.filter_by(email=user_data['email']).first()
+        face_template = face_template_from_payload(user_data)
         
         if not user:
             # Create new user in SQLite
@@ -479,7 +503,8 @@ def sync_firebase_to_sqlite(app, user_data, db_session, User):
                 year=user_data.get('year', ''),
                 semester=user_data.get('semester', ''),
                 face_registered=user_data.get('face_registered', False),
-                face_encoding=user_data.get('face_encoding'),
+                face_template=face_template,
+                face_template_version=FACE_TEMPLATE_VERSION if face_template is not None else None,
                 is_active=user_data.get('is_active', True)
             )
             db_session.add(user)
@@ -494,10 +519,16 @@ def sync_firebase_to_sqlite(app, user_data, db_session, User):
             user.semester = user_data.get('semester', user.semester)
             user.face_registered = user_data.get('face_registered', user.face_registered)
             user.is_active = user_data.get('is_active', user.is_active)
-            if user_data.get('face_encoding'):
-                user.face_encoding = user_data['face_encoding']
+            if face_template is not None:
+                user.face_template = face_template
+                user.face_template_version = FACE_TEMPLATE_VERSION
+                user.face_encoding = None
         
         db_session.commit()
+        if not user.face_registered:
+            face_gallery.remove(user.id)
+        elif face_template is not None:
+            face_gallery.upsert(user.id, face_template)
         logger.info(f"✅ Synced Firebase user to SQLite: {user.email}")
         return user
     except Exception as exc:
@@ -506,155 +537,349 @@ def sync_firebase_to_sqlite(app, user_data, db_session, User):
         return None
 
 
-def sync_reference_data_to_sqlite(app, db_session, User, Course, TeacherAssignment, Enrollment, ClassSession):
-    """Hydrate SQLite from Firebase for ephemeral deployments like Render."""
-    if not firebase_enabled(app):
-        return
+# ═══════════════════════════════════════════════════════════════════════════
+# HYDRATION - Bulk, incremental Firebase → SQLite copy of reference data
+# ═══════════════════════════════════════════════════════════════════════════
+
+HYDRATION_STATE_KEY = "firebase_hydration.{path}.synced_at"
+# Re-read records this far behind the stored watermark to absorb clock skew between
+# the app servers that stamp synced_at.
+HYDRATION_WATERMARK_OVERLAP = timedelta(minutes=5)
+_USER_ROLES = ('student', 'teacher', 'admin')
 
-    def _parse_dt(value):
-        if not value:
-            return None
-        try:
-            return datetime.fromisoformat(str(value).replace('Z', '+00:00'))
-        except Exception:
-            return None
 
+def _parse_dt(value):
+    if not value:
+        return None
     try:
-        users_data = db.reference('users').get() or {}
-        for user_id, payload in users_data.items():
-            payload = payload or {}
-            existing = db_session.get(User, int(user_id))
-            if not existing:
-                existing = User(
-                    id=int(user_id),
-                    name=payload.get('name', 'Unknown'),
-                    email=payload.get('email', f'{user_id}@invalid.local'),
-                    department=payload.get('department', '') or 'General',
-                    password_hash=payload.get('password_hash', ''),
-                )
-                db_session.add(existing)
-            existing.name = payload.get('name', existing.name)
-            existing.email = payload.get('email', existing.email)
-            if payload.get('password_hash'):
-                existing.password_hash = payload.get('password_hash')
-            existing.role = payload.get('role', existing.role)
-            existing.department = payload.get('department', existing.department)
-            existing.college_id = payload.get('college_id', existing.college_id)
-            existing.section = payload.get('section', existing.section)
-            existing.year = payload.get('year', existing.year)
-            existing.semester = payload.get('semester', existing.semester)
-            existing.face_registered = payload.get('face_registered', existing.face_registered)
-            if payload.get('face_encoding'):
-                existing.face_encoding = payload.get('face_encoding')
-            existing.is_active = payload.get('is_active', existing.is_active)
-
-        courses_data = db.reference('courses').get() or {}
-        for course_id, payload in courses_data.items():
-            payload = payload or {}
-            existing = db_session.get(Course, int(course_id))
-            if not existing:
-                existing = Course(
-                    id=int(course_id),
-                    code=payload.get('code', f'COURSE-{course_id}'),
-                    title=payload.get('title', 'Untitled Course'),
-                    department=payload.get('department', 'General'),
-                    academic_year=payload.get('academic_year', 'N/A'),
-                    semester=payload.get('semester', 'N/A'),
-                )
-                db_session.add(existing)
-            existing.code = payload.get('code', existing.code)
-            existing.title = payload.get('title', existing.title)
-            existing.department = payload.get('department', existing.department)
-            existing.academic_year = payload.get('academic_year', existing.academic_year)
-            existing.semester = payload.get('semester', existing.semester)
-            existing.credits = payload.get('credits', existing.credits or 3)
-            existing.teacher_id = payload.get('teacher_id', existing.teacher_id)
-            existing.created_by_admin_id = payload.get('created_by_admin_id', getattr(existing, 'created_by_admin_id', None))
-            existing.is_active = payload.get('is_active', existing.is_active)
-            created_at = _parse_dt(payload.get('created_at'))
-            if created_at:
-                existing.created_at = created_at
-
-        assignments_data = db.reference('teacher_assignments').get() or {}
-        for assignment_id, payload in assignments_data.items():
-            payload = payload or {}
-            existing = db_session.get(TeacherAssignment, int(assignment_id))
-            if not existing:
-                existing = TeacherAssignment(
-                    id=int(assignment_id),
-                    teacher_id=payload.get('teacher_id'),
-                    course_id=payload.get('course_id'),
-                    section=payload.get('section', ''),
-                )
-                db_session.add(existing)
-            existing.teacher_id = payload.get('teacher_id', existing.teacher_id)
-            existing.course_id = payload.get('course_id', existing.course_id)
-            existing.section = payload.get('section', existing.section)
-            existing.assigned_by_admin_id = payload.get('assigned_by_admin_id', existing.assigned_by_admin_id)
-            existing.is_active = payload.get('is_active', existing.is_active)
-            assigned_at = _parse_dt(payload.get('assigned_at'))
-            if assigned_at:
-                existing.assigned_at = assigned_at
-
-        enrollments_data = db.reference('enrollments').get() or {}
-        for student_id, course_map in enrollments_data.items():
-            for course_id, payload in (course_map or {}).items():
-                payload = payload or {}
-                existing = None
-                if payload.get('enrollment_id'):
-                    existing = db_session.get(Enrollment, int(payload['enrollment_id']))
-                if not existing:
-                    existing = Enrollment.query.filter_by(student_id=int(student_id), course_id=int(course_id)).first()
-                if not existing:
-                    existing = Enrollment(
-                        id=int(payload['enrollment_id']) if payload.get('enrollment_id') else None,
-                        student_id=int(student_id),
-                        course_id=int(course_id),
-                    )
-                    db_session.add(existing)
-                existing.student_id = int(student_id)
-                existing.course_id = int(course_id)
-                existing.is_active = payload.get('is_active', existing.is_active)
-                enrolled_at = _parse_dt(payload.get('enrolled_at'))
-                if enrolled_at:
-                    existing.enrolled_at = enrolled_at
-
-        sessions_data = db.reference('sessions').get() or {}
-        for session_id, payload in sessions_data.items():
+        return datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except Exception:
+        return None
+
+
+def _as_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _record_items(data):
+    """Key/payload pairs of a Firebase snapshot; numeric keys may come back as a list."""
+    if isinstance(data, list):
+        return [(str(key), payload) for key, payload in enumerate(data) if payload is not None]
+    return list((data or {}).items())
+
+
+def _changed_record_pages(path, since, page_size):
+    """
+    Yield pages of ``(key, payload)`` from ``path`` whose ``synced_at`` >= ``since``.
+
+    Without a watermark the whole tree is read once. Otherwise records are read with an
+    ordered, bounded ``synced_at`` query, which needs ``".indexOn": "synced_at"`` in the
+    database rules; without the index the tree is read whole and filtered here.
+    """
+    if since is None:
+        yield _record_items(db.reference(path).get())
+        return
+    start = since
+    try:
+        while True:
+            page = _record_items(
+                db.reference(path).order_by_child('synced_at').start_at(start).limit_to_first(page_size).get()
+            )
+            if page:
+                yield page
+            if len(page) < page_size:
+                return
+            last = (page[-1][1] or {}).get('synced_at')
+            if last == start:
+                # A full page shares one synced_at value: read all of them, then step past it.
+                yield _record_items(db.reference(path).order_by_child('synced_at').equal_to(start).get())
+                start = start + '\x00'
+            else:
+                start = last
+    except Exception as exc:
+        logger.warning(f"Firebase ordered query on {path} failed ({exc}); reading the whole tree")
+        yield [
+            (key, payload)
+            for key, payload in _record_items(db.reference(path).get())
+            if str((payload or {}).get('synced_at') or '') >= since
+        ]
+
+
+def _user_row(user_id, payload):
+    face_template = face_template_from_payload(payload)
+    email = payload.get('email')
+    role = payload.get('role')
+    return {
+        'id': user_id,
+        'name': payload.get('name'),
+        'email': email.lower().strip() if email else None,
+        'password_hash': payload.get('password_hash') or None,
+        'role': role if role in _USER_ROLES else None,
+        'department': payload.get('department'),
+        'college_id': payload.get('college_id'),
+        'section': payload.get('section'),
+        'year': payload.get('year'),
+        'semester': payload.get('semester'),
+        'face_registered': payload.get('face_registered'),
+        'face_template': face_template,
+        'face_template_version': FACE_TEMPLATE_VERSION if face_template is not None else None,
+        'is_active': payload.get('is_active'),
+    }
+
+
+def _course_row(course_id, payload):
+    return {
+        'id': course_id,
+        'code': payload.get('code'),
+        'title': payload.get('title'),
+        'department': payload.get('department'),
+        'academic_year': payload.get('academic_year'),
+        'semester': payload.get('semester'),
+        'credits': payload.get('credits'),
+        'teacher_id': payload.get('teacher_id'),
+        'created_by_admin_id': payload.get('created_by_admin_id'),
+        'is_active': payload.get('is_active'),
+        'created_at': _parse_dt(payload.get('created_at')),
+    }
+
+
+def _assignment_row(assignment_id, payload):
+    return {
+        'id': assignment_id,
+        'teacher_id': payload.get('teacher_id'),
+        'course_id': payload.get('course_id'),
+        'section': payload.get('section'),
+        'assigned_by_admin_id': payload.get('assigned_by_admin_id'),
+        'is_active': payload.get('is_active'),
+        'assigned_at': _parse_dt(payload.get('assigned_at')),
+    }
+
+
+def _session_row(session_id, payload):
+    return {
+        'id': session_id,
+        'title': payload.get('title'),
+        'course_code': payload.get('course_code'),
+        'room': payload.get('room'),
+        'course_id': payload.get('course_id'),
+        'section': payload.get('section'),
+        'teacher_id': payload.get('teacher_id'),
+        'is_active': payload.get('is_active'),
+        'starts_at': _parse_dt(payload.get('starts_at')),
+        'ends_at': _parse_dt(payload.get('ends_at')),
+        'location_lat': payload.get('location_lat'),
+        'location_lng': payload.get('location_lng'),
+        'location_radius_meters': payload.get('location_radius_meters'),
+    }
+
+
+def _enrollment_row(student_id, course_id, payload):
+    return {
+        'id': _as_int(payload.get('enrollment_id')),
+        'student_id': student_id,
+        'course_id': course_id,
+        'is_active': payload.get('is_active'),
+        'enrolled_at': _parse_dt(payload.get('enrolled_at')),
+    }
+
+
+def _utc_now(row):
+    return datetime.now(timezone.utc)
+
+
+# Values for NOT NULL or defaulted columns when a partial payload creates a new row.
+_NEW_ROW_DEFAULTS = {
+    'users': {
+        'name': 'Unknown',
+        'email': lambda row: f"{row['id']}@invalid.local",
+        'department': 'General',
+        'password_hash': '',
+        'role': 'student',
+        'face_registered': False,
+        'is_active': True,
+    },
+    'courses': {
+        'code': lambda row: f"COURSE-{row['id']}",
+        'title': 'Untitled Course',
+        'department': 'General',
+        'academic_year': 'N/A',
+        'semester': 'N/A',
+        'credits': 3,
+        'is_active': True,
+        'created_at': _utc_now,
+    },
+    'teacher_assignments': {'section': '', 'is_active': True, 'assigned_at': _utc_now},
+    'sessions': {
+        'title': 'Untitled Session',
+        'course_code': '',
+        'room': '',
+        'starts_at': _utc_now,
+        'ends_at': _utc_now,
+        'is_active': True,
+        'location_radius_meters': 50,
+    },
+    'enrollments': {'is_active': True, 'enrolled_at': _utc_now},
+}
+
+
+def _hydration_since(path):
+    watermark = SyncState.get_value(HYDRATION_STATE_KEY.format(path=path))
+    stamp = _parse_dt(watermark)
+    if stamp is None:
+        return None
+    return (stamp - HYDRATION_WATERMARK_OVERLAP).isoformat()
+
+
+def _changed_enrollment_rows(since):
+    """Enrollments are nested per student, so they are read whole and filtered on synced_at."""
+    rows = []
+    newest = None
+    for student_key, course_map in _record_items(db.reference('enrollments').get()):
+        student_id = _as_int(student_key)
+        if student_id is None:
+            continue
+        for course_key, payload in _record_items(course_map):
             payload = payload or {}
-            existing = db_session.get(ClassSession, int(session_id))
-            if not existing:
-                existing = ClassSession(
-                    id=int(session_id),
-                    title=payload.get('title', 'Untitled Session'),
-                    course_code=payload.get('course_code', ''),
-                    room=payload.get('room', ''),
-                    starts_at=_parse_dt(payload.get('starts_at')) or datetime.now(timezone.utc),
-                    ends_at=_parse_dt(payload.get('ends_at')) or datetime.now(timezone.utc),
-                    teacher_id=payload.get('teacher_id'),
+            course_id = _as_int(course_key)
+            synced_at = payload.get('synced_at') or ''
+            if course_id is None or (since is not None and synced_at < since):
+                continue
+            rows.append(_enrollment_row(student_id, course_id, payload))
+            newest = max(newest or '', synced_at) or newest
+    return rows, newest
+
+
+def _apply_face_updates(db_session, User, face_updates):
+    """Mirror hydrated face templates into the in-memory gallery without loading templates back."""
+    user_ids = list(face_updates)
+    for start in range(0, len(user_ids), 500):
+        chunk = user_ids[start:start + 500]
+        registered = dict(db_session.query(User.id, User.face_registered).filter(User.id.in_(chunk)))
+        for user_id in chunk:
+            if not registered.get(user_id):
+                face_gallery.remove(user_id)
+            elif face_updates[user_id] is not None:
+                face_gallery.upsert(user_id, face_updates[user_id])
+
+
+def sync_reference_data_to_sqlite(app, db_session, User, Course, TeacherAssignment, Enrollment, ClassSession):
+    """
+    Hydrate SQLite from Firebase for ephemeral deployments like Render.
+
+    Each tree is written with chunked bulk upserts. Its newest ``synced_at`` is stored in
+    ``SyncState``, and later runs only pull records changed since then. Returns
+    ``{tree: records written}``, or ``None`` when Firebase is off or the sync failed.
+    """
+    if not firebase_enabled(app):
+        return None
+
+    page_size = app.config.get('FIREBASE_HYDRATION_PAGE_SIZE', 1000)
+    trees = (
+        ('users', User, _user_row),
+        ('courses', Course, _course_row),
+        ('teacher_assignments', TeacherAssignment, _assignment_row),
+        ('sessions', ClassSession, _session_row),
+    )
+    counts = {}
+    watermarks = {}
+    face_updates = {}
+    try:
+        for path, model, build_row in trees:
+            counts[path] = 0
+            for page in _changed_record_pages(path, _hydration_since(path), page_size):
+                rows = []
+                for key, payload in page:
+                    record_id = _as_int(key)
+                    if record_id is None:
+                        continue
+                    payload = payload or {}
+                    rows.append(build_row(record_id, payload))
+                    watermarks[path] = max(watermarks.get(path, ''), payload.get('synced_at') or '')
+                if not rows:
+                    continue
+                counts[path] += upsert_rows(db_session, model, rows, defaults=_NEW_ROW_DEFAULTS[path])
+                if model is User:
+                    with_template = [row['id'] for row in rows if row['face_template'] is not None]
+                    if with_template:
+                        db_session.query(User).filter(
+                            User.id.in_(with_template), User.face_encoding.isnot(None)
+                        ).update({User.face_encoding: None}, synchronize_session=False)
+                    face_updates.update((row['id'], row['face_template']) for row in rows)
+                db_session.commit()
+
+        rows, watermarks['enrollments'] = _changed_enrollment_rows(_hydration_since('enrollments'))
+        keyed = [row for row in rows if row['id'] is not None]
+        unkeyed = [{name: value for name, value in row.items() if name != 'id'} for row in rows if row['id'] is None]
+        counts['enrollments'] = 0
+        for batch in (keyed, unkeyed):
+            if batch:
+                counts['enrollments'] += upsert_rows(
+                    db_session,
+                    Enrollment,
+                    batch,
+                    key_columns=('course_id', 'student_id'),
+                    defaults=_NEW_ROW_DEFAULTS['enrollments'],
+                    insert_only_columns=('id',),
                 )
-                db_session.add(existing)
-            existing.course_id = payload.get('course_id', existing.course_id)
-            existing.course_code = payload.get('course_code', existing.course_code)
-            existing.title = payload.get('title', existing.title)
-            existing.room = payload.get('room', existing.room)
-            existing.section = payload.get('section', getattr(existing, 'section', None))
-            existing.teacher_id = payload.get('teacher_id', existing.teacher_id)
-            existing.is_active = payload.get('is_active', existing.is_active)
-            starts_at = _parse_dt(payload.get('starts_at'))
-            ends_at = _parse_dt(payload.get('ends_at'))
-            if starts_at:
-                existing.starts_at = starts_at
-            if ends_at:
-                existing.ends_at = ends_at
-            existing.location_lat = payload.get('location_lat', existing.location_lat)
-            existing.location_lng = payload.get('location_lng', existing.location_lng)
-            if payload.get('location_radius_meters') is not None:
-                existing.location_radius_meters = payload.get('location_radius_meters')
 
+        # Hydrated sessions and enrollments bypass the incremental counter updates.
+        if counts['sessions'] or counts['enrollments']:
+            db_session.flush()
+            rebuild_attendance_counters()
+        for path, newest in watermarks.items():
+            if newest:
+                SyncState.set_value(HYDRATION_STATE_KEY.format(path=path), newest)
         db_session.commit()
-        logger.info("✅ Firebase reference data synced to SQLite")
+        _apply_face_updates(db_session, User, face_updates)
+        logger.info(
+            "✅ Firebase reference data synced to SQLite: "
+            + ", ".join(f"{path}={written}" for path, written in counts.items())
+        )
+        return counts
     except Exception as exc:
         db_session.rollback()
         logger.error(f"Firebase sync_reference_data_to_sqlite failed: {exc}")
+        return None
+
+
+def hydration_ready(app):
+    """True once the startup Firebase → SQLite hydration has finished (or was not needed)."""
+    return bool(app.extensions.get('firebase_hydration_ready', True))
 
+
+def run_reference_hydration(app, db_session, *models, on_complete=None):
+    """Hydrate under a host-wide lock so gunicorn workers take turns, then flag readiness."""
+    if not firebase_enabled(app):
+        return
+    app.extensions['firebase_hydration_ready'] = False
+    try:
+        with file_lock(os.path.join(app.instance_path, 'firebase_hydration.lock')):
+            sync_reference_data_to_sqlite(app, db_session, *models)
+        if on_complete is not None:
+            on_complete()
+    except Exception:
+        db_session.rollback()
+        logger.exception("Firebase reference hydration failed")
+    finally:
+        app.extensions['firebase_hydration_ready'] = True
+
+
+def start_reference_hydration(app, db_session, *models, on_complete=None):
+    """Run ``run_reference_hydration`` in a daemon thread so worker boot does not wait on Firebase."""
+    if not firebase_enabled(app):
+        return None
+    app.extensions['firebase_hydration_ready'] = False
+
+    def run():
+        with app.app_context():
+            try:
+                run_reference_hydration(app, db_session, *models, on_complete=on_complete)
+            finally:
+                db_session.remove()
+
+    thread = threading.Thread(target=run, name="firebase-hydration", daemon=True)
+    thread.start()
+    return thread
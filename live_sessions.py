@@ -0,0 +1,522 @@
+"""
+In-process state for live class sessions.
+
+A ``SessionContext`` holds what the attendance routes need for one session — the
+enrolled students, their face templates as one matrix, the classroom geofence and the
+students already marked — so it is prepared once when the session goes live rather
+than on every mark. ``LiveSessionRegistry`` indexes the live sessions by course so
+student polls resolve theirs without SQL. ``SessionExpiryScheduler`` closes sessions at
+their deadline from a background thread so request handlers never sweep for expired
+sessions.
+"""
+import heapq
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timezone
+
+import numpy as np
+
+from face_matching import (
+    DESCRIPTOR_SIZE,
+    min_distance,
+    squared_norms,
+    to_face_matrix,
+)
+from models import ClassSession, Enrollment, SessionAttendance, User, db
+from worker_sync import GenerationFile
+
+logger = logging.getLogger(__name__)
+
+
+class SessionContext:
+    """Pre-built matching and validation state for one class session."""
+
+    def __init__(
+        self,
+        session_id,
+        course_id,
+        enrolled_ids,
+        student_ids,
+        matrix,
+        location_lat=None,
+        location_lng=None,
+        location_radius_meters=None,
+        marked_ids=(),
+    ):
+        self.session_id = session_id
+        self.course_id = course_id
+        self.enrolled_ids = frozenset(enrolled_ids)
+        # One row per template; a student with K templates owns K consecutive rows.
+        self.student_ids = np.asarray(student_ids, dtype=np.int64)
+        self.matrix = np.asarray(matrix, dtype=np.float32).reshape(-1, DESCRIPTOR_SIZE)
+        self.sq_norms = squared_norms(self.matrix)
+        self.rows_by_student = {}
+        for row, student_id in enumerate(self.student_ids.tolist()):
+            start, _ = self.rows_by_student.get(student_id, (row, row))
+            self.rows_by_student[student_id] = (start, row + 1)
+        # Same attribute names as ClassSession so geofence checks accept either object.
+        self.location_lat = location_lat
+        self.location_lng = location_lng
+        self.location_radius_meters = location_radius_meters
+        self._marked_lock = threading.Lock()
+        self._marked_ids = set(marked_ids)
+        self.built_at = time.monotonic()
+
+    @classmethod
+    def from_rows(cls, session_id, rows, course_id=None, enrolled_ids=None, **geofence):
+        """Build from ``(student_id, face_template)`` rows, skipping unreadable templates."""
+        student_ids = []
+        blocks = []
+        for student_id, template in rows:
+            templates = to_face_matrix(template)
+            if templates is None:
+                continue
+            student_ids.extend([student_id] * templates.shape[0])
+            blocks.append(templates)
+        matrix = np.concatenate(blocks) if blocks else np.empty((0, DESCRIPTOR_SIZE), dtype=np.float32)
+        if enrolled_ids is None:
+            enrolled_ids = set(student_ids)
+        return cls(session_id, course_id, enrolled_ids, student_ids, matrix, **geofence)
+
+    def __len__(self):
+        return int(self.student_ids.shape[0])
+
+    def is_enrolled(self, student_id):
+        return student_id in self.enrolled_ids
+
+    def is_marked(self, student_id):
+        with self._marked_lock:
+            return student_id in self._marked_ids
+
+    def add_marked(self, student_ids):
+        with self._marked_lock:
+            self._marked_ids.update(student_ids)
+
+    def templates_for(self, student_id):
+        """Return the cached (K x 128) templates of an enrolled student, or None if they have none."""
+        rows = self.rows_by_student.get(student_id)
+        return None if rows is None else self.matrix[rows[0]:rows[1]]
+
+    def distance_to(self, student_id, vector):
+        """Best-of-K distance between a scan and one student's cached templates, or None."""
+        rows = self.rows_by_student.get(student_id)
+        if rows is None:
+            return None
+        start, stop = rows
+        return min_distance(self.matrix[start:stop], vector, self.sq_norms[start:stop])
+
+    def nearest_many(self, vectors):
+        """
+        Match a batch of descriptors in one pass.
+
+        Returns ``(student_ids, distances)`` arrays aligned with ``vectors``; ids are -1
+        and distances inf when the gallery is empty.
+        """
+        queries = np.asarray(vectors, dtype=np.float32).reshape(-1, DESCRIPTOR_SIZE)
+        count = queries.shape[0]
+        if len(self) == 0 or count == 0:
+            return np.full(count, -1, dtype=np.int64), np.full(count, np.inf, dtype=np.float32)
+        # ||q - t||^2 = ||q||^2 + ||t||^2 - 2 q.t for every (query, template) pair at once.
+        scores = self.sq_norms[None, :] - 2.0 * (queries @ self.matrix.T)
+        best = np.argmin(scores, axis=1)
+        # Exact distances for the winners only, so thresholds see no cancellation error.
+        distances = np.linalg.norm(self.matrix[best] - queries, axis=1)
+        return self.student_ids[best], distances
+
+
+def build_session_context(session, default_radius=None):
+    """Load enrollments, face templates, geofence and marks for ``session`` in three queries."""
+    enrolled_ids = [
+        student_id
+        for (student_id,) in db.session.query(Enrollment.student_id).filter(
+            Enrollment.course_id == session.course_id
+        )
+    ]
+    rows = (
+        db.session.query(User.id, User.face_template)
+        .join(Enrollment, Enrollment.student_id == User.id)
+        .filter(
+            Enrollment.course_id == session.course_id,
+            User.role == "student",
+            User.face_registered.is_(True),
+            User.face_template.isnot(None),
+        )
+        .all()
+    )
+    marked_ids = [
+        student_id
+        for (student_id,) in db.session.query(SessionAttendance.student_id).filter(
+            SessionAttendance.session_id == session.id
+        )
+    ]
+    return SessionContext.from_rows(
+        session.id,
+        rows,
+        course_id=session.course_id,
+        enrolled_ids=enrolled_ids,
+        location_lat=session.location_lat,
+        location_lng=session.location_lng,
+        location_radius_meters=session.location_radius_meters or default_radius,
+        marked_ids=marked_ids,
+    )
+
+
+class SessionContextCache:
+    """
+    Session id -> ``SessionContext`` with a short TTL.
+
+    Enrollment and face-template writes call ``evict_course``/``evict_student`` after
+    committing, which drops the affected contexts here and bumps a shared
+    ``GenerationFile`` so other workers drop theirs on their next read. Closing or
+    expiring a session evicts its context immediately; the TTL only bounds staleness
+    from writers that bypass the cache (CLI commands, Firebase hydration).
+    """
+
+    def __init__(self, ttl_seconds=60):
+        self.ttl_seconds = ttl_seconds
+        self.generations = None
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._contexts = {}
+
+    def attach(self, generation_path):
+        """Share evictions with the other workers through ``generation_path``."""
+        self.generations = GenerationFile(generation_path)
+
+    def _read_generation(self):
+        return self.generations.read() if self.generations is not None else self._generation
+
+    def get(self, session_id, builder):
+        """Return the cached context for ``session_id``, calling ``builder()`` when missing or stale."""
+        generation = self._read_generation()
+        with self._lock:
+            if generation != self._generation:
+                self._generation = generation
+                self._contexts.clear()
+            context = self._contexts.get(session_id)
+        if context is not None and time.monotonic() - context.built_at < self.ttl_seconds:
+            return context
+        context = builder()
+        with self._lock:
+            self._prune_stale()
+            if self._generation == generation:
+                self._contexts[session_id] = context
+        return context
+
+    def put(self, context):
+        with self._lock:
+            self._contexts[context.session_id] = context
+
+    def warm(self, session, default_radius=None):
+        """Build and cache the context for a session that just went live; failures are only logged."""
+        try:
+            self.put(build_session_context(session, default_radius))
+        except Exception:
+            logger.exception("Could not pre-warm context for session %s", session.id)
+
+    def evict(self, session_id):
+        with self._lock:
+            self._contexts.pop(session_id, None)
+
+    def evict_course(self, course_id):
+        """Drop the contexts of ``course_id``'s sessions after its enrollments changed."""
+        self._evict_where(lambda context: context.course_id == course_id)
+
+    def evict_student(self, student_id):
+        """Drop the contexts that enroll ``student_id`` after their face templates changed."""
+        self._evict_where(lambda context: context.is_enrolled(student_id))
+
+    def _evict_where(self, predicate):
+        with self._lock:
+            for session_id in [session_id for session_id, context in self._contexts.items() if predicate(context)]:
+                del self._contexts[session_id]
+        self._publish()
+
+    def _publish(self):
+        """Bump the shared generation; keep the local contexts only if no other worker evicted meanwhile."""
+        if self.generations is None:
+            # Still advance locally so a context built before the eviction is not cached.
+            with self._lock:
+                self._generation += 1
+            return
+        generation = self.generations.bump()
+        with self._lock:
+            if generation != self._generation + 1:
+                self._contexts.clear()
+            self._generation = generation
+
+    def clear(self):
+        with self._lock:
+            self._contexts.clear()
+
+    def _prune_stale(self):
+        """Drop contexts past their TTL so sessions that never close don't accumulate (lock held)."""
+        now = time.monotonic()
+        for session_id in [
+            session_id
+            for session_id, context in self._contexts.items()
+            if now - context.built_at >= self.ttl_seconds
+        ]:
+            del self._contexts[session_id]
+
+
+session_contexts = SessionContextCache()
+
+
+LiveSession = namedtuple(
+    "LiveSession", "id course_id title course_code room section starts_at ends_at is_active"
+)
+_LIVE_SESSION_COLUMNS = [getattr(ClassSession, name) for name in LiveSession._fields]
+
+
+def live_session_snapshot(session):
+    """Detached, immutable copy of the ``ClassSession`` columns student views read."""
+    return LiveSession(*(getattr(session, name) for name in LiveSession._fields))
+
+
+class LiveSessionRegistry:
+    """
+    Course id -> active sessions, plus each polling student's enrolled courses.
+
+    A student's live sessions are the intersection of the two, filtered by time in
+    memory. Starting, closing or expiring a session updates the local index and bumps a
+    shared ``GenerationFile``; enrollment changes call ``invalidate()``. Other workers
+    see the new generation on their next read and reload, and ``ttl_seconds`` bounds
+    staleness from writers that bypass the registry (CLI commands, Firebase hydration).
+    """
+
+    def __init__(self, ttl_seconds=60, enrollment_ttl_seconds=300):
+        self.ttl_seconds = ttl_seconds
+        self.enrollment_ttl_seconds = enrollment_ttl_seconds
+        self.generations = None
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._by_course = None
+        self._loaded_at = 0.0
+        self._enrollments = {}  # student_id -> (loaded_at, {course_id: is_active})
+
+    def attach(self, generation_path):
+        """Share invalidations with the other workers through ``generation_path``."""
+        self.generations = GenerationFile(generation_path)
+
+    def _read_generation(self):
+        return self.generations.read() if self.generations is not None else self._generation
+
+    def _sync_generation(self, generation):
+        """Drop everything cached under an older generation (lock held)."""
+        if generation != self._generation:
+            self._generation = generation
+            self._by_course = None
+            self._enrollments.clear()
+
+    def _publish(self):
+        """Bump the shared generation; keep the local index only if no other worker changed it meanwhile."""
+        if self.generations is None:
+            return
+        generation = self.generations.bump()
+        with self._lock:
+            if generation == self._generation + 1:
+                self._generation = generation
+            else:
+                self._sync_generation(generation)
+
+    def _sessions_by_course(self, generation):
+        with self._lock:
+            self._sync_generation(generation)
+            if self._by_course is not None and time.monotonic() - self._loaded_at < self.ttl_seconds:
+                return self._by_course
+        by_course = {}
+        for row in db.session.query(*_LIVE_SESSION_COLUMNS).filter(ClassSession.is_active.is_(True)):
+            by_course.setdefault(row.course_id, {})[row.id] = LiveSession(*row)
+        with self._lock:
+            if self._generation == generation:
+                self._by_course = by_course
+                self._loaded_at = time.monotonic()
+                self._prune_enrollments()
+        return by_course
+
+    def _enrolled_courses(self, student_id, generation):
+        with self._lock:
+            cached = self._enrollments.get(student_id)
+            if cached is not None and time.monotonic() - cached[0] < self.enrollment_ttl_seconds:
+                return cached[1]
+        courses = dict(
+            db.session.query(Enrollment.course_id, Enrollment.is_active).filter(Enrollment.student_id == student_id)
+        )
+        with self._lock:
+            if self._generation == generation:
+                self._enrollments[student_id] = (time.monotonic(), courses)
+        return courses
+
+    def sessions_for_student(self, student_id, now, active_enrollments_only=False):
+        """Live sessions of the student's courses at ``now`` (naive UTC), soonest ending first."""
+        generation = self._read_generation()
+        by_course = self._sessions_by_course(generation)
+        courses = self._enrolled_courses(student_id, generation)
+        course_ids = {
+            course_id for course_id, is_active in courses.items() if is_active or not active_enrollments_only
+        }
+        sessions = [
+            session
+            for course_id in course_ids & by_course.keys()
+            for session in by_course[course_id].values()
+            if session.starts_at <= now <= session.ends_at
+        ]
+        return sorted(sessions, key=lambda session: session.ends_at)
+
+    def add(self, session):
+        """Index a session that just went live, here and (via the generation) in other workers."""
+        with self._lock:
+            if self._by_course is not None:
+                # Copy on write: readers iterate the index outside the lock.
+                sessions = dict(self._by_course.get(session.course_id, {}))
+                sessions[session.id] = live_session_snapshot(session)
+                self._by_course = {**self._by_course, session.course_id: sessions}
+        self._publish()
+
+    def remove(self, session_ids):
+        """Drop closed or expired sessions."""
+        session_ids = set(session_ids)
+        with self._lock:
+            if self._by_course is not None:
+                self._by_course = {
+                    course_id: {session_id: session for session_id, session in sessions.items() if session_id not in session_ids}
+                    for course_id, sessions in self._by_course.items()
+                }
+        self._publish()
+
+    def invalidate(self):
+        """Reload sessions and enrollments on the next read in every worker."""
+        with self._lock:
+            self._by_course = None
+            self._enrollments.clear()
+        self._publish()
+
+    def _prune_enrollments(self):
+        """Forget students who stopped polling so the cache does not grow without bound (lock held)."""
+        now = time.monotonic()
+        for student_id in [
+            student_id
+            for student_id, (loaded_at, _) in self._enrollments.items()
+            if now - loaded_at >= self.enrollment_ttl_seconds
+        ]:
+            del self._enrollments[student_id]
+
+
+live_session_registry = LiveSessionRegistry()
+
+
+def _utc_now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class SessionExpiryScheduler:
+    """
+    Min-heap of session deadlines (start and end times) served by one daemon thread.
+
+    The thread sleeps until the earliest deadline, then calls ``on_due(now)``, which
+    closes expired sessions and counts started ones in the database. Because ``on_due``
+    sweeps by time, a deadline only decides *when* to wake: sessions closed early need
+    no cleanup, and a periodic fallback wake covers sessions created by other processes.
+    """
+
+    def __init__(self, on_due=None, fallback_seconds=300):
+        self.on_due = on_due
+        self.fallback_seconds = fallback_seconds
+        self._heap = []
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pid = None
+        self._stopped = False
+        if hasattr(os, "register_at_fork"):
+            # Threads do not survive fork: gunicorn workers restart their own timer.
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def __len__(self):
+        with self._cond:
+            return len(self._heap)
+
+    def schedule(self, when, session_id):
+        """Wake at ``when`` (naive UTC) for ``session_id``."""
+        if when is None:
+            return
+        with self._cond:
+            heapq.heappush(self._heap, (when, session_id))
+            self._cond.notify()
+
+    def schedule_session(self, session):
+        """Queue the deadlines still ahead for ``session``: its start if uncounted, its end if active."""
+        if not getattr(session, "is_counted", True):
+            self.schedule(session.starts_at, session.id)
+        if session.is_active:
+            self.schedule(session.ends_at, session.id)
+
+    def cancel(self, session_id):
+        """Drop pending deadlines of a session closed early."""
+        with self._cond:
+            self._heap = [entry for entry in self._heap if entry[1] != session_id]
+            heapq.heapify(self._heap)
+
+    def next_deadline(self):
+        with self._cond:
+            return self._heap[0][0] if self._heap else None
+
+    def start(self):
+        """Start the timer thread once per process."""
+        with self._cond:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._stopped = False
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="session-expiry", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def pop_due(self, now):
+        """Remove and return every deadline at or before ``now``."""
+        due = []
+        with self._cond:
+            while self._heap and self._heap[0][0] <= now:
+                due.append(heapq.heappop(self._heap))
+        return due
+
+    def _after_fork(self):
+        self._cond = threading.Condition()
+        was_running = self._thread is not None and not self._stopped
+        self._thread = None
+        if was_running:
+            self.start()
+
+    def _run(self):
+        next_fallback = time.monotonic() + self.fallback_seconds
+        while True:
+            with self._cond:
+                if self._stopped:
+                    return
+                now = _utc_now()
+                due = bool(self._heap) and self._heap[0][0] <= now
+                if not due and time.monotonic() < next_fallback:
+                    timeout = next_fallback - time.monotonic()
+                    if self._heap:
+                        timeout = min(timeout, (self._heap[0][0] - now).total_seconds())
+                    # A new deadline notifies the condition, so the sleep is recomputed.
+                    self._cond.wait(max(timeout, 0.0))
+                    continue
+            next_fallback = time.monotonic() + self.fallback_seconds
+            self.pop_due(now)
+            if self.on_due is None:
+                continue
+            try:
+                self.on_due(now)
+            except Exception:
+                logger.exception("Session expiry sweep failed")
+
+
+session_expiry = SessionExpiryScheduler()
@@ -1,8 +1,186 @@
+import csv
+import json
+import os
+import time
+
+import click
+import numpy as np
 from flask_migrate import Migrate
 
-from app import app, db
+from app import User, app, current_face_thresholds, db, registered_face_rows
+from attendance_backfill import backfill_daily_attendance
+from attendance_counters import rebuild_attendance_counters
+from face_audit import (
+    DEFAULT_BLOCK_SIZE,
+    AuditCheckpoint,
+    block_count,
+    gallery_fingerprint,
+    iter_duplicate_pairs,
+    load_audit_gallery,
+    merge_pairs,
+)
+from face_calibration import run_face_calibration, save_calibration_report
+from face_index import IVFIndex
+from face_matching import to_face_matrix
+from firebase_outbox import requeue_dead_letters
 
 migrate = Migrate(app, db)
 
+
+@app.cli.command("build-face-index")
+@click.option("--nlist", type=int, default=None, help="Number of inverted lists (default: ~sqrt(N)).")
+@click.option("--output", default=None, help="Index path (default: FACE_ANN_INDEX_PATH).")
+def build_face_index(nlist, output):
+    """Train the ANN face index offline from all registered templates."""
+    blocks = [to_face_matrix(template) for _, template in registered_face_rows()]
+    blocks = [block for block in blocks if block is not None]
+    if not blocks:
+        click.echo("No registered face templates found; nothing to index.")
+        return
+    vectors = np.concatenate(blocks)
+    index = IVFIndex.train(vectors, nlist=nlist)
+    path = output or app.config["FACE_ANN_INDEX_PATH"]
+    index.save(path)
+    click.echo(f"Face index with {index.nlist} lists over {len(vectors)} templates written to {path}")
+
+
+@app.cli.command("audit-duplicate-faces")
+@click.option("--threshold", type=float, default=None, help="Report pairs closer than this (default: FACE_DUPLICATE_THRESHOLD).")
+@click.option("--block-size", type=int, default=DEFAULT_BLOCK_SIZE, show_default=True, help="Templates per matrix tile.")
+@click.option("--output", default=None, help="CSV report path (default: instance/face_duplicate_audit.csv).")
+@click.option("--restart", is_flag=True, help="Ignore saved progress and audit from the first block.")
+def audit_duplicate_faces(threshold, block_size, output, restart):
+    """Find suspected duplicate identities across every registered face template."""
+    threshold = threshold if threshold is not None else app.config.get("FACE_DUPLICATE_THRESHOLD", 0.50)
+    output = output or os.path.join(app.instance_path, "face_duplicate_audit.csv")
+    partial_path = f"{output}.partial"
+    checkpoint = AuditCheckpoint(f"{output}.progress")
+
+    owners, matrix = load_audit_gallery(
+        registered_face_rows().order_by(User.id)
+    )
+    if len(owners) < 2:
+        click.echo("Fewer than two registered face templates; nothing to audit.")
+        return
+
+    fingerprint = gallery_fingerprint(owners, matrix, threshold, block_size)
+    start_block, partial_bytes = (0, 0) if restart else checkpoint.load(fingerprint)
+    if start_block and not os.path.exists(partial_path):
+        start_block, partial_bytes = 0, 0
+    total_blocks = block_count(len(owners), block_size)
+    if start_block:
+        click.echo(f"Resuming at block {start_block + 1}/{total_blocks}")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+
+    started = time.monotonic()
+    with open(partial_path, "r+" if start_block else "w", newline="", encoding="utf-8") as handle:
+        handle.seek(partial_bytes)
+        handle.truncate()
+        writer = csv.writer(handle)
+        for block_index, pairs in iter_duplicate_pairs(owners, matrix, threshold, block_size, start_block):
+            writer.writerows(pairs)
+            handle.flush()
+            checkpoint.save(fingerprint, block_index + 1, handle.tell())
+            click.echo(
+                f"Block {block_index + 1}/{total_blocks}: {len(pairs)} pairs "
+                f"({time.monotonic() - started:.1f}s)"
+            )
+
+    with open(partial_path, newline="", encoding="utf-8") as handle:
+        pairs = merge_pairs((int(a), int(b), float(d)) for a, b, d in csv.reader(handle))
+
+    user_ids = sorted({user_id for pair in pairs for user_id in pair[:2]})
+    users = {}
+    for start in range(0, len(user_ids), 500):
+        chunk = user_ids[start:start + 500]
+        for user_id, name, email, role in db.session.query(User.id, User.name, User.email, User.role).filter(
+            User.id.in_(chunk)
+        ):
+            users[user_id] = (name, email, role)
+
+    with open(output, "w", newline="", encoding="utf-8") as handle:
+        writer = csv.writer(handle)
+        writer.writerow([
+            "user_a_id", "user_a_name", "user_a_email", "user_a_role",
+            "user_b_id", "user_b_name", "user_b_email", "user_b_role",
+            "distance",
+        ])
+        for user_a, user_b, distance in pairs:
+            writer.writerow([
+                user_a, *users.get(user_a, ("", "", "")),
+                user_b, *users.get(user_b, ("", "", "")),
+                f"{distance:.4f}",
+            ])
+
+    os.remove(partial_path)
+    checkpoint.clear()
+    click.echo(
+        f"Audited {len(owners)} templates of {len(set(owners.tolist()))} users in "
+        f"{time.monotonic() - started:.1f}s: {len(pairs)} suspected duplicate pairs written to {output}"
+    )
+
+
+@app.cli.command("calibrate-face-thresholds")
+@click.option("--far", "far_target", type=float, default=0.001, show_default=True, help="Target false-accept rate for marking.")
+@click.option("--duplicate-far", "duplicate_far_target", type=float, default=0.01, show_default=True, help="Target false-accept rate for duplicate checks.")
+@click.option("--impostor-samples", type=int, default=200000, show_default=True, help="Cross-user template pairs to sample.")
+@click.option("--json", "as_json", is_flag=True, help="Print the full report as JSON.")
+def calibrate_face_thresholds(far_target, duplicate_far_target, impostor_samples, as_json):
+    """Recommend face thresholds from recorded distances and the registered gallery; the report is saved for the admin API."""
+    report = run_face_calibration(
+        registered_face_rows(),
+        current_face_thresholds(),
+        far_target=far_target,
+        duplicate_far_target=duplicate_far_target,
+        impostor_samples=impostor_samples,
+    )
+    save_calibration_report(report, app.config["FACE_CALIBRATION_REPORT_PATH"])
+    if as_json:
+        click.echo(json.dumps(report, indent=2))
+        return
+
+    samples = report["samples"]
+    click.echo(
+        f"Samples: {samples['genuine']} genuine, {samples['impostor']} impostor, "
+        f"{samples['unresolved_failures']} unresolved failures"
+    )
+    for name, value in report["recommended"]["thresholds"].items():
+        current = report["current"]["thresholds"][name]
+        recommended = "n/a" if value is None else f"{value:.3f}"
+        click.echo(f"{name}: current {current:.3f} -> recommended {recommended}")
+    for label in ("current", "recommended"):
+        rates = report[label]
+        if rates["far"] is not None and rates["frr"] is not None:
+            click.echo(f"At {label} recognition threshold: FAR {rates['far']:.4%}, FRR {rates['frr']:.4%}")
+
+
+@app.cli.command("rebuild-attendance-counters")
+def rebuild_attendance_counters_command():
+    """Recompute every enrollment's attended/eligible session counters from scratch."""
+    started = time.monotonic()
+    rebuilt = rebuild_attendance_counters()
+    db.session.commit()
+    click.echo(f"Rebuilt attendance counters for {rebuilt} enrollments in {time.monotonic() - started:.1f}s")
+
+
+@app.cli.command("backfill-daily-attendance")
+def backfill_daily_attendance_command():
+    """Create missing daily attendance records from session marks added since the last run."""
+    started = time.monotonic()
+    try:
+        inserted = backfill_daily_attendance(app.config["APP_TIMEZONE"])
+    except NotImplementedError as exc:
+        raise click.ClickException(str(exc)) from None
+    click.echo(f"Backfilled {inserted} daily attendance records in {time.monotonic() - started:.1f}s")
+
+
+@app.cli.command("requeue-firebase-outbox")
+def requeue_firebase_outbox_command():
+    """Retry Firebase mirror writes that were dead-lettered after exhausting their attempts."""
+    requeued = requeue_dead_letters()
+    db.session.commit()
+    click.echo(f"Requeued {requeued} dead-lettered Firebase writes")
+
+
 if __name__ == "__main__":
     app.run()
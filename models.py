@@ -1,8 +1,11 @@
+import numpy as np
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 from datetime import datetime, timezone, date, timedelta
-from sqlalchemy import Index, event
-from sqlalchemy.orm import validates
+from sqlalchemy import Index, event, func
+from sqlalchemy.orm import deferred, validates
+
+from face_matching import FACE_TEMPLATE_VERSION, MAX_FACE_TEMPLATES, decode_template, encode_template, to_face_matrix
 
 db = SQLAlchemy()
 
@@ -22,7 +25,10 @@ class User(UserMixin, db.Model):
     year = db.Column(db.String(10), nullable=True)
     semester = db.Column(db.String(10), nullable=True)
     assignment_status = db.Column(db.String(20), default='pending', index=True)  # pending / assigned
-    face_encoding = db.Column(db.Text, nullable=True)   # JSON of 128-D vector
+    # Biometric columns are deferred: only the face-matching code paths load them (undefer_group('face')).
+    face_encoding = deferred(db.Column(db.Text, nullable=True), group='face')   # Legacy JSON of 128-D vector (migrated to face_template)
+    face_template = deferred(db.Column(db.LargeBinary, nullable=True), group='face')  # K x 128 little-endian float32 values (K x 512 bytes)
+    face_template_version = deferred(db.Column(db.SmallInteger, nullable=True), group='face')
     face_registered = db.Column(db.Boolean, default=False, index=True)
     registered_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
     updated_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
@@ -58,6 +64,18 @@ class User(UserMixin, db.Model):
 
     def get_attendance_percentage(self, start_date=None, end_date=None):
         """Calculate attendance percentage for date range"""
+        if start_date is None and end_date is None:
+            # All-time figures come straight from the enrollment counters.
+            attended, eligible = (
+                db.session.query(
+                    func.coalesce(func.sum(Enrollment.sessions_attended), 0),
+                    func.coalesce(func.sum(Enrollment.sessions_eligible), 0),
+                )
+                .filter(Enrollment.student_id == self.id)
+                .one()
+            )
+            return round((min(attended, eligible) / eligible * 100), 2) if eligible > 0 else 0.0
+
         query = SessionAttendance.query.filter_by(student_id=self.id)
         
         if start_date:
@@ -88,7 +106,26 @@ class User(UserMixin, db.Model):
 
     def has_face_registered(self):
         """Check if user has completed face registration"""
-        return self.face_registered and self.face_encoding is not None
+        return self.face_registered and self.face_template is not None
+
+    def get_face_templates(self):
+        """Return the stored face templates as a (K x 128) float32 matrix (falls back to legacy JSON)"""
+        if self.face_template is not None:
+            return decode_template(self.face_template, self.face_template_version)
+        return to_face_matrix(self.face_encoding)
+
+    def set_face_templates(self, templates):
+        """Store face vectors as one binary template block, or clear it when ``templates`` is None"""
+        self.face_template = encode_template(templates) if templates is not None else None
+        self.face_template_version = FACE_TEMPLATE_VERSION if templates is not None else None
+        self.face_encoding = None
+
+    def add_face_templates(self, templates):
+        """Append re-enrollment templates, keeping only the newest MAX_FACE_TEMPLATES"""
+        current = self.get_face_templates()
+        if current is not None:
+            templates = np.concatenate([current, templates])
+        self.set_face_templates(templates[-MAX_FACE_TEMPLATES:])
 
     def __repr__(self):
         return f'<User {self.name} ({self.role})>'
@@ -143,6 +180,8 @@ class ClassSession(db.Model):
     location_lat = db.Column(db.Float, nullable=True)
     location_lng = db.Column(db.Float, nullable=True)
     location_radius_meters = db.Column(db.Integer, nullable=False, default=50)
+    # Set once the session has been added to its enrollments' sessions_eligible counters.
+    is_counted = db.Column(db.Boolean, nullable=False, default=False, index=True)
     teacher_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
     updated_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
@@ -371,6 +410,9 @@ class Enrollment(db.Model):
     student_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
     enrolled_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
     is_active = db.Column(db.Boolean, default=True, index=True)
+    # Maintained by attendance_counters; rebuild with: flask --app manage rebuild-attendance-counters
+    sessions_attended = db.Column(db.Integer, nullable=False, default=0)
+    sessions_eligible = db.Column(db.Integer, nullable=False, default=0)
 
     __table_args__ = (
         db.UniqueConstraint('course_id', 'student_id', name='unique_course_student'),
@@ -380,17 +422,10 @@ class Enrollment(db.Model):
 
     def get_attendance_percentage(self):
         """Calculate attendance percentage for this enrollment"""
-        sessions = ClassSession.query.filter_by(course_id=self.course_id).all()
-        if not sessions:
+        if not self.sessions_eligible:
             return 0.0
-        
-        session_ids = [s.id for s in sessions]
-        attended = SessionAttendance.query.filter(
-            SessionAttendance.student_id == self.student_id,
-            SessionAttendance.session_id.in_(session_ids)
-        ).count()
-        
-        return round((attended / len(sessions) * 100), 2)
+        attended = min(self.sessions_attended or 0, self.sessions_eligible)
+        return round((attended / self.sessions_eligible * 100), 2)
 
     def __repr__(self):
         return f'<Enrollment c{self.course_id} s{self.student_id}>'
@@ -478,6 +513,54 @@ class Timetable(db.Model):
         return f'<Timetable {self.get_day_name()} {self.start_time} - {self.course.code if self.course else "?"} Sec {self.section}>'
 
 
+class FirebaseOutbox(db.Model):
+    """Firebase mirror writes committed with the rows they describe, drained by a background flusher."""
+    __tablename__ = 'firebase_outbox'
+
+    id = db.Column(db.Integer, primary_key=True)
+    path = db.Column(db.String(512), nullable=False)
+    payload = db.Column(db.Text, nullable=True)  # JSON value written at path; null deletes the node
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=True)  # Null means due now
+    last_error = db.Column(db.Text, nullable=True)
+    dead_at = db.Column(db.DateTime, nullable=True)  # Set once retries are exhausted
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+
+    __table_args__ = (
+        Index('idx_outbox_pending', 'dead_at', 'id'),
+    )
+
+    def __repr__(self):
+        return f'<FirebaseOutbox {self.id} {self.path} attempts={self.attempts}>'
+
+
+class SyncState(db.Model):
+    """Named high-water marks for incremental background jobs."""
+    __tablename__ = 'sync_state'
+
+    key = db.Column(db.String(64), primary_key=True)
+    value = db.Column(db.String(255), nullable=True)
+    updated_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
+
+    @classmethod
+    def get_value(cls, key, default=None):
+        state = db.session.get(cls, key)
+        return state.value if state is not None and state.value is not None else default
+
+    @classmethod
+    def set_value(cls, key, value):
+        """Stage ``value`` for ``key``; the caller commits."""
+        state = db.session.get(cls, key)
+        if state is None:
+            state = cls(key=key)
+            db.session.add(state)
+        state.value = None if value is None else str(value)
+        return state
+
+    def __repr__(self):
+        return f'<SyncState {self.key}={self.value}>'
+
+
 # Event listeners for automatic timestamp updates
 @event.listens_for(User, 'before_update')
 def receive_before_update_user(mapper, connection, target):
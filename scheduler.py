@@ -7,6 +7,9 @@ from zoneinfo import ZoneInfo
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.interval import IntervalTrigger
 
+from attendance_counters import LOW_ATTENDANCE_THRESHOLD, attendance_percentage
+from live_sessions import session_expiry
+
 logger = logging.getLogger(__name__)
 
 
@@ -42,6 +45,7 @@ def init_scheduler(app, db):
                 ).all()
                 
                 sessions_created = 0
+                created_sessions = []
                 
                 for entry in timetable_entries:
                     # Combine date and time for session start/end
@@ -87,6 +91,7 @@ def init_scheduler(app, db):
                             location_radius_meters=app.config['SESSION_LOCATION_RADIUS_METERS'],
                         )
                         db.session.add(new_session)
+                        created_sessions.append(new_session)
                         sessions_created += 1
                         logger.info(
                             f"Auto-generated session: {entry.course.code} - "
@@ -96,6 +101,10 @@ def init_scheduler(app, db):
                 if sessions_created > 0:
                     db.session.commit()
                     logger.info(f"Auto-session generation: {sessions_created} sessions created")
+                    # The expiry timer wakes at each start and prepares the matching state then,
+                    # so the first wave of marks doesn't pay for it
+                    for new_session in created_sessions:
+                        session_expiry.schedule_session(new_session)
                     
             except Exception as e:
                 db.session.rollback()
@@ -103,28 +112,10 @@ def init_scheduler(app, db):
     
     def auto_close_expired_sessions():
         """Close sessions that have ended"""
-        with app.app_context():
-            try:
-                now_utc = datetime.now(timezone.utc).replace(tzinfo=None)
-                
-                expired_sessions = ClassSession.query.filter(
-                    ClassSession.is_active == True,
-                    ClassSession.ends_at < now_utc
-                ).all()
-                
-                closed_count = 0
-                for session in expired_sessions:
-                    session.is_active = False
-                    closed_count += 1
-                    logger.info(f"Auto-closed session: {session.course_code} - Session ID {session.id}")
-                
-                if closed_count > 0:
-                    db.session.commit()
-                    logger.info(f"Auto-closed {closed_count} expired sessions")
-                    
-            except Exception as e:
-                db.session.rollback()
-                logger.error(f"Error in auto_close_expired_sessions: {str(e)}", exc_info=True)
+        # The same sweep as the session expiry timer, so closing a session also updates
+        # the Firebase mirror, the live session registry and the teacher counter streams.
+        from app import expire_due_sessions
+        expire_due_sessions()
     
     def send_low_attendance_alerts():
         """Send daily alerts to students with low attendance"""
@@ -132,43 +123,32 @@ def init_scheduler(app, db):
             try:
                 from email_service import send_low_attendance_alert
                 
-                # Get all active students
-                students = User.query.filter_by(role='student', is_active=True).all()
+                # One pass over the enrollment counters of active students below the threshold
+                low_enrollments = (
+                    db.session.query(Enrollment, User)
+                    .join(User, User.id == Enrollment.student_id)
+                    .filter(
+                        User.role == 'student',
+                        User.is_active == True,
+                        Enrollment.is_active == True,
+                        Enrollment.sessions_eligible > 0,
+                        Enrollment.sessions_attended * 100 < LOW_ATTENDANCE_THRESHOLD * Enrollment.sessions_eligible,
+                    )
+                    .order_by(User.id)
+                    .all()
+                )
+                low_courses_by_student = {}
+                for enrollment, student in low_enrollments:
+                    _, low_courses = low_courses_by_student.setdefault(student.id, (student, []))
+                    low_courses.append({
+                        'course': enrollment.course,
+                        'percentage': attendance_percentage(enrollment.sessions_attended, enrollment.sessions_eligible),
+                        'attended': enrollment.sessions_attended,
+                        'total': enrollment.sessions_eligible
+                    })
                 
                 alerts_sent = 0
-                for student in students:
-                    # Get enrolled courses
-                    enrollments = Enrollment.query.filter_by(
-                        student_id=student.id,
-                        is_active=True
-                    ).all()
-                    
-                    low_courses = []
-                    for enrollment in enrollments:
-                        # Calculate attendance percentage
-                        total_sessions = ClassSession.query.filter_by(
-                            course_id=enrollment.course_id
-                        ).count()
-                        
-                        if total_sessions == 0:
-                            continue
-                        
-                        attended_sessions = SessionAttendance.query.filter_by(
-                            student_id=student.id
-                        ).join(ClassSession).filter(
-                            ClassSession.course_id == enrollment.course_id
-                        ).count()
-                        
-                        percentage = (attended_sessions / total_sessions * 100) if total_sessions > 0 else 0
-                        
-                        if percentage < 75:  # Below 75% threshold
-                            low_courses.append({
-                                'course': enrollment.course,
-                                'percentage': round(percentage, 2),
-                                'attended': attended_sessions,
-                                'total': total_sessions
-                            })
-                    
+                for student, low_courses in low_courses_by_student.values():
                     if low_courses and student.email:
                         # Send alert email
                         send_low_attendance_alert(app, student, low_courses)
@@ -0,0 +1,90 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from face_index import IVFIndex  # noqa: E402
+from face_matching import FaceGallery  # noqa: E402
+
+
+def synthetic_gallery(size, rng):
+    """Unit-norm 128-D descriptors, roughly the spread face-api.js produces across people."""
+    faces = rng.normal(size=(size, 128)).astype(np.float32)
+    return faces / np.linalg.norm(faces, axis=1, keepdims=True)
+
+
+def probe_queries(faces, count, noise, rng):
+    """Re-scans of enrolled people: a gallery row plus camera/lighting noise."""
+    picked = rng.choice(faces.shape[0], count, replace=False)
+    jitter = rng.normal(scale=noise / np.sqrt(128), size=(count, 128)).astype(np.float32)
+    return picked, faces[picked] + jitter
+
+
+def timed_search(gallery, queries):
+    results = []
+    latencies = []
+    for query in queries:
+        started = time.perf_counter()
+        results.append(gallery.nearest(query))
+        latencies.append((time.perf_counter() - started) * 1000)
+    return results, np.array(latencies)
+
+
+def run(size, args, rng):
+    faces = synthetic_gallery(size, rng)
+    expected_ids, queries = probe_queries(faces, args.queries, args.noise, rng)
+
+    exact = FaceGallery(initial_capacity=size)
+    exact.ensure_loaded(lambda: enumerate(faces))
+
+    started = time.perf_counter()
+    index = IVFIndex.train(faces, nlist=args.nlist)
+    train_seconds = time.perf_counter() - started
+    approx = FaceGallery(initial_capacity=size)
+    approx.ensure_loaded(lambda: enumerate(faces))
+    approx.attach_index(index, nprobe=args.nprobe)
+
+    exact_results, exact_ms = timed_search(exact, queries)
+    approx_results, approx_ms = timed_search(approx, queries)
+
+    exact_hits = [
+        (match_id, distance) for match_id, distance in exact_results if distance < args.threshold
+    ]
+    same_answer = sum(1 for a, b in zip(exact_results, approx_results) if a[0] == b[0])
+    threshold_recall = sum(
+        1 for a, b in zip(exact_results, approx_results)
+        if a[1] < args.threshold and b[0] == a[0]
+    ) / max(1, len(exact_hits))
+    true_identity = sum(1 for expected, (match_id, _) in zip(expected_ids, approx_results) if match_id == expected)
+
+    print(
+        f"N={size:>7}  nlist={index.nlist:>4} nprobe={args.nprobe:<3} train={train_seconds:6.2f}s  "
+        f"exact p50={np.percentile(exact_ms, 50):7.3f}ms p95={np.percentile(exact_ms, 95):7.3f}ms  "
+        f"ivf p50={np.percentile(approx_ms, 50):7.3f}ms p95={np.percentile(approx_ms, 95):7.3f}ms  "
+        f"recall@1={same_answer / len(queries):.4f} threshold-recall={threshold_recall:.4f} "
+        f"identity={true_identity / len(queries):.4f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare IVF face search against the exact gallery scan")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 50000, 100000], help="Gallery sizes")
+    parser.add_argument("--queries", type=int, default=300, help="Queries per gallery size")
+    parser.add_argument("--nlist", type=int, default=None, help="Inverted lists (default: ~sqrt(N))")
+    parser.add_argument("--nprobe", type=int, default=8, help="Lists probed per query")
+    parser.add_argument("--noise", type=float, default=0.3, help="Expected distance of a re-scan from its template")
+    parser.add_argument("--threshold", type=float, default=0.50, help="Duplicate threshold used for recall")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    for size in args.sizes:
+        run(size, args, rng)
+
+
+if __name__ == "__main__":
+    main()
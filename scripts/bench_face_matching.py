@@ -0,0 +1,77 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from face_matching import FaceGallery  # noqa: E402
+
+
+def synthetic_gallery(size, rng):
+    """Unit-norm 128-D descriptors, roughly the spread face-api.js produces across people."""
+    faces = rng.normal(size=(size, 128)).astype(np.float32)
+    return faces / np.linalg.norm(faces, axis=1, keepdims=True)
+
+
+def subtract_and_norm(matrix, query):
+    """The previous per-call scan: an N x 128 temporary, then a norm per row."""
+    distances = np.linalg.norm(matrix - query, axis=1)
+    best = int(np.argmin(distances))
+    return best, float(distances[best])
+
+
+def timed(search, queries, repeat):
+    latencies = []
+    results = []
+    for query in queries:
+        started = time.perf_counter()
+        for _ in range(repeat):
+            result = search(query)
+        latencies.append((time.perf_counter() - started) * 1000 / repeat)
+        results.append(result)
+    return results, np.array(latencies)
+
+
+def run(size, args, rng):
+    faces = synthetic_gallery(size, rng)
+    picked = rng.choice(size, args.queries, replace=False)
+    queries = faces[picked] + rng.normal(scale=0.3 / np.sqrt(128), size=(args.queries, 128)).astype(np.float32)
+
+    galleries = {}
+    for label, dtype in (("gemv-f32", np.float32), ("gemv-f16", np.float16)):
+        gallery = FaceGallery(initial_capacity=size, dtype=dtype)
+        gallery.ensure_loaded(lambda: enumerate(faces))
+        galleries[label] = gallery
+
+    baseline, baseline_ms = timed(lambda q: subtract_and_norm(faces, q), queries, args.repeat)
+    line = f"N={size:>7}  subtract+norm p50={np.percentile(baseline_ms, 50):7.3f}ms"
+    for label, gallery in galleries.items():
+        results, latency_ms = timed(gallery.nearest, queries, args.repeat)
+        agree = sum(1 for (row, _), (user_id, _) in zip(baseline, results) if row == user_id) / len(queries)
+        error = max(abs(a[1] - b[1]) for a, b in zip(baseline, results))
+        line += (
+            f"  {label} p50={np.percentile(latency_ms, 50):7.3f}ms "
+            f"x{np.percentile(baseline_ms, 50) / np.percentile(latency_ms, 50):4.1f} "
+            f"agree={agree:.3f} max-err={error:.1e}"
+        )
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare GEMV face matching against subtract-and-norm")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000], help="Gallery sizes")
+    parser.add_argument("--queries", type=int, default=50, help="Queries per gallery size")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed repetitions per query")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    for size in args.sizes:
+        run(size, args, rng)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+LAT, LNG = 28.325645, 79.461063
+
+
+def prepare_environment(database_path):
+    """Point the app at a scratch copy of the bundled database and keep background threads quiet."""
+    shutil.copyfile(os.path.join(ROOT, "instance", "attendance.db"), database_path)
+    os.environ["DATABASE_URL"] = f"sqlite:///{database_path}"
+    os.environ.setdefault("SECRET_KEY", "bench")
+    os.environ["DAILY_ATTENDANCE_BACKFILL_ON_STARTUP"] = "0"
+    os.environ["SESSION_EXPIRY_ENABLED"] = "0"
+
+
+def seed(attendance_app, students, rng):
+    """One live session with ``students`` enrolled, each with a unit-norm face template."""
+    from werkzeug.security import generate_password_hash
+
+    db = attendance_app.db
+    password_hash = generate_password_hash("BenchPass1", method="pbkdf2:sha256:1000")
+    teacher = attendance_app.User(
+        name="Bench Teacher", email="bench-teacher@example.com", department="CS", role="teacher",
+        password_hash=password_hash,
+    )
+    db.session.add(teacher)
+    db.session.flush()
+    course = attendance_app.Course(
+        code="BENCH101", title="Bench", department="CS", academic_year="2025-26", semester="1", teacher_id=teacher.id,
+    )
+    db.session.add(course)
+    db.session.flush()
+
+    faces = rng.normal(size=(students, 128)).astype(np.float32)
+    faces /= np.linalg.norm(faces, axis=1, keepdims=True)
+    accounts = []
+    for index, face in enumerate(faces):
+        student = attendance_app.User(
+            name=f"Bench Student {index}", email=f"bench-student-{index}@example.com", department="CS",
+            role="student", section="A", face_registered=True, face_template=attendance_app.encode_template(face),
+            password_hash=password_hash,
+        )
+        db.session.add(student)
+        accounts.append((student, face))
+    db.session.flush()
+    db.session.add_all(attendance_app.Enrollment(course_id=course.id, student_id=student.id) for student, _ in accounts)
+
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    session = attendance_app.ClassSession(
+        title="Bench", course_code=course.code, room="Hall", course_id=course.id, section="A", teacher_id=teacher.id,
+        starts_at=now - timedelta(minutes=1), ends_at=now + timedelta(hours=1), is_active=True,
+        location_lat=LAT, location_lng=LNG, location_radius_meters=50,
+    )
+    db.session.add(session)
+    db.session.commit()
+    return session.id, [(student.email, face) for student, face in accounts]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time a burst of self-service session marks")
+    parser.add_argument("--students", type=int, default=200, help="Students marking one after another")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as scratch:
+        prepare_environment(os.path.join(scratch, "bench.db"))
+        from sqlalchemy import event
+
+        import app as attendance_app
+
+        flask_app = attendance_app.app
+        flask_app.config.update(TESTING=True, WTF_CSRF_ENABLED=False)
+        attendance_app.limiter.enabled = False
+        rng = np.random.default_rng(args.seed)
+
+        with flask_app.app_context():
+            session_id, accounts = seed(attendance_app, args.students, rng)
+            statements = []
+            event.listen(attendance_app.db.engine, "before_cursor_execute", lambda conn, cursor, statement, *_: statements.append(statement))
+
+        clients = []
+        for email, face in accounts:
+            client = flask_app.test_client()
+            client.post("/login", data={"email": email, "password": "BenchPass1"})
+            scan = face + rng.normal(scale=0.1 / np.sqrt(128), size=128).astype(np.float32)
+            clients.append((client, scan.tolist()))
+
+        latencies = []
+        counts = []
+        failures = 0
+        for client, scan in clients:
+            before = len(statements)
+            started = time.perf_counter()
+            response = client.post(
+                "/api/session_attendance/mark",
+                json={"session_id": session_id, "descriptor": scan, "lat": LAT, "lng": LNG},
+            )
+            latencies.append((time.perf_counter() - started) * 1000)
+            counts.append(len(statements) - before)
+            failures += response.status_code != 200
+
+        latencies = np.array(latencies)
+        print(
+            f"{args.students} marks: p50={np.percentile(latencies, 50):.2f}ms p95={np.percentile(latencies, 95):.2f}ms "
+            f"max={latencies.max():.2f}ms  SQL statements/mark median={int(np.median(counts))}  failures={failures}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Cross-worker change signal for the teacher dashboard's live session counters.
+
+``record_attempt`` stages every attendance attempt with ``stage_attempt``; once the
+transaction commits, ``session_counters`` bumps a shared ``GenerationFile``. Starting,
+closing or expiring a session and enrollment changes bump it as well. Dashboards poll
+``/api/teacher/live_counts`` with the last generation they saw: an unchanged generation
+is answered from one file read without touching the database, and no request ever
+waits for a change, so an open dashboard never holds a worker thread.
+"""
+import threading
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from worker_sync import GenerationFile
+
+_STAGED_KEY = "session_counter_attempts"
+
+
+def stage_attempt(session, session_id):
+    """Signal a counter change when ``session`` (a SQLAlchemy session) commits."""
+    if session_id is not None:
+        session.info[_STAGED_KEY] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _publish_after_commit(session):
+    if session.info.pop(_STAGED_KEY, None):
+        session_counters.changed()
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_rolled_back_attempts(session):
+    session.info.pop(_STAGED_KEY, None)
+
+
+class SessionCounterGeneration:
+    """
+    Generation of the live session counters, shared by every worker through a
+    ``GenerationFile`` once attached (a process-local counter until then).
+    """
+
+    def __init__(self):
+        self.generations = None
+        self._lock = threading.Lock()
+        self._generation = 0
+
+    def attach(self, generation_path):
+        self.generations = GenerationFile(generation_path)
+
+    def current(self):
+        if self.generations is not None:
+            return self.generations.read()
+        with self._lock:
+            return self._generation
+
+    def changed(self):
+        """Bump the generation so every dashboard reloads its counts on its next poll."""
+        if self.generations is not None:
+            return self.generations.bump()
+        with self._lock:
+            self._generation += 1
+            return self._generation
+
+
+session_counters = SessionCounterGeneration()
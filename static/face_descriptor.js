@@ -0,0 +1,21 @@
+/**
+ * Compact face descriptor wire format
+ * Encodes a 128-value face-api.js descriptor as base64 of little-endian float32,
+ * about a third of the size of a JSON array of decimals. The server also accepts
+ * plain arrays, so pages without this script keep working.
+ */
+
+function encodeFaceDescriptor(descriptor) {
+    const view = new DataView(new ArrayBuffer(descriptor.length * 4));
+    for (let i = 0; i < descriptor.length; i++) {
+        view.setFloat32(i * 4, descriptor[i], true);
+    }
+    const bytes = new Uint8Array(view.buffer);
+    let binary = '';
+    for (let i = 0; i < bytes.length; i++) {
+        binary += String.fromCharCode(bytes[i]);
+    }
+    return btoa(binary);
+}
+
+window.encodeFaceDescriptor = encodeFaceDescriptor;
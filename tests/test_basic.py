@@ -1,15 +1,21 @@
+import base64
 import os
 import sys
+import threading
+import time
 import uuid
-import json
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
 
+import pytest
+from sqlalchemy import inspect
 from werkzeug.security import check_password_hash, generate_password_hash
 
 os.environ.setdefault("SECRET_KEY", "test-secret")
 sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
 
+from attendance_counters import count_low_attendance_students
+from face_matching import to_face_matrix
 import app as attendance_app
 
 app = attendance_app.app
@@ -70,7 +76,7 @@ def _create_kiosk_fixture():
             year="1",
             semester="1",
             face_registered=True,
-            face_encoding=json.dumps([0.1] * 128),
+            face_template=attendance_app.encode_template([0.1] * 128),
             password_hash=generate_password_hash("StudentPass1", method="scrypt"),
         )
         db.session.add_all([teacher, student])
@@ -246,3 +252,697 @@ def test_kiosk_data_does_not_expose_face_descriptors():
         assert "face_ready" in payload["students"][0]
     finally:
         _cleanup_kiosk_fixture(fixture["teacher_email"], fixture["student_email"])
+
+
+def test_legacy_face_encodings_are_migrated_to_binary_templates():
+    email = f"legacy-{uuid.uuid4().hex[:10]}@example.com"
+    with app.app_context():
+        user = User(
+            name="Legacy Face User",
+            email=email,
+            department="Computer Science",
+            role="student",
+            face_registered=True,
+            face_encoding="[" + ",".join(["0.25"] * 128) + "]",
+            password_hash=generate_password_hash("LegacyPass1", method="scrypt"),
+        )
+        db.session.add(user)
+        db.session.commit()
+
+    try:
+        with app.app_context():
+            attendance_app.migrate_legacy_face_encodings(batch_size=1)
+            user = User.query.filter_by(email=email).first()
+            assert user.face_encoding is None
+            assert len(user.face_template) == 512
+            assert user.get_face_templates().tolist() == [[0.25] * 128]
+    finally:
+        _delete_test_user(email)
+
+
+def test_face_template_is_deferred_on_user_loads():
+    fixture = _create_kiosk_fixture()
+    try:
+        with app.app_context():
+            student = User.query.filter_by(email=fixture["student_email"]).first()
+            assert "face_template" in inspect(student).unloaded
+            assert student.face_registered is True
+            assert student.get_face_templates() is not None
+    finally:
+        _cleanup_kiosk_fixture(fixture["teacher_email"], fixture["student_email"])
+
+
+def test_teacher_dashboard_attendance_matrix_is_pivoted_from_one_query():
+    fixture = _create_kiosk_fixture()
+    app.config["TESTING"] = True
+    app.config["WTF_CSRF_ENABLED"] = False
+    client = app.test_client()
+
+    try:
+        with app.app_context():
+            student = User.query.filter_by(email=fixture["student_email"]).first()
+            teacher = User.query.filter_by(email=fixture["teacher_email"]).first()
+            today = attendance_app.today_local_date()
+            db.session.add(attendance_app.Attendance(
+                user_id=student.id, date=today, time=datetime(2025, 1, 1, 9, 30).time(),
+            ))
+            db.session.commit()
+            recent_dates = [today - timedelta(days=i) for i in range(6, -1, -1)]
+            matrix, today_count = attendance_app.recent_attendance_matrix(
+                [student.id, teacher.id], recent_dates
+            )
+            assert matrix[student.id][today.isoformat()] == "09:30 AM"
+            assert matrix[student.id][recent_dates[0].isoformat()] is None
+            assert all(value is None for value in matrix[teacher.id].values())
+            assert today_count == 1
+
+        client.post(
+            "/login",
+            data={"email": fixture["teacher_email"], "password": "TeacherPass1"},
+            follow_redirects=False,
+        )
+        response = client.get("/dashboard")
+        assert response.status_code == 200
+    finally:
+        _cleanup_kiosk_fixture(fixture["teacher_email"], fixture["student_email"])
+
+
+def test_session_roster_counts_match_full_roster():
+    fixture = _create_kiosk_fixture()
+    extra_emails = [f"roster-{uuid.uuid4().hex[:10]}@example.com" for _ in range(2)]
+    session_id = fixture["session_id"]
+
+    try:
+        with app.app_context():
+            session = db.session.get(ClassSession, session_id)
+            marked_student = User.query.filter_by(email=fixture["student_email"]).first()
+            failed_student, pending_student = [
+                User(name="Roster Student", email=email, role="student", department="Computer Science", password_hash="x")
+                for email in extra_emails
+            ]
+            db.session.add_all([failed_student, pending_student])
+            db.session.flush()
+            db.session.add_all([
+                Enrollment(course_id=session.course_id, student_id=failed_student.id),
+                Enrollment(course_id=session.course_id, student_id=pending_student.id),
+                attendance_app.SessionAttendance(session_id=session_id, student_id=marked_student.id),
+                attendance_app.AttendanceAttempt(session_id=session_id, student_id=marked_student.id, success=False, reason="Face verification failed"),
+                attendance_app.AttendanceAttempt(session_id=session_id, student_id=failed_student.id, success=False, reason="Outside geofence"),
+                attendance_app.AttendanceAttempt(session_id=session_id, student_id=failed_student.id, success=False, reason="Face verification failed"),
+                attendance_app.AttendanceAttempt(session_id=session_id, student_id=None, success=False, reason="Unknown face"),
+            ])
+            db.session.commit()
+
+            counts = attendance_app.session_roster_counts([session_id, -1])
+            assert counts[session_id] == {"enrolled": 3, "marked": 1, "failed": 2, "pending": 1}
+            assert counts[session_id] == attendance_app.build_session_roster(session)["counts"]
+            assert counts[-1] == {"enrolled": 0, "marked": 0, "failed": 0, "pending": 0}
+    finally:
+        with app.app_context():
+            attendance_app.AttendanceAttempt.query.filter_by(session_id=session_id).delete()
+            attendance_app.SessionAttendance.query.filter_by(session_id=session_id).delete()
+            for email in extra_emails:
+                user = User.query.filter_by(email=email).first()
+                if user:
+                    db.session.delete(user)
+            db.session.commit()
+        _cleanup_kiosk_fixture(fixture["teacher_email"], fixture["student_email"])
+
+
+def test_enrollment_counters_follow_session_start_and_marks():
+    fixture = _create_kiosk_fixture()
+    app.config["TESTING"] = True
+    app.config["WTF_CSRF_ENABLED"] = False
+    client = app.test_client()
+
+    try:
+        client.post(
+            "/login",
+            data={"email": fixture["teacher_email"], "password": "TeacherPass1"},
+            follow_redirects=False,
+        )
+        # The first mark counts a started session that no sweep has reached yet.
+        marked = client.post(
+            "/api/kiosk_mark_batch",
+            json={"session_id": fixture["session_id"], "descriptors": [[0.1] * 128]},
+        ).get_json()
+        assert marked["marked"] == 1
+
+        with app.app_context():
+            student = User.query.filter_by(email=fixture["student_email"]).first()
+            enrollment = Enrollment.query.filter_by(student_id=student.id).first()
+            assert (enrollment.sessions_attended, enrollment.sessions_eligible) == (1, 1)
+            assert enrollment.get_attendance_percentage() == 100.0
+            assert db.session.get(ClassSession, fixture["session_id"]).is_counted is True
+
+            baseline = count_low_attendance_students()
+            enrollment.sessions_eligible = 4  # 1 of 4 sessions attended: below 75%
+            db.session.commit()
+            assert count_low_attendance_students() == baseline + 1
+
+            enrollment.sessions_attended = enrollment.sessions_eligible = 0
+            db.session.commit()
+            attendance_app.rebuild_attendance_counters()
+            db.session.commit()
+            db.session.refresh(enrollment)
+            assert (enrollment.sessions_attended, enrollment.sessions_eligible) == (1, 1)
+    finally:
+        attendance_app.session_contexts.evict(fixture["session_id"])
+        _cleanup_kiosk_fixture(fixture["teacher_email"], fixture["student_email"])
+
+
+def test_session_mark_writes_mark_daily_and_attempt_together():
+    fixture = _create_kiosk_fixture()
+    app.config["TESTING"] = True
+    app.config["WTF_CSRF_ENABLED"] = False
+    payload = {"session_id": fixture["session_id"], "descriptor": [0.1] * 128, "lat": 28.325645, "lng": 79.461063}
+    try:
+        client = app.test_client()
+        client.post("/login", data={"email": fixture["student_email"], "password": "StudentPass1"})
+        response = client.post("/api/session_attendance/mark", json=payload)
+        assert response.status_code == 200, response.get_json()
+
+        response = client.post("/api/session_attendance/mark", json=payload)
+        assert response.get_json()["message"] == "Attendance already marked for this class session."
+        with app.app_context():
+            student = User.query.filter_by(email=fixture["student_email"]).first()
+            attempts = (
+                attendance_app.AttendanceAttempt.query.filter_by(session_id=fixture["session_id"], student_id=student.id)
+                .order_by(attendance_app.AttendanceAttempt.id)
+                .all()
+            )
+            assert [(attempt.success, attempt.reason) for attempt in attempts] == [
+                (True, "Attendance marked"),
+                (False, "Duplicate mark"),
+            ]
+            assert attendance_app.Attendance.query.filter_by(user_id=student.id).count() == 1
+
+        # A kiosk retry that raced past every cache still inserts nothing instead of failing.
+        with app.test_request_context():
+            session = db.session.get(ClassSession, fixture["session_id"])
+            student = User.query.filter_by(email=fixture["student_email"]).first()
+            assert attendance_app.record_kiosk_attendance(session, student, 0.1, "Kiosk retry") is None
+            assert attendance_app.SessionAttendance.query.filter_by(session_id=session.id).count() == 1
+    finally:
+        attendance_app.session_contexts.evict(fixture["session_id"])
+        with app.app_context():
+            student = User.query.filter_by(email=fixture["student_email"]).first()
+            attendance_app.AttendanceAttempt.query.filter_by(student_id=student.id).delete()
+            db.session.commit()
+        _cleanup_kiosk_fixture(fixture["teacher_email"], fixture["student_email"])
+
+
+def test_live_session_registry_shares_changes_across_workers(tmp_path):
+    from live_sessions import LiveSessionRegistry
+
+    fixture = _create_kiosk_fixture()
+    # Two registries on one generation file stand in for two gunicorn workers.
+    worker_a, worker_b = LiveSessionRegistry(), LiveSessionRegistry()
+    for registry in (worker_a, worker_b):
+        registry.attach(str(tmp_path / "live_sessions.generation"))
+    try:
+        with app.app_context():
+            student = User.query.filter_by(email=fixture["student_email"]).first()
+            now = attendance_app.now_utc_naive()
+            assert [s.id for s in worker_a.sessions_for_student(student.id, now)] == [fixture["session_id"]]
+            assert [s.id for s in worker_b.sessions_for_student(student.id, now)] == [fixture["session_id"]]
+
+            worker_b.remove([fixture["session_id"]])
+            assert worker_b.sessions_for_student(student.id, now) == []
+            # Worker A still has the session indexed but sees the new generation and reloads.
+            db.session.get(ClassSession, fixture["session_id"]).is_active = False
+            db.session.commit()
+            assert worker_a.sessions_for_student(student.id, now) == []
+    finally:
+        _cleanup_kiosk_fixture(fixture["teacher_email"], fixture["student_email"])
+
+
+def test_scheduler_close_removes_session_from_student_registry():
+    from scheduler import init_scheduler
+
+    fixture = _create_kiosk_fixture()
+    scheduler = init_scheduler(app, db)
+    try:
+        with app.app_context():
+            student_id = User.query.filter_by(email=fixture["student_email"]).first().id
+            attendance_app.live_session_registry.invalidate()
+            assert [s.id for s in attendance_app.student_active_sessions(student_id)] == [fixture["session_id"]]
+            # The deadline passes behind the registry's back, as it does for a cached index.
+            session = db.session.get(ClassSession, fixture["session_id"])
+            session.ends_at = attendance_app.now_utc_naive() - timedelta(seconds=1)
+            db.session.commit()
+
+        scheduler.get_job("auto_close_sessions").func()
+
+        with app.app_context():
+            assert db.session.get(ClassSession, fixture["session_id"]).is_active is False
+            assert attendance_app.student_active_sessions(student_id) == []
+    finally:
+        scheduler.shutdown(wait=False)
+        _cleanup_kiosk_fixture(fixture["teacher_email"], fixture["student_email"])
+
+
+def test_teacher_live_counts_poll_reports_committed_marks():
+    fixture = _create_kiosk_fixture()
+    app.config["TESTING"] = True
+    app.config["WTF_CSRF_ENABLED"] = False
+    try:
+        teacher_client = app.test_client()
+        teacher_client.post("/login", data={"email": fixture["teacher_email"], "password": "TeacherPass1"})
+        first = teacher_client.get("/api/teacher/live_counts").get_json()
+        assert first["changed"] is True
+        assert first["sessions"][str(fixture["session_id"])] == {"marked": 0, "failed": 0, "pending": 1}
+
+        idle = teacher_client.get(f"/api/teacher/live_counts?since={first['generation']}").get_json()
+        assert idle == {"success": True, "generation": first["generation"], "changed": False}
+
+        student_client = app.test_client()
+        student_client.post("/login", data={"email": fixture["student_email"], "password": "StudentPass1"})
+        student_client.post(
+            "/api/session_attendance/mark",
+            json={"session_id": fixture["session_id"], "descriptor": [0.1] * 128, "lat": 28.325645, "lng": 79.461063},
+        )
+        after_mark = teacher_client.get(f"/api/teacher/live_counts?since={first['generation']}").get_json()
+        assert after_mark["changed"] is True
+        assert after_mark["generation"] > first["generation"]
+        assert after_mark["sessions"][str(fixture["session_id"])] == {"marked": 1, "failed": 0, "pending": 0}
+    finally:
+        attendance_app.session_contexts.evict(fixture["session_id"])
+        with app.app_context():
+            student = User.query.filter_by(email=fixture["student_email"]).first()
+            attendance_app.AttendanceAttempt.query.filter_by(student_id=student.id).delete()
+            db.session.commit()
+        _cleanup_kiosk_fixture(fixture["teacher_email"], fixture["student_email"])
+
+
+def test_session_start_deadline_warms_context_for_first_mark(monkeypatch):
+    fixture = _create_kiosk_fixture()
+    app.config["TESTING"] = True
+    app.config["WTF_CSRF_ENABLED"] = False
+    attendance_app.session_contexts.evict(fixture["session_id"])
+    try:
+        with app.app_context():
+            session = db.session.get(ClassSession, fixture["session_id"])
+            session.starts_at = attendance_app.now_utc_naive() - timedelta(seconds=1)
+            session.is_counted = False
+            db.session.commit()
+        attendance_app.expire_due_sessions()
+
+        def uncached(*args, **kwargs):
+            raise AssertionError("the first mark should find the context warmed at the start deadline")
+
+        monkeypatch.setattr(attendance_app, "build_session_context", uncached)
+        client = app.test_client()
+        client.post("/login", data={"email": fixture["student_email"], "password": "StudentPass1"})
+        response = client.post(
+            "/api/session_attendance/mark",
+            json={"session_id": fixture["session_id"], "descriptor": [0.1] * 128, "lat": 28.325645, "lng": 79.461063},
+        )
+        assert response.status_code == 200, response.get_json()
+    finally:
+        attendance_app.session_contexts.evict(fixture["session_id"])
+        with app.app_context():
+            student = User.query.filter_by(email=fixture["student_email"]).first()
+            attendance_app.AttendanceAttempt.query.filter_by(student_id=student.id).delete()
+            db.session.commit()
+        _cleanup_kiosk_fixture(fixture["teacher_email"], fixture["student_email"])
+
+
+def test_session_expiry_scheduler_wakes_at_earliest_deadline():
+    from live_sessions import SessionExpiryScheduler
+
+    fired = threading.Event()
+    calls = []
+
+    def on_due(now):
+        calls.append(now)
+        fired.set()
+
+    scheduler = SessionExpiryScheduler(on_due=on_due, fallback_seconds=60)
+    now = attendance_app.now_utc_naive()
+    scheduler.schedule(now + timedelta(hours=1), 2)
+    scheduler.schedule(now + timedelta(hours=2), 3)
+    scheduler.cancel(3)
+    assert len(scheduler) == 1
+    scheduler.start()
+    try:
+        scheduler.schedule(now + timedelta(milliseconds=50), 1)
+        assert fired.wait(5)
+        assert scheduler.next_deadline() == now + timedelta(hours=1)
+        assert len(calls) == 1
+    finally:
+        scheduler.stop()
+
+
+def test_expire_due_sessions_closes_and_evicts():
+    fixture = _create_kiosk_fixture()
+    try:
+        with app.app_context():
+            session = db.session.get(ClassSession, fixture["session_id"])
+            deadline = session.ends_at
+        attendance_app.expire_due_sessions(now=deadline - timedelta(seconds=1))
+        with app.app_context():
+            assert db.session.get(ClassSession, fixture["session_id"]).is_active is True
+        attendance_app.expire_due_sessions(now=deadline)
+        with app.app_context():
+            session = db.session.get(ClassSession, fixture["session_id"])
+            assert session.is_active is False
+            assert session.is_counted is True
+    finally:
+        _cleanup_kiosk_fixture(fixture["teacher_email"], fixture["student_email"])
+
+
+def test_concurrent_expiry_sweeps_close_each_session_once(monkeypatch):
+    fixture = _create_kiosk_fixture()
+    status_writes = []
+
+    def slow_status_write(app_, session_id, is_active):
+        status_writes.append(session_id)
+        time.sleep(0.2)  # keep the first sweep's transaction open while the second starts
+
+    monkeypatch.setattr(attendance_app, "update_session_status", slow_status_write)
+    try:
+        with app.app_context():
+            deadline = db.session.get(ClassSession, fixture["session_id"]).ends_at
+        sweeps = [threading.Thread(target=attendance_app.expire_due_sessions, args=(deadline,)) for _ in range(2)]
+        for sweep in sweeps:
+            sweep.start()
+        for sweep in sweeps:
+            sweep.join()
+        assert status_writes.count(fixture["session_id"]) == 1
+        with app.app_context():
+            assert db.session.get(ClassSession, fixture["session_id"]).is_active is False
+    finally:
+        _cleanup_kiosk_fixture(fixture["teacher_email"], fixture["student_email"])
+
+
+def test_daily_attendance_backfill_uses_local_date_and_high_water_mark():
+    from zoneinfo import ZoneInfo
+
+    from attendance_backfill import backfill_daily_attendance, utc_offset_segments
+
+    segments = list(utc_offset_segments(datetime(2025, 3, 8), datetime(2025, 3, 10), ZoneInfo("America/New_York")))
+    assert [(upper, offset) for _, upper, offset in segments][0] == (datetime(2025, 3, 9, 7), -300)
+    assert segments[-1][2] == -240
+
+    fixture = _create_kiosk_fixture()
+    second_id = None
+    try:
+        with app.app_context():
+            student = User.query.filter_by(email=fixture["student_email"]).first()
+            first = db.session.get(ClassSession, fixture["session_id"])
+            second = ClassSession(
+                title=first.title, course_code=first.course_code, room=first.room, course_id=first.course_id,
+                teacher_id=first.teacher_id, starts_at=first.starts_at, ends_at=first.ends_at, is_active=False,
+            )
+            db.session.add(second)
+            db.session.flush()
+            db.session.add_all([
+                attendance_app.SessionAttendance(session_id=session_id, student_id=student.id, marked_at=marked_at)
+                for session_id, marked_at in (
+                    (first.id, datetime(2025, 3, 10, 20, 0)),
+                    (second.id, datetime(2025, 3, 10, 21, 0)),
+                )
+            ])
+            db.session.commit()
+            second_id = second.id
+
+            assert backfill_daily_attendance("Asia/Kolkata") >= 1
+            daily = attendance_app.Attendance.query.filter_by(user_id=student.id).all()
+            assert [(row.date.isoformat(), row.time.isoformat()) for row in daily] == [("2025-03-11", "01:30:00")]
+            assert backfill_daily_attendance("Asia/Kolkata") == 0
+    finally:
+        with app.app_context():
+            student = User.query.filter_by(email=fixture["student_email"]).first()
+            attendance_app.Attendance.query.filter_by(user_id=student.id).delete()
+            attendance_app.SessionAttendance.query.filter_by(student_id=student.id).delete()
+            ClassSession.query.filter_by(id=second_id).delete()
+            db.session.commit()
+        _cleanup_kiosk_fixture(fixture["teacher_email"], fixture["student_email"])
+
+
+def test_daily_attendance_backfill_shifts_offset_segments_per_dialect():
+    from sqlalchemy import literal, select
+    from sqlalchemy.dialects import postgresql
+
+    from attendance_backfill import _local_date_and_time
+
+    marked_at = literal(datetime(2025, 3, 10, 3, 30))
+    with app.app_context():
+        local = db.session.execute(select(*_local_date_and_time(marked_at, -300, "sqlite"))).one()
+    assert tuple(local) == ("2025-03-09", "22:30:00.000000")
+
+    local_date, local_time = _local_date_and_time(attendance_app.SessionAttendance.marked_at, 330, "postgresql")
+    compiled = [str(expression.compile(dialect=postgresql.dialect())) for expression in (local_date, local_time)]
+    assert compiled[0].startswith("CAST(session_attendance.marked_at + ") and compiled[0].endswith(" AS DATE)")
+    assert compiled[1].endswith(" AS TIME WITHOUT TIME ZONE)")
+    assert not any("strftime" in sql for sql in compiled)
+
+    with pytest.raises(NotImplementedError, match="mysql"):
+        _local_date_and_time(attendance_app.SessionAttendance.marked_at, 0, "mysql")
+
+
+class _FakeFirebaseQuery:
+    def __init__(self, records, child):
+        self.records = sorted(records.items(), key=lambda item: item[1].get(child) or "")
+        self.child = child
+
+    def start_at(self, value):
+        self.records = [item for item in self.records if (item[1].get(self.child) or "") >= value]
+        return self
+
+    def equal_to(self, value):
+        self.records = [item for item in self.records if item[1].get(self.child) == value]
+        return self
+
+    def limit_to_first(self, count):
+        self.records = self.records[:count]
+        return self
+
+    def get(self):
+        return dict(self.records)
+
+
+class _FakeFirebaseDb:
+    def __init__(self, tree):
+        self.tree = tree
+        self.paths = []
+
+    def reference(self, path):
+        fake = self
+
+        class Reference:
+            def get(self):
+                fake.paths.append((path, "full"))
+                return fake.tree.get(path, {})
+
+            def order_by_child(self, child):
+                fake.paths.append((path, "ordered"))
+                return _FakeFirebaseQuery(fake.tree.get(path, {}), child)
+
+        return Reference()
+
+
+def test_firebase_hydration_upserts_and_then_pulls_only_changed_records(monkeypatch):
+    import firebase_service
+    from models import SyncState
+
+    first_id, late_id = 990001, 990002
+    fake = _FakeFirebaseDb({
+        "users": {
+            str(first_id): {
+                "name": "Hydrated User", "email": "Hydrated.User@Example.com", "department": "Physics",
+                "role": "teacher", "synced_at": "2026-01-01T10:00:00+00:00",
+            },
+        },
+    })
+    monkeypatch.setattr(firebase_service, "db", fake)
+    monkeypatch.setitem(app.extensions, "firebase_enabled", True)
+    models = (User, Course, attendance_app.TeacherAssignment, Enrollment, ClassSession)
+    try:
+        with app.app_context():
+            counts = firebase_service.sync_reference_data_to_sqlite(app, db.session, *models)
+            assert counts["users"] == 1
+            user = db.session.get(User, first_id)
+            assert (user.email, user.role, user.password_hash) == ("hydrated.user@example.com", "teacher", "")
+
+            fake.tree["users"][str(first_id)] = {"name": "Renamed User", "synced_at": "2026-01-02T10:00:00+00:00"}
+            fake.tree["users"][str(late_id)] = {"name": "Stale", "synced_at": "2025-12-01T10:00:00+00:00"}
+            fake.paths.clear()
+            counts = firebase_service.sync_reference_data_to_sqlite(app, db.session, *models)
+            assert counts["users"] == 1
+            assert ("users", "ordered") in fake.paths
+            db.session.expire_all()
+            user = db.session.get(User, first_id)
+            assert (user.name, user.department, user.role) == ("Renamed User", "Physics", "teacher")
+            assert db.session.get(User, late_id) is None
+    finally:
+        with app.app_context():
+            User.query.filter(User.id.in_([first_id, late_id])).delete(synchronize_session=False)
+            SyncState.query.filter(SyncState.key.like("firebase_hydration.%")).delete(synchronize_session=False)
+            db.session.commit()
+
+
+def test_firebase_outbox_batches_in_order_and_dead_letters_failures():
+    from firebase_outbox import enqueue_firebase_writes, flush_outbox
+    from models import FirebaseOutbox
+
+    sent = []
+    with app.app_context():
+        FirebaseOutbox.query.delete()
+        enqueue_firebase_writes({"sessions/1/is_active": False, "attendance/sessions/1/7": {"studentId": 7}})
+        enqueue_firebase_writes({"sessions/1": {"id": 1}})
+        db.session.commit()
+
+        # The overlapping "sessions/1" write waits for the next batch.
+        now = attendance_app.now_utc_naive()
+        assert flush_outbox(sent.append, now=now) == (2, now)
+        assert sent == [{"sessions/1/is_active": False, "attendance/sessions/1/7": {"studentId": 7}}]
+
+        def fail(updates):
+            raise RuntimeError("firebase down")
+
+        sent_count, retry_at = flush_outbox(fail, max_attempts=2, backoff_seconds=4, now=now)
+        assert sent_count == 0 and retry_at == now + timedelta(seconds=4)
+        assert flush_outbox(sent.append, now=now) == (0, retry_at)
+        assert flush_outbox(fail, max_attempts=2, now=retry_at) == (0, retry_at)
+        row = FirebaseOutbox.query.one()
+        assert (row.attempts, row.dead_at, row.last_error) == (2, retry_at, "firebase down")
+        assert flush_outbox(sent.append, now=retry_at) == (0, None)
+        FirebaseOutbox.query.delete()
+        db.session.commit()
+
+
+def test_kiosk_mark_batch_returns_per_face_results():
+    fixture = _create_kiosk_fixture()
+    app.config["TESTING"] = True
+    app.config["WTF_CSRF_ENABLED"] = False
+    client = app.test_client()
+
+    try:
+        client.post(
+            "/login",
+            data={"email": fixture["teacher_email"], "password": "TeacherPass1"},
+            follow_redirects=False,
+        )
+
+        response = client.post(
+            "/api/kiosk_mark_batch",
+            json={
+                "session_id": fixture["session_id"],
+                "descriptors": [[0.1] * 128, [0.9] * 128, [0.1] * 127, [0.1001] * 128],
+            },
+        )
+        payload = response.get_json()
+        assert payload["success"] is True
+        assert payload["marked"] == 1
+
+        results = payload["results"]
+        assert results[0]["success"] is True
+        assert results[1]["matched"] is False
+        assert results[2]["message"] == "Invalid face scan."
+        assert results[3]["student_id"] == results[0]["student_id"]
+
+        # Compact wire format: base64 of little-endian float32.
+        compact = base64.b64encode(attendance_app.encode_template([0.1] * 128)).decode("ascii")
+        repeat = client.post(
+            "/api/kiosk_mark_batch",
+            json={"session_id": fixture["session_id"], "descriptors": [compact]},
+        ).get_json()
+        assert repeat["marked"] == 0
+        assert repeat["results"][0]["already_marked"] is True
+        assert repeat["results"][0]["student_name"] == "Fixture Student"
+
+        with app.app_context():
+            student = User.query.filter_by(email=fixture["student_email"]).first()
+            assert attendance_app.SessionAttendance.query.filter_by(
+                session_id=fixture["session_id"], student_id=student.id
+            ).count() == 1
+    finally:
+        attendance_app.session_contexts.evict(fixture["session_id"])
+        _cleanup_kiosk_fixture(fixture["teacher_email"], fixture["student_email"])
+
+
+def test_kiosk_mark_sees_enrollment_changes_during_live_session():
+    fixture = _create_kiosk_fixture()
+    app.config["TESTING"] = True
+    app.config["WTF_CSRF_ENABLED"] = False
+    client = app.test_client()
+
+    try:
+        with app.app_context():
+            student_id = User.query.filter_by(email=fixture["student_email"]).first().id
+            course_id = db.session.get(ClassSession, fixture["session_id"]).course_id
+        client.post(
+            "/login",
+            data={"email": fixture["teacher_email"], "password": "TeacherPass1"},
+            follow_redirects=False,
+        )
+        payload = {"session_id": fixture["session_id"], "student_id": student_id, "descriptor": [0.1] * 128}
+        # Build and cache the session context while the student is enrolled.
+        primed = client.post("/api/kiosk_mark", json={**payload, "descriptor": None})
+        assert primed.status_code == 400
+
+        client.post(f"/teacher/courses/{course_id}/unenroll/{student_id}")
+        unenrolled = client.post("/api/kiosk_mark", json=payload)
+        assert unenrolled.status_code == 403
+
+        client.post(f"/teacher/courses/{course_id}/enroll", data={"student_email": fixture["student_email"]})
+        enrolled = client.post("/api/kiosk_mark", json=payload)
+        assert enrolled.get_json()["success"] is True
+    finally:
+        attendance_app.session_contexts.evict(fixture["session_id"])
+        _cleanup_kiosk_fixture(fixture["teacher_email"], fixture["student_email"])
+
+
+def test_session_context_is_prewarmed_and_tracks_marks():
+    fixture = _create_kiosk_fixture()
+    try:
+        with app.app_context():
+            session = db.session.get(ClassSession, fixture["session_id"])
+            student = User.query.filter_by(email=fixture["student_email"]).first()
+            attendance_app.session_contexts.warm(session)
+
+            context = attendance_app.live_session_context(session)
+            assert context.is_enrolled(student.id)
+            assert context.templates_for(student.id).tolist() == to_face_matrix([0.1] * 128).tolist()
+            assert context.location_radius_meters == 50
+            assert not context.is_marked(student.id)
+
+            context.add_marked([student.id])
+            assert attendance_app.live_session_context(session).is_marked(student.id)
+    finally:
+        attendance_app.session_contexts.evict(fixture["session_id"])
+        _cleanup_kiosk_fixture(fixture["teacher_email"], fixture["student_email"])
+
+
+def test_save_face_stores_burst_and_appends_matching_samples():
+    fixture = _create_kiosk_fixture()
+    app.config["TESTING"] = True
+    app.config["WTF_CSRF_ENABLED"] = False
+    client = app.test_client()
+    burst = [[0.1] * 128, [0.11] * 128, [0.09] * 128]
+
+    try:
+        client.post(
+            "/login",
+            data={"email": fixture["student_email"], "password": "StudentPass1"},
+            follow_redirects=False,
+        )
+
+        response = client.post("/save_face", json={"descriptors": burst})
+        assert response.get_json() == {"success": True, "templates": 3}
+
+        oversized = [[0.1] * 127] + [[0.1] * 128] * attendance_app.MAX_FACE_TEMPLATES
+        rejected = client.post("/save_face", json={"descriptors": oversized})
+        assert rejected.status_code == 400
+        malformed = client.post("/save_face", json={"descriptors": [[0.1] * 127, [0.1] * 128]})
+        assert malformed.status_code == 400
+
+        stranger = client.post("/save_face", json={"descriptors": [[0.5] * 128], "mode": "append"})
+        assert stranger.status_code == 400
+
+        appended = client.post("/save_face", json={"descriptors": [[0.1] * 128] * 3, "mode": "append"})
+        assert appended.get_json()["templates"] == attendance_app.MAX_FACE_TEMPLATES
+    finally:
+        _cleanup_kiosk_fixture(fixture["teacher_email"], fixture["student_email"])
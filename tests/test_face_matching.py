@@ -0,0 +1,319 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from face_calibration import (
+    DistanceHistogram,
+    GroupedHistograms,
+    build_calibration_report,
+    load_calibration_report,
+    save_calibration_report,
+)
+from face_audit import AuditCheckpoint, gallery_fingerprint, iter_duplicate_pairs, merge_pairs
+from face_index import IVFIndex
+from face_matching import (
+    MAX_FACE_TEMPLATES,
+    FaceGallery,
+    decode_template,
+    distances_to,
+    encode_template,
+    min_distance,
+    parse_descriptor,
+    to_face_matrix,
+    template_from_base64,
+    template_to_base64,
+    to_face_vector,
+)
+from face_store import SharedFaceStore
+from worker_sync import GenerationFile
+
+
+def _random_faces(count, seed=0):
+    rng = np.random.default_rng(seed)
+    faces = rng.normal(size=(count, 128)).astype(np.float32)
+    return faces / np.linalg.norm(faces, axis=1, keepdims=True)
+
+
+def test_to_face_vector_rejects_invalid_encodings():
+    assert to_face_vector(None) is None
+    assert to_face_vector("not json") is None
+    assert to_face_vector([0.1] * 127) is None
+    assert to_face_vector([float("nan")] * 128) is None
+    vector = to_face_vector("[" + ",".join(["0.5"] * 128) + "]")
+    assert vector.dtype == np.float32
+    assert vector.shape == (128,)
+
+
+def test_binary_template_round_trip():
+    vector = _random_faces(1)[0]
+    blob = encode_template(vector)
+    assert len(blob) == 512
+
+    decoded = decode_template(blob)
+    assert decoded.shape == (1, 128)
+    assert np.array_equal(decoded[0], vector)
+    assert not decoded.flags.owndata  # a view over the stored bytes, not a copy
+    assert decode_template(blob[:-4]) is None
+    assert decode_template(blob, version=99) is None
+
+    assert template_from_base64(template_to_base64(blob)) == blob
+    assert template_from_base64("not base64!") is None
+    assert np.array_equal(to_face_vector(blob), vector)
+
+
+def test_gallery_nearest_matches_brute_force():
+    faces = _random_faces(300)
+    gallery = FaceGallery(initial_capacity=8)
+    gallery.ensure_loaded(lambda: ((user_id, faces[user_id].tolist()) for user_id in range(len(faces))))
+    assert len(gallery) == 300
+
+    query = faces[42] + 0.01
+    match_id, distance = gallery.nearest(query)
+    expected = np.linalg.norm(faces - query, axis=1)
+    assert match_id == int(np.argmin(expected))
+    assert abs(distance - float(expected.min())) < 1e-5
+
+    other_id, _ = gallery.nearest(query, exclude_id=42)
+    assert other_id != 42
+
+
+def test_gallery_updates_in_place():
+    faces = _random_faces(4, seed=1)
+    gallery = FaceGallery(initial_capacity=2)
+
+    gallery.upsert(1, faces[0])
+    assert len(gallery) == 0  # not loaded yet, the database is the source of truth
+
+    gallery.ensure_loaded(lambda: [(1, faces[0]), (2, faces[1]), (3, faces[2])])
+    gallery.remove(1)
+    assert gallery.nearest(faces[0])[0] != 1
+    assert gallery.nearest(faces[2]) == (3, 0.0)
+
+    gallery.upsert(2, faces[3])
+    assert gallery.nearest(faces[3])[0] == 2
+    gallery.upsert(3, None)
+    assert len(gallery) == 1
+
+
+def test_gemv_distances_match_direct_norms_in_float32_and_float16():
+    faces = _random_faces(50, seed=6)
+    query = faces[7] + 0.01
+    expected = np.linalg.norm(faces - query, axis=1)
+
+    assert np.allclose(distances_to(faces, query), expected, atol=1e-5)
+    assert abs(min_distance(faces[5:10], query) - expected[5:10].min()) < 1e-6
+
+    for dtype in (np.float32, np.float16):
+        gallery = FaceGallery(initial_capacity=4, dtype=dtype)
+        gallery.ensure_loaded(lambda: enumerate(faces))
+        gallery.remove(3)
+        user_id, distance = gallery.nearest(query)
+        assert user_id == 7
+        assert abs(distance - expected[7]) < 1e-3
+
+
+def test_parse_descriptor_accepts_lists_and_base64_float32():
+    vector = _random_faces(1, seed=8)[0]
+    compact = template_to_base64(encode_template(vector))
+
+    assert np.array_equal(parse_descriptor(compact), vector)
+    assert np.allclose(parse_descriptor(vector.tolist()), vector)
+    assert parse_descriptor(vector.tolist()[:127]) is None
+    assert parse_descriptor([float("nan")] * 128) is None
+    assert parse_descriptor(template_to_base64(encode_template(np.full(128, np.inf)))) is None
+    assert parse_descriptor(template_to_base64(encode_template(np.zeros((2, 128))))) is None
+    assert parse_descriptor("not base64!") is None
+    assert parse_descriptor(["x"] * 128) is None
+
+
+def test_shared_store_gallery_is_built_once_and_remapped(tmp_path):
+    faces = _random_faces(4, seed=5)
+    first, second = FaceGallery(), FaceGallery()
+    first.attach_store(SharedFaceStore(str(tmp_path)))
+    second.attach_store(SharedFaceStore(str(tmp_path)))
+
+    first.ensure_loaded(lambda: [(1, faces[0]), (2, faces[1])])
+
+    def unused_loader():
+        raise AssertionError("second worker should map the published gallery")
+
+    second.ensure_loaded(unused_loader)
+    assert second.nearest(faces[1]) == (2, 0.0)
+
+    first.upsert(3, faces[2])
+    first.remove(1)
+    assert second.nearest(faces[2]) == (3, 0.0)
+    assert second.nearest(faces[0])[0] != 1
+    second.upsert(4, faces[3])
+    assert first.nearest(faces[3]) == (4, 0.0)
+    assert len(first) == len(second) == 3
+
+
+def test_shared_store_writes_replay_as_deltas_and_compact(tmp_path):
+    faces = _random_faces(40, seed=6)
+    index = IVFIndex.train(faces, nlist=4)
+    first, second = FaceGallery(), FaceGallery()
+    for gallery in (first, second):
+        gallery.attach_store(SharedFaceStore(str(tmp_path), compact_every=3))
+        gallery.attach_index(index, nprobe=4)
+    first.ensure_loaded(lambda: [(user_id, faces[user_id]) for user_id in range(30)])
+    second.ensure_loaded(lambda: [])
+
+    assigned = []
+    original_assign = index.assign
+    index.assign = lambda vectors: assigned.append(len(vectors)) or original_assign(vectors)
+    first.upsert(30, faces[30])
+    first.remove(0)
+    assert second.nearest(faces[30]) == (30, 0.0)
+    assert second.nearest(faces[0])[0] != 0
+    assert assigned == [1, 1]  # one row per write in each worker, not the whole gallery
+    assert sorted(path.name for path in tmp_path.glob("delta-*.npz")) == ["delta-2.npz", "delta-3.npz"]
+
+    first.upsert(31, faces[31])  # third delta: folded into a new base
+    assert (tmp_path / "owners-4.npy").exists()
+    second.upsert(32, faces[32])
+    assert assigned == [1, 1, 1, 1, 1]  # compaction and remapping reuse list assignments
+    assert first.nearest(faces[32]) == (32, 0.0)
+    assert second.nearest(faces[31]) == (31, 0.0)
+    assert len(first) == len(second) == 32
+
+    late = FaceGallery()
+    late.attach_store(SharedFaceStore(str(tmp_path)))
+    late.ensure_loaded(lambda: [])
+    assert late.nearest(faces[32]) == (32, 0.0)
+    assert len(late) == 32
+
+
+def test_private_galleries_reload_after_another_worker_writes(tmp_path):
+    faces = _random_faces(3, seed=9)
+    database = {1: faces[0]}
+    first, second = FaceGallery(), FaceGallery()
+    for gallery in (first, second):
+        gallery.attach_generations(GenerationFile(str(tmp_path / "face_gallery.generation")))
+        gallery.ensure_loaded(lambda: list(database.items()))
+
+    database[2] = faces[1]
+    first.upsert(2, faces[1])
+    loads = []
+    first.ensure_loaded(lambda: loads.append("first") or list(database.items()))
+    assert loads == []  # the writer's own copy is current
+
+    second.ensure_loaded(lambda: loads.append("second") or list(database.items()))
+    assert loads == ["second"]
+    assert second.nearest(faces[1]) == (2, 0.0)
+
+    del database[1]
+    second.remove(1)
+    first.ensure_loaded(lambda: list(database.items()))
+    assert first.nearest(faces[0])[0] != 1
+
+
+def test_ivf_index_reranks_exactly_and_round_trips(tmp_path):
+    faces = _random_faces(2000, seed=3)
+    index = IVFIndex.train(faces, nlist=20)
+    path = tmp_path / "face_index.npy"
+    index.save(str(path))
+    loaded = IVFIndex.load(str(path))
+    assert np.array_equal(loaded.centroids, index.centroids)
+    assert IVFIndex.load(str(tmp_path / "missing.npy")) is None
+
+    gallery = FaceGallery()
+    gallery.ensure_loaded(lambda: enumerate(faces))
+    gallery.attach_index(loaded, nprobe=4)
+    gallery.upsert(5000, faces[7] + 0.001)
+
+    match_id, distance = gallery.nearest(faces[11] + 0.01, exclude_id=None)
+    assert match_id == 11
+    assert abs(distance - float(np.linalg.norm(faces[11] - (faces[11] + 0.01)))) < 1e-5
+    assert gallery.nearest(faces[7], exclude_id=7)[0] == 5000
+
+
+def test_multi_template_blocks_and_best_of_k_matching():
+    faces = _random_faces(6, seed=4)
+    blob = encode_template(faces[:3])
+    assert len(blob) == 3 * 512
+    assert np.array_equal(to_face_matrix(blob), faces[:3])
+    assert to_face_vector(blob) is None  # several templates are not a single descriptor
+    assert to_face_matrix(encode_template(_random_faces(MAX_FACE_TEMPLATES + 1))) is None
+    assert abs(min_distance(faces[:3], faces[1])) < 1e-6
+
+    gallery = FaceGallery(initial_capacity=2)
+    gallery.ensure_loaded(lambda: [(1, encode_template(faces[:3])), (2, faces[3])])
+    assert len(gallery) == 4
+    assert gallery.nearest(faces[2]) == (1, 0.0)
+    assert gallery.nearest(faces[2], exclude_id=1)[0] == 2
+
+    gallery.upsert(1, faces[4:6])
+    assert len(gallery) == 3
+    assert gallery.nearest(faces[5])[0] == 1
+    gallery.remove(1)
+    assert len(gallery) == 1
+    assert gallery.nearest(faces[5])[0] == 2
+
+
+def test_duplicate_audit_matches_brute_force_and_resumes(tmp_path):
+    faces = _random_faces(300, seed=5)
+    faces[10] = faces[200] + 0.01
+    faces[20] = faces[250] + 0.02
+    owners = np.arange(300, dtype=np.int64)
+    owners[21] = 20  # a second template of user 20 is not a duplicate of itself
+    faces[21] = faces[20]
+
+    distances = np.linalg.norm(faces[:, None, :] - faces[None, :, :], axis=2)
+    expected = {
+        (min(owners[i], owners[j]), max(owners[i], owners[j]))
+        for i, j in zip(*np.nonzero(distances < 0.5))
+        if owners[i] != owners[j]
+    }
+
+    blocks = list(iter_duplicate_pairs(owners, faces, 0.5, block_size=64))
+    found = merge_pairs(pair for _, pairs in blocks for pair in pairs)
+    assert {(a, b) for a, b, _ in found} == expected == {(10, 200), (20, 250)}
+
+    resumed = list(iter_duplicate_pairs(owners, faces, 0.5, block_size=64, start_block=2))
+    assert [index for index, _ in resumed] == [2, 3, 4]
+
+    checkpoint = AuditCheckpoint(str(tmp_path / "audit.progress"))
+    fingerprint = gallery_fingerprint(owners, faces, 0.5, 64)
+    assert checkpoint.load(fingerprint) == (0, 0)
+    checkpoint.save(fingerprint, 3, 128)
+    assert checkpoint.load(fingerprint) == (3, 128)
+    assert checkpoint.load(gallery_fingerprint(owners, faces, 0.4, 64)) == (0, 0)
+
+    # A face re-registered between runs makes the old checkpoint stale.
+    reregistered = faces.copy()
+    reregistered[42] = _random_faces(1, seed=11)[0]
+    assert checkpoint.load(gallery_fingerprint(owners, reregistered, 0.5, 64)) == (0, 0)
+
+
+def test_calibration_recommends_threshold_between_distributions(tmp_path):
+    rng = np.random.default_rng(6)
+    genuine = GroupedHistograms()
+    genuine.add_rows(
+        (distance, "CSE", "CSE101", "Kiosk-AssistedVerify/2.0" if index % 2 else "Mozilla/5.0 (iPhone)")
+        for index, distance in enumerate(rng.normal(0.3, 0.05, 4000))
+    )
+    impostor = DistanceHistogram()
+    impostor.add(rng.normal(0.9, 0.08, 20000))
+
+    current = {"FACE_RECOGNITION_THRESHOLD": 0.45, "FACE_DUPLICATE_THRESHOLD": 0.5, "FACE_SPOOFING_THRESHOLD": 0.8}
+    report = build_calibration_report(genuine, impostor, current, far_target=0.001)
+    recommended = report["recommended"]["thresholds"]
+
+    assert 0.6 < recommended["FACE_RECOGNITION_THRESHOLD"] < 0.7
+    assert recommended["FACE_DUPLICATE_THRESHOLD"] > recommended["FACE_RECOGNITION_THRESHOLD"]
+    assert report["recommended"]["far"] <= 0.001
+    assert report["recommended"]["frr"] < report["current"]["frr"]
+    assert set(report["groups"]["device"]) == {"kiosk", "mobile"}
+    assert report["samples"]["genuine"] == 4000
+
+    # The admin API serves the report the offline command saved.
+    path = str(tmp_path / "face_calibration.json")
+    assert load_calibration_report(path) is None
+    save_calibration_report(report, path)
+    saved = load_calibration_report(path)
+    assert saved["recommended"]["thresholds"] == recommended
+    assert "generated_at" in saved
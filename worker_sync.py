@@ -0,0 +1,62 @@
+"""
+Cross-process coordination for gunicorn workers on one host.
+
+A ``GenerationFile`` is a small counter file: a worker that changes shared state bumps
+it, and every other worker compares the value with the one it last saw to know when to
+reload. ``file_lock`` serializes writers with ``flock``.
+"""
+import os
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - non-POSIX development machines
+    fcntl = None
+
+
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive advisory lock on ``path`` (created if missing) for the block."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "a+") as handle:
+        if fcntl is not None:
+            fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
+
+
+class GenerationFile:
+    """Monotonic counter shared by every worker process through a file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = f"{path}.lock"
+
+    def read(self):
+        """Return the current generation, or 0 if nothing has been published yet."""
+        try:
+            with open(self.path, encoding="ascii") as handle:
+                return int(handle.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def lock(self):
+        """Exclusive lock for read-modify-publish sequences."""
+        return file_lock(self.lock_path)
+
+    def write(self, generation):
+        """Replace the counter atomically; callers hold ``lock()``."""
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="ascii") as handle:
+            handle.write(str(int(generation)))
+        os.replace(tmp_path, self.path)
+
+    def bump(self):
+        """Increment the counter and return the new generation."""
+        with self.lock():
+            generation = self.read() + 1
+            self.write(generation)
+        return generation